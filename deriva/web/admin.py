@@ -0,0 +1,81 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Service administration routes, restricted to the admin groups of the "profiling" service config."""
+import os
+import json
+import datetime
+import flask
+from .core import app, deriva_ctx, RestHandler, NotFound, Forbidden, BadRequest, PROFILER, is_profiling_admin
+from .profiling import format_profile, PROFILE_SORT_KEYS
+
+
+class ProfileRetrieve(RestHandler):
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    def check_admin(self):
+        if not PROFILER.enabled:
+            raise NotFound("Request profiling is not enabled on this server.")
+        self.check_authenticated()
+        if not is_profiling_admin():
+            raise Forbidden("The currently authenticated user is not permitted to access request profiles.")
+
+    def list_profiles(self):
+        self.check_admin()
+        base_url = flask.request.base_url.rstrip("/")
+        profiles = [{"id": profile_id,
+                     "size": size,
+                     "modified": datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc).isoformat(),
+                     "url": "%s/%s" % (base_url, profile_id)}
+                    for profile_id, size, mtime in PROFILER.list_profiles()]
+        deriva_ctx.deriva_response.status = '200 OK'
+        deriva_ctx.deriva_response.content_type = 'application/json'
+        deriva_ctx.deriva_response.set_data(json.dumps(profiles, indent=2))
+        return deriva_ctx.deriva_response
+
+    def GET(self, profile_id):
+        self.check_admin()
+        try:
+            path = PROFILER.get_profile_path(profile_id)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        if not os.path.isfile(path):
+            raise NotFound("The profile %s does not exist. It was never created or has been pruned." % profile_id)
+        if flask.request.args.get("format") == "text":
+            sort = flask.request.args.get("sort", "cumulative")
+            if sort not in PROFILE_SORT_KEYS:
+                raise BadRequest("Invalid sort order: %s" % sort)
+            report = format_profile(path, sort=sort)
+            deriva_ctx.deriva_response.status = '200 OK'
+            deriva_ctx.deriva_response.content_type = 'text/plain'
+            deriva_ctx.deriva_response.set_data(report)
+            return deriva_ctx.deriva_response
+        deriva_ctx.deriva_response.content_type = 'application/octet-stream'
+        deriva_ctx.deriva_response.headers['Content-Disposition'] = \
+            "attachment; filename=\"%s\"" % os.path.basename(path)
+        return self.get_content(path)
+
+
+@app.route('/admin/profiles', methods=['GET'])
+@app.route('/admin/profiles/', methods=['GET'])
+def _profile_list_handler():
+    return ProfileRetrieve().list_profiles()
+
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+def _profile_retrieve_handler(profile_id):
+    return ProfileRetrieve().GET(profile_id)
@@ -19,4 +19,6 @@ from deriva.web.core import app
 import deriva.web.export.rest
 import deriva.web.export.providers.bdbag.rest
 import deriva.web.export.providers.file.rest
+import deriva.web.export.providers.batch.rest
+import deriva.web.admin
 
@@ -0,0 +1,220 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Content coding negotiation and streaming compression of responses.
+
+Response bodies are compressed chunk by chunk as they are sent, so a streamed response is never buffered in full. A
+compressed copy of a file (a "sidecar") is written alongside it while it is first sent, in the `.encoded` directory
+next to the file, and later requests for the same file and encoding are answered from the sidecar.
+"""
+import os
+import zlib
+import uuid
+import fnmatch
+import logging
+from deriva.core import format_exception
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ENCODING_EXTENSIONS = {
+    "br": ".br",
+    "zstd": ".zst",
+    "gzip": ".gz"
+}
+
+DEFAULT_COMPRESSION_CONFIG = {
+    "enabled": True,
+    "encodings": ["br", "zstd", "gzip"],
+    "levels": {"br": 5, "zstd": 3, "gzip": 6},
+    "min_size": 1024,
+    "mime_types": ["text/*", "application/json", "application/x-json-stream", "application/xml",
+                   "application/*+json", "application/*+xml"]
+}
+
+SIDECAR_DIR_NAME = ".encoded"
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def get_compression_config(config=None):
+    compression_config = DEFAULT_COMPRESSION_CONFIG.copy()
+    compression_config.update(config or {})
+    return compression_config
+
+
+def is_encoding_available(encoding):
+    if encoding == "br":
+        return brotli is not None
+    if encoding == "zstd":
+        return zstandard is not None
+    return encoding in ENCODING_EXTENSIONS
+
+
+def is_compressible(config, content_type, nbytes=None):
+    if not config.get("enabled") or not content_type:
+        return False
+    if nbytes is not None and nbytes < int(config.get("min_size") or 0):
+        return False
+    mime_type = content_type.split(";", 1)[0].strip().lower()
+    return any(fnmatch.fnmatch(mime_type, pattern) for pattern in config.get("mime_types") or [])
+
+
+def parse_accept_encoding(accept_encoding):
+    """Returns a {coding: qvalue} dict of the codings listed in an Accept-Encoding header."""
+    accepted = dict()
+    for item in (accept_encoding or "").split(","):
+        params = item.split(";")
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        accepted["gzip" if coding == "x-gzip" else coding] = qvalue
+    return accepted
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """Returns the content coding to use for a response, or None for the identity coding.
+
+    The coding with the highest qvalue in the Accept-Encoding header is chosen from the available encodings, which are
+    given in order of server preference, and ties are broken by that order.
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    best, best_qvalue = None, 0.0
+    for encoding in encodings:
+        if not is_encoding_available(encoding):
+            continue
+        qvalue = accepted.get(encoding, accepted.get("*", 0.0))
+        if qvalue > best_qvalue:
+            best, best_qvalue = encoding, qvalue
+    return best
+
+
+class _BrotliCompressor(object):
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def create_compressor(encoding, level=None):
+    """Returns an object with zlib-style compress(data) and flush() methods for the given content coding."""
+    if encoding == "gzip":
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "br" and brotli is not None:
+        return _BrotliCompressor(5 if level is None else level)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise ValueError("Unsupported content coding: %s" % encoding)
+
+
+def compress_chunks(chunks, encoding, level=None):
+    """Compress an iterable of str or bytes chunks incrementally, yielding compressed data as it becomes available."""
+    compressor = create_compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def read_file_chunks(file_path, offset=0, length=None, chunk_size=READ_CHUNK_SIZE):
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            data = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+
+def get_sidecar_path(file_path, encoding):
+    return os.path.join(os.path.dirname(file_path), SIDECAR_DIR_NAME,
+                        os.path.basename(file_path) + ENCODING_EXTENSIONS[encoding])
+
+
+def is_sidecar_current(file_path, sidecar_path):
+    """A sidecar is current if it carries the modification time of the file it was compressed from."""
+    try:
+        return os.stat(sidecar_path).st_mtime_ns == os.stat(file_path).st_mtime_ns
+    except OSError:
+        return False
+
+
+def write_sidecar(chunks, file_path, sidecar_path):
+    """Yield compressed chunks while also writing them to the sidecar of file_path.
+
+    The sidecar only appears once every chunk has been written, so an interrupted or failed write never leaves a
+    partial sidecar behind. Failure to write the sidecar does not interrupt the response.
+    """
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    tmp = "%s.%s.tmp" % (sidecar_path, uuid.uuid4().hex)
+    f = None
+    try:
+        os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+        f = open(tmp, "wb")
+    except OSError as e:
+        logger.warning("Unable to create compressed copy of %s: %s" % (file_path, format_exception(e)))
+    try:
+        for chunk in chunks:
+            if f is not None:
+                try:
+                    f.write(chunk)
+                except OSError as e:
+                    logger.warning("Unable to write compressed copy of %s: %s" % (file_path, format_exception(e)))
+                    f.close()
+                    f = None
+            yield chunk
+        if f is not None:
+            f.close()
+            f = None
+            try:
+                os.utime(tmp, ns=(mtime_ns, mtime_ns))
+                os.replace(tmp, sidecar_path)
+            except OSError as e:
+                logger.warning("Unable to save compressed copy of %s: %s" % (file_path, format_exception(e)))
+    finally:
+        if f is not None:
+            f.close()
+        if os.path.lexists(tmp):
+            os.remove(tmp)
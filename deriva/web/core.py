@@ -19,7 +19,11 @@
 
 import os
 import sys
+import copy
+import math
 import logging
+import ipaddress
+import threading
 import traceback
 import werkzeug
 import flask
@@ -27,7 +31,6 @@ import json
 import random
 import base64
 import datetime
-import pytz
 import struct
 import urllib
 import requests
@@ -35,9 +38,13 @@ from collections import OrderedDict
 from logging.handlers import SysLogHandler
 import webauthn2.util
 from webauthn2.util import deriva_ctx, deriva_debug, merge_config, negotiated_content_type, Context
-from webauthn2.manager import Manager
 from webauthn2.rest import format_trace_json, format_final_json
 from deriva.core import format_exception
+from .ratelimit import RateLimiter
+from .profiling import RequestProfiler, new_profile_id
+from .tracing import Tracer, TracedIterable, traced
+from .compression import get_compression_config, is_compressible, negotiate_encoding, compress_chunks, \
+    read_file_chunks, get_sidecar_path, is_sidecar_current, write_sidecar
 
 SERVICE_BASE_DIR = os.path.expanduser("~")
 STORAGE_BASE_DIR = os.path.join("deriva", "data")
@@ -64,9 +71,40 @@ else:
 
 STORAGE_PATH = SERVICE_CONFIG.get('storage_path')
 
-# instantiate webauthn2 manager if using webauthn
 AUTHENTICATION = SERVICE_CONFIG.get("authentication", None)
-webauthn2_manager = Manager() if AUTHENTICATION == "webauthn" else None
+
+RATE_LIMITER = RateLimiter(SERVICE_CONFIG.get("rate_limits"))
+
+COMPRESSION_CONFIG = get_compression_config(SERVICE_CONFIG.get("compression"))
+
+PROFILER = RequestProfiler(SERVICE_CONFIG.get("profiling"), os.path.join(STORAGE_PATH, "profiles"))
+
+TRACER = Tracer(SERVICE_CONFIG.get("tracing"), os.path.join(STORAGE_PATH, "traces", "traces.jsonl"))
+
+# the webauthn2 manager (if using webauthn) is created on first use, see get_webauthn2_manager()
+_webauthn2_manager = None
+_webauthn2_manager_pid = None
+_webauthn2_manager_lock = threading.Lock()
+
+
+def get_webauthn2_manager():
+    """Returns the webauthn2 manager of the current process, or None if webauthn is not in use.
+
+    The manager is created lazily so that importing the app stays cheap, and it is re-created in a forked child
+    process, because its database connections must not be shared with the parent.
+    """
+    global _webauthn2_manager, _webauthn2_manager_pid
+    if AUTHENTICATION != "webauthn":
+        return None
+    pid = os.getpid()
+    if _webauthn2_manager is None or _webauthn2_manager_pid != pid:
+        with _webauthn2_manager_lock:
+            if _webauthn2_manager is None or _webauthn2_manager_pid != pid:
+                from webauthn2.manager import Manager
+                _webauthn2_manager = Manager()
+                _webauthn2_manager_pid = pid
+    return _webauthn2_manager
+
 
 # setup logger and web request log helpers
 logger = logging.getLogger()
@@ -210,6 +248,16 @@ class BadRange(RestException):
             self.headers['content-range'] = 'bytes */%d' % nbytes
 
 
+class TooManyRequests(RestException):
+    code = 429
+    message = 'Request rate limit exceeded.'
+
+    def __init__(self, msg=None, headers=None, retry_after=None):
+        RestException.__init__(self, msg, dict(headers or {}))
+        if retry_after is not None:
+            self.headers['retry-after'] = '%d' % math.ceil(retry_after)
+
+
 class InternalServerError(RestException):
     code = 500
     message = 'A processing error prevented the server from fulfilling this request.'
@@ -225,14 +273,24 @@ class BadGateway(RestException):
     message = 'A downstream processing error prevented the server from fulfilling this request.'
 
 
+def get_client_attribute_ids():
+    """Returns the set of attribute IDs (identities and groups) of the client, computed once per request."""
+    attribute_ids = getattr(deriva_ctx, 'derivaweb_client_attribute_ids', None)
+    if attribute_ids is None:
+        attributes = deriva_ctx.webauthn2_context.attributes if deriva_ctx.webauthn2_context else None
+        attribute_ids = frozenset(attrib['id'] for attrib in attributes or [])
+        deriva_ctx.derivaweb_client_attribute_ids = attribute_ids
+    return attribute_ids
+
+
 def client_has_identity(identity):
     if identity == "*":
         return True
-    if deriva_ctx.webauthn2_context.attributes is not None:
-        for attrib in deriva_ctx.webauthn2_context.attributes:
-            if attrib['id'] == identity:
-                return True
-    return False
+    return identity in get_client_attribute_ids()
+
+
+def is_profiling_admin():
+    return any(client_has_identity(group) for group in PROFILER.admin_groups)
 
 
 def get_client_identity():
@@ -242,6 +300,49 @@ def get_client_identity():
         return None
 
 
+def parse_ip(value):
+    """Returns the normalized form of an IPv4 or IPv6 address, or None if value is not one."""
+    try:
+        return str(ipaddress.ip_address(value.strip()))
+    except (ValueError, AttributeError):
+        return None
+
+
+def parse_trusted_proxies(config):
+    networks = list()
+    for proxy in config or []:
+        try:
+            networks.append(ipaddress.ip_network(proxy, strict=False))
+        except ValueError:
+            logger.warning("Ignoring invalid trusted proxy address: %s" % proxy)
+    return networks
+
+
+TRUSTED_PROXIES = parse_trusted_proxies(SERVICE_CONFIG.get("trusted_proxies"))
+
+
+def resolve_client_ip(remote_addr, forwarded_for=None, trusted_proxies=None):
+    """Returns the address of the client of a request: the peer address of the connection, unless that is a trusted
+    proxy, in which case it is the right-most address of the X-Forwarded-For header which was not added by a trusted
+    proxy. The left-most entries of the header are whatever the client sent, so they are never trusted."""
+    ip = parse_ip(remote_addr)
+    if ip is None or not forwarded_for:
+        return ip
+    for hop in reversed(forwarded_for.split(',')):
+        if not any(ipaddress.ip_address(ip) in network for network in trusted_proxies or []):
+            break
+        hop = parse_ip(hop)
+        if hop is None:
+            break
+        ip = hop
+    return ip
+
+
+def get_client_ip():
+    return resolve_client_ip(flask.request.remote_addr, flask.request.environ.get('HTTP_X_FORWARDED_FOR'),
+                             TRUSTED_PROXIES)
+
+
 def get_client_wallet():
     if deriva_ctx.webauthn2_context and deriva_ctx.webauthn2_context.extra_values:
         return deriva_ctx.webauthn2_context.extra_values.get("wallet")
@@ -252,20 +353,50 @@ def get_client_wallet():
 def before_request():
     # request context init
     deriva_ctx.derivaweb_request_guid = base64.b64encode(struct.pack('Q', random.getrandbits(64))).decode()
-    deriva_ctx.derivaweb_start_time = datetime.datetime.now(pytz.timezone('UTC'))
+    deriva_ctx.derivaweb_start_time = datetime.datetime.now(datetime.timezone.utc)
     deriva_ctx.deriva_response = flask.Response() # to accumulate response content by side-effect
     deriva_ctx.derivaweb_request_content_range = '-/-'
     deriva_ctx.derivaweb_content_type = None
     deriva_ctx.derivaweb_request_error_detail = None
     deriva_ctx.derivaweb_request_trace = request_trace
+    webauthn2_manager = get_webauthn2_manager()
     deriva_ctx.webauthn2_manager = webauthn2_manager
+    deriva_ctx.derivaweb_client_attribute_ids = None
+    deriva_ctx.derivaweb_profile = None
+
+    # trace the request if it is sampled (see the "tracing" service config)
+    route = flask.request.url_rule.rule if flask.request.url_rule else flask.request.path
+    deriva_ctx.derivaweb_trace = TRACER.start_trace(
+        "%s %s" % (flask.request.method, route),
+        traceparent=flask.request.headers.get("traceparent"),
+        attributes={"http.request.method": flask.request.method,
+                    "http.route": route,
+                    "url.path": flask.request.path,
+                    "client.address": flask.request.remote_addr,
+                    "deriva.request_guid": deriva_ctx.derivaweb_request_guid})
 
     # call directly into manager code to access full session context from DB
     # we may need the extra_values wallet info, not passed from mod_webauthn!
-    deriva_ctx.webauthn2_context = webauthn2_manager.get_request_context(
-        require_client=False,
-        require_attributes=False,
-    ) if webauthn2_manager is not None else Context()
+    with traced("webauthn2.get_request_context"):
+        deriva_ctx.webauthn2_context = webauthn2_manager.get_request_context(
+            require_client=False,
+            require_attributes=False,
+        ) if webauthn2_manager is not None else Context()
+
+    # the client is known, so the request can be counted against its rate limits
+    identity = get_client_identity()
+    retry_after = RATE_LIMITER.check(flask.request.path,
+                                     flask.request.method,
+                                     identity=identity.get('id') if identity else None,
+                                     ip=get_client_ip(),
+                                     attribute_ids=get_client_attribute_ids())
+    if retry_after:
+        raise TooManyRequests("Retry after %d seconds." % math.ceil(retry_after), retry_after=retry_after)
+
+    # profile the request if an admin asked for it (see the "profiling" service config)
+    if PROFILER.is_requested(flask.request.headers) and is_profiling_admin():
+        deriva_ctx.derivaweb_profile_id = new_profile_id(deriva_ctx.derivaweb_request_guid)
+        deriva_ctx.derivaweb_profile = PROFILER.start()
 
 @app.after_request
 def after_request(response):
@@ -278,6 +409,20 @@ def after_request(response):
     elif isinstance(response, werkzeug.exceptions.HTTPException):
         deriva_ctx.deriva_response.status = response.code
 
+    if getattr(deriva_ctx, 'derivaweb_profile', None) is not None:
+        response.headers['%s-Id' % PROFILER.header] = deriva_ctx.derivaweb_profile_id
+
+    trace = getattr(deriva_ctx, 'derivaweb_trace', None)
+    if trace is not None:
+        trace.set_attribute("http.response.status_code", response.status_code)
+        if response.status_code >= 500:
+            trace.set_error(response.status)
+        # the trace ends once the response has been sent, which for a streamed body (e.g. a file) is after teardown
+        if response.is_streamed:
+            response.response = TracedIterable("http.response.send", response.response)
+        response.call_on_close(lambda: TRACER.end_trace(trace))
+        deriva_ctx.derivaweb_trace = None
+
     deriva_ctx.deriva_content_type = response.headers.get('content-type', 'none')
     if 'content-range' in response.headers:
         content_range = response.headers['content-range']
@@ -302,6 +447,18 @@ def after_request(response):
     ))
     return response
 
+@app.teardown_request
+def teardown_request(exc=None):
+    profile = getattr(deriva_ctx, 'derivaweb_profile', None)
+    if profile is not None:
+        deriva_ctx.derivaweb_profile = None
+        PROFILER.stop(profile, deriva_ctx.derivaweb_profile_id)
+    trace = getattr(deriva_ctx, 'derivaweb_trace', None)
+    if trace is not None:
+        # the request failed before its response was finalized
+        deriva_ctx.derivaweb_trace = None
+        TRACER.end_trace(trace, exc)
+
 @app.errorhandler(Exception)
 def error_handler(ev):
     if isinstance(ev, werkzeug.exceptions.HTTPException):
@@ -318,6 +475,23 @@ def error_handler(ev):
 
     return ev
 
+_handler_config_cache = dict()
+
+
+def read_handler_config(config_file):
+    """Read a handler config file, re-parsing it only when it has changed on disk.
+
+    Every service process holds its own copy, so the file mtime is what keeps all processes consistent.
+    """
+    mtime = os.path.getmtime(config_file)
+    cached = _handler_config_cache.get(config_file)
+    if cached is None or cached[0] != mtime:
+        with open(config_file) as cf:
+            cached = (mtime, json.load(cf))
+        _handler_config_cache[config_file] = cached
+    return copy.deepcopy(cached[1])
+
+
 class RestHandler(object):
     """Generic implementation logic for deriva REST API handlers.
 
@@ -326,6 +500,7 @@ class RestHandler(object):
     def __init__(self, handler_config_file=None, default_handler_config=None):
         self.get_body = True
         self.http_etag = None
+        webauthn2_manager = get_webauthn2_manager()
         self.http_vary = webauthn2_manager.get_http_vary() if webauthn2_manager else None
         self.config = self.load_handler_config(handler_config_file, default_handler_config)
         # deriva_debug("Using configuration: %s" % json.dumps(self.config))
@@ -333,8 +508,7 @@ class RestHandler(object):
     def load_handler_config(self, config_file, default_config=None):
         config = default_config.copy() if default_config else {}
         if config_file and os.path.isfile(config_file):
-            with open(config_file) as cf:
-                config.update(json.load(cf))
+            config.update(read_handler_config(config_file))
         return config
 
     def check_authenticated(self):
@@ -357,21 +531,117 @@ class RestHandler(object):
                     result[parts[0]] = '='.join(parts[1:])
         return result
 
-    def get_content(self, file_path):
-        get_body = flask.request.method.upper() != 'HEAD'
-
-        deriva_ctx.deriva_response.status = '200 OK'
-        nbytes = os.path.getsize(file_path)
-        deriva_ctx.deriva_response.content_length = nbytes
+    def get_byte_range(self, nbytes):
+        """Returns the (first, last) byte positions requested by a single range Range header, or None.
 
-        if not get_body:
+        Any other Range header is ignored, so that the full content is sent, as RFC 7233 permits.
+        """
+        header = flask.request.headers.get('range')
+        if not header:
+            return None
+        units, _, ranges = header.partition('=')
+        first, sep, last = ranges.strip().partition('-')
+        if units.strip().lower() != 'bytes' or ',' in ranges or not sep:
+            return None
+        try:
+            if first.strip():
+                first, last = int(first), int(last) if last.strip() else None
+                if last is not None and last < first:
+                    return None
+                last = nbytes - 1 if last is None else min(last, nbytes - 1)
+            else:
+                suffix = int(last)
+                if suffix < 1:
+                    raise BadRange("Invalid byte range: %s" % header, headers={}, nbytes=nbytes)
+                first, last = max(0, nbytes - suffix), nbytes - 1
+        except ValueError:
+            return None
+        if first >= nbytes:
+            raise BadRange("Byte range %s starts beyond the end of the content." % header, headers={}, nbytes=nbytes)
+        return first, last
+
+    def negotiate_content_encoding(self, nbytes=None):
+        """Returns the content coding to apply to the response body, or None to send it unencoded."""
+        if not is_compressible(COMPRESSION_CONFIG, deriva_ctx.deriva_response.content_type, nbytes):
+            return None
+        deriva_ctx.deriva_response.vary.add('Accept-Encoding')
+        return negotiate_encoding(flask.request.headers.get('accept-encoding'), COMPRESSION_CONFIG["encodings"])
+
+    def compress_response(self):
+        """Compress the (possibly streaming) body of the response as it is sent, if the client accepts it."""
+        response = deriva_ctx.deriva_response
+        encoding = self.negotiate_content_encoding()
+        if encoding:
+            response.response = compress_chunks(response.response, encoding, COMPRESSION_CONFIG["levels"].get(encoding))
+            response.direct_passthrough = True
+            response.content_encoding = encoding
+            response.headers.pop('content-length', None)
+        return response
+
+    def get_encoded_content(self, file_path, encoding, get_body, length=None):
+        """Sends a file with a content coding. A length limits the content to the first length bytes of a file which
+        is still growing, which is compressed as it is sent without saving a compressed copy next to it."""
+        response = deriva_ctx.deriva_response
+        response.status = '200 OK'
+        response.content_encoding = encoding
+        if length is not None:
+            if get_body:
+                response.response = compress_chunks(read_file_chunks(file_path, 0, length), encoding,
+                                                    COMPRESSION_CONFIG["levels"].get(encoding))
+                response.direct_passthrough = True
+            return response
+        sidecar_path = get_sidecar_path(file_path, encoding)
+        if is_sidecar_current(file_path, sidecar_path):
+            response.content_length = os.path.getsize(sidecar_path)
+            if get_body:
+                response.response = open(sidecar_path, 'rb')
+                response.direct_passthrough = True
+            return response
+        if get_body:
+            # the first request for this encoding compresses the file as it is sent, and saves the result for reuse
+            chunks = compress_chunks(read_file_chunks(file_path), encoding, COMPRESSION_CONFIG["levels"].get(encoding))
+            response.response = write_sidecar(chunks, file_path, sidecar_path)
+            response.direct_passthrough = True
+        return response
+
+    def get_content(self, file_path, growing=False):
+        """Sends a file, or the requested byte range of it. A file which is growing, such as the log of a running
+        export, is sent as it is now, and no compressed copy of it is saved."""
+        with traced("get_content", {"file.path": file_path}) as span:
+            get_body = flask.request.method.upper() != 'HEAD'
+
+            nbytes = os.path.getsize(file_path)
+            span.set_attribute("file.size", nbytes)
+            deriva_ctx.deriva_response.headers['Accept-Ranges'] = 'bytes'
+            byte_range = self.get_byte_range(nbytes)
+            if byte_range is None:
+                # ranges always refer to the unencoded content
+                encoding = self.negotiate_content_encoding(nbytes)
+                if encoding:
+                    return self.get_encoded_content(file_path, encoding, get_body, nbytes if growing else None)
+            else:
+                first, last = byte_range
+                deriva_ctx.deriva_response.status = '206 Partial Content'
+                deriva_ctx.deriva_response.headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, nbytes)
+                deriva_ctx.deriva_response.content_length = last - first + 1
+                if get_body:
+                    deriva_ctx.deriva_response.response = read_file_chunks(file_path, first, last - first + 1)
+                    deriva_ctx.deriva_response.direct_passthrough = True
+                return deriva_ctx.deriva_response
+
+            deriva_ctx.deriva_response.status = '200 OK'
+            deriva_ctx.deriva_response.content_length = nbytes
+
+            if not get_body:
+                return deriva_ctx.deriva_response
+
+            if growing:
+                deriva_ctx.deriva_response.response = read_file_chunks(file_path, 0, nbytes)
+            else:
+                deriva_ctx.deriva_response.response = open(file_path, 'rb')
+            deriva_ctx.deriva_response.direct_passthrough = True
             return deriva_ctx.deriva_response
 
-        f = open(file_path, 'rb')
-        deriva_ctx.deriva_response.response = f
-        deriva_ctx.deriva_response.direct_passthrough = True
-        return deriva_ctx.deriva_response
-
     def create_response(self, urls, set_location_header=True):
         """Form response for resource creation request."""
         deriva_ctx.deriva_response.status = '201 Created'
@@ -387,6 +657,22 @@ class RestHandler(object):
         deriva_ctx.deriva_response.set_data(body)
         return deriva_ctx.deriva_response
 
+    def accepted_response(self, body, location=None):
+        """Form response for a request which is processed in the background, with a JSON status document."""
+        deriva_ctx.deriva_response.status = '202 Accepted'
+        deriva_ctx.deriva_response.content_type = 'application/json'
+        if location:
+            deriva_ctx.deriva_response.location = location
+        deriva_ctx.deriva_response.set_data(json.dumps(body, indent=2))
+        return deriva_ctx.deriva_response
+
+    def redirect_response(self, url):
+        """Form response redirecting the client to another location for the requested content."""
+        deriva_ctx.deriva_response.status = '302 Found'
+        deriva_ctx.deriva_response.location = url
+        deriva_ctx.deriva_response.content_length = 0
+        return deriva_ctx.deriva_response
+
     def delete_response(self):
         """Form response for deletion request."""
         deriva_ctx.deriva_response.status = '204 No Content'
@@ -14,25 +14,45 @@
 # limitations under the License.
 #
 import os
+import copy
+import json
 import errno
+import shutil
 import logging
 import uuid
 import flask
-import shutil
-import socket
-from pathlib import Path
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext, ExitStack
 from portalocker import LockException, AlreadyLocked
 from requests import HTTPError
-from deriva.core import urlparse, format_credential, format_exception, get_new_requests_session, lock_file
-from deriva.transfer import GenericDownloader
-from deriva.transfer.download import DerivaDownloadAuthenticationError, DerivaDownloadAuthorizationError, \
-    DerivaDownloadConfigurationError, DerivaDownloadTimeoutError, DerivaDownloadError
-from ..core import STORAGE_PATH, AUTHENTICATION, DEFAULT_HANDLER_CONFIG_DIR, client_has_identity, \
-    get_client_identity, get_client_wallet, \
-    deriva_ctx, deriva_debug, \
+from deriva.core import urlparse, format_credential, format_exception, get_new_requests_session, lock_file, stob
+from .archive import get_archive_policy, is_archiver_available
+from .storage import create_export_storage
+from .events import ProgressReporter, emit_event, queue_webhook, delete_events, is_webhook_allowed, \
+    EVENT_COMPLETE, EVENT_FAILED, EVENT_CANCELLED
+from .jobs import create_job, finish_job, get_job, delete_jobs, running_job_keys, is_job_cancelled, \
+    JOB_COMPLETE, JOB_FAILED
+from .worker import run_isolated, is_isolation_available, ExportCancelledError, DEFAULT_ISOLATION_CONFIG, \
+    LOG_FORMAT
+from .batch import DEFAULT_BATCH_CONFIG
+from .streams import DEFAULT_STREAMS_CONFIG
+from .expiry import set_export_expiry, renew_export_expiry, delete_export_expiry
+from ..profiling import paused, EXPORT_PROFILE_SUFFIX
+from ..tracing import traced, trace_context, SPAN_KIND_CLIENT
+from ..core import STORAGE_PATH, AUTHENTICATION, DEFAULT_HANDLER_CONFIG_DIR, get_client_attribute_ids, \
+    get_client_identity, get_client_ip, get_client_wallet, \
+    deriva_ctx, deriva_debug, PROFILER, TRACER, \
     BadRequest, Unauthorized, Forbidden, Conflict, BadGateway, \
     logger as sys_logger
 
+METADATA_FILES = frozenset([".access", ".log", ".stats", ".lock", ".purge.lock"])
+
+# the key of the remote URLs in the output metadata of a file, i.e. GenericDownloader.REMOTE_PATHS_KEY, which is kept
+# here so that the request handlers can be imported without loading the transfer machinery
+REMOTE_PATHS_KEY = "remote_paths"
+
 HANDLER_CONFIG_FILE = os.path.join(DEFAULT_HANDLER_CONFIG_DIR, "export", "export_config.json")
 DEFAULT_HANDLER_CONFIG = {
   "propagate_logs": True,
@@ -42,93 +62,396 @@ DEFAULT_HANDLER_CONFIG = {
   "allow_concurrent_export": False,
   "max_payload_size_mb": 0,
   "dir_auto_purge_threshold": 5,
-  "timeout_secs": 600
+  "ttl_secs": 86400,
+  "max_ttl_secs": 2592000,
+  "expiry_sweep_interval_secs": 300,
+  "timeout_secs": 600,
+  "enable_blob_cache": False,
+  "blob_cache_max_size_mb": 0,
+  "bag_archive_policy": {},
+  "storage": {"type": "local"},
+  "webhooks": {"enabled": False, "allowed_url_patterns": [], "max_attempts": 5, "backoff_secs": 2},
+  "additional_read_acl": [],
+  "isolation": DEFAULT_ISOLATION_CONFIG,
+  "scratch_path": None,
+  "templates_path": None,
+  "batch_exports": DEFAULT_BATCH_CONFIG,
+  "streams": DEFAULT_STREAMS_CONFIG
 }
 
 logger = logging.getLogger()
 
 
+class ThreadLogFilter(logging.Filter):
+    """Passes only the records of the thread which created it, so that the log of an export does not pick up the
+    records of other exports which run at the same time. An isolated export writes its own records to the log."""
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.thread = threading.get_ident()
+
+    def filter(self, record):
+        return record.thread == self.thread
+
+
 def configure_logging(level=logging.INFO, log_path=None, propagate=True):
     handler = None
     logger.propagate = propagate
     logger.setLevel(level)
     if log_path and propagate:
         handler = logging.FileHandler(log_path)
-        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(ThreadLogFilter())
         logger.addHandler(handler)
 
     return handler
 
 
-def create_output_dir():
+def get_scratch_path(scratch_path=None):
+    """Returns the base directory in which exports are built, before they are published for retrieval."""
+    return os.path.abspath(scratch_path or os.path.join(STORAGE_PATH, "scratch", "export"))
+
+
+def create_output_dir(scratch_path=None, ttl_secs=None):
 
     key = str(uuid.uuid4())
-    output_dir = os.path.abspath(os.path.join(get_staging_path(), key))
+    owner = get_staging_subdir()
+    output_dir = os.path.join(get_scratch_path(scratch_path), owner or "", key)
     if not os.path.isdir(output_dir):
         try:
             os.makedirs(output_dir)
         except OSError as error:
             if error.errno != errno.EEXIST:
                 raise
+    create_job(key, owner, output_dir)
+    if ttl_secs:
+        set_export_expiry(owner, key, ttl_secs)
     return key, output_dir
 
 
-def purge_output_dirs(threshold=0, count=1):
+def get_export_ttl(settings, requested=None):
+    """Returns the time to live of a new export in seconds, or 0 if it does not expire: the TTL requested by the client
+    (with the "ttl" URL parameter), up to the max_ttl_secs setting, or else the ttl_secs setting of the export handler
+    config or template."""
+    ttl = float(settings.get("ttl_secs", DEFAULT_HANDLER_CONFIG["ttl_secs"]) or 0)
+    if requested is not None:
+        try:
+            requested = float(requested)
+        except ValueError:
+            requested = -1
+        if requested <= 0:
+            raise BadRequest("Invalid ttl: the time to live must be a positive number of seconds.")
+        max_ttl = float(settings.get("max_ttl_secs", DEFAULT_HANDLER_CONFIG["max_ttl_secs"]) or 0)
+        ttl = min(requested, max_ttl) if max_ttl else requested
+    return ttl
+
+
+def purge_output_dirs(threshold=0, count=1, storage=None):
     if threshold < 1:
         return
     basedir = get_staging_path()
-    if not os.path.isdir(basedir):
-        return
-    paths = [os.fspath(path) for path in sorted(Path(basedir).iterdir(), key=os.path.getctime, reverse=True)]
-    if not paths or (len(paths) < threshold):
+    os.makedirs(basedir, exist_ok=True)
+    storage = storage or get_export_storage()
+    owner = get_staging_subdir()
+    # only one process purges a given user's staging dir at a time; everyone else just skips purging
+    try:
+        with lock_file(os.path.join(basedir, ".purge.lock"), mode='w', exclusive=True, timeout=0):
+            running = running_job_keys(owner)
+            keys = [key for key, created in sorted(storage.list_exports(owner), key=lambda e: e[1], reverse=True)
+                    if key not in running]
+            if not keys or (len(keys) < threshold):
+                return
+
+            purged = list()
+            for i in range(min(count, len(keys))):
+                try:
+                    key = keys.pop()
+                    storage.delete(owner, key)
+                    purged.append(key)
+                except Exception as e:
+                    logging.warning(format_exception(e))
+            delete_jobs(purged)
+            delete_events(purged)
+            delete_export_expiry(purged)
+            forget_export_acls(storage, [(owner, key) for key in purged])
+    except LockException:
         return
 
-    for i in range(count):
-        try:
-            path = paths.pop()
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-        except Exception as e:
-            logging.warning(format_exception(e))
 
+def get_export_url(key, path=None):
+    return "%s/%s/%s" % (
+        flask.request.root_url.rstrip('/'),
+        (path or flask.request.path).strip('/'),
+        key.lstrip('/'),
+    )
 
-def get_client_ip():
-    ip = flask.request.environ.get('HTTP_X_FORWARDED_FOR', flask.request.remote_addr)
-    for ip in ip.split(','):
-        ip = ip.strip()
-        try:
-            socket.inet_aton(ip)
-            return ip
-        except socket.error:
-            pass
-    return None
 
-
-def get_staging_path():
+def get_staging_subdir():
     identity = get_client_identity()
-    subdir = 'anon-%s' % get_client_ip() or "unknown" \
+    return 'anon-%s' % get_client_ip() or "unknown" \
         if not identity else identity.get('id', '').rsplit("/", 1)[-1]
-    return os.path.abspath(os.path.join(STORAGE_PATH, "export", subdir or ""))
+
+
+def get_staging_path():
+    return os.path.abspath(os.path.join(STORAGE_PATH, "export", get_staging_subdir() or ""))
+
+
+def list_output_files(directory):
+    return sorted(f for f in os.listdir(directory)
+                  if f not in METADATA_FILES and os.path.isfile(os.path.join(directory, f)))
+
+
+def get_export_files(key, storage, owner):
+    """Returns the retrievable files of an export, from the shared job state when possible."""
+    job = get_job(key)
+    if job and job["status"] == JOB_COMPLETE and job["files"] is not None:
+        return job["files"]
+    return storage.list_files(owner, key)
+
+
+_export_storage = dict()
+
+
+def get_export_storage(config=None):
+    """Returns the (per-process, shared) storage backend instance for the "storage" handler config object."""
+    cache_key = json.dumps(config, sort_keys=True)
+    storage = _export_storage.get(cache_key)
+    if storage is None:
+        storage = create_export_storage(config, os.path.join(STORAGE_PATH, "export"))
+        _export_storage[cache_key] = storage
+    return storage
 
 
 def get_final_output_path(output_path, output_name=None, ext=''):
     return ''.join([os.path.join(output_path, output_name) if output_name else output_path, ext])
 
 
-def create_access_descriptor(directory, identity, public=False):
-    with open(os.path.abspath(os.path.join(directory, ".access")), 'w') as access:
-        access.writelines(''.join([identity if (identity and not public) else "*", '\n']))
+def create_access_descriptor(directory, identity, public=False, additional_acl=None):
+    acl = ["*"] if (public or not identity) else [identity] + [a for a in additional_acl or [] if a != identity]
+    write_access_descriptor(directory, acl)
+
+
+def write_access_descriptor(directory, acl):
+    path = os.path.abspath(os.path.join(directory, ".access"))
+    with open(path, 'w') as access:
+        json.dump({"acl": acl}, access)
+    # prime the ACL cache of this process, since the creator is also the most likely first reader
+    _acl_cache.put(path, os.path.getmtime(path), frozenset(acl))
+
+
+def parse_access_descriptor(data):
+    """Parse an access descriptor into a frozenset of permitted identities.
+
+    The descriptor is a JSON object with an "acl" list of identity or group attribute IDs (or "*" for public access).
+    The legacy format, one identity per line, is also accepted.
+    """
+    text = data.decode().strip()
+    if text.startswith("{"):
+        return frozenset(json.loads(text).get("acl", []))
+    return frozenset(line.strip() for line in text.splitlines() if line.strip())
+
+
+class ACLCache(object):
+    """Bounded per-process cache of parsed export ACLs.
+
+    Entries for local descriptor files are validated against the file mtime (one stat, no open); entries read from a
+    remote storage backend never change once published and are cached as-is, until their export is deleted."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, cache_key, mtime=None):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None or entry[0] != mtime:
+                return None
+            self.entries.move_to_end(cache_key)
+            return entry[1]
+
+    def put(self, cache_key, mtime, acl):
+        with self.lock:
+            self.entries[cache_key] = (mtime, acl)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, cache_key):
+        with self.lock:
+            self.entries.pop(cache_key, None)
 
 
-def check_access(directory):
+_acl_cache = ACLCache()
+
+
+def _local_access_paths(storage, owner, key):
+    yield storage.local_path(owner, key, ".access")
+    # an export that is not yet published may be in progress in the scratch area
+    job = get_job(key)
+    if job and job["owner"] == owner:
+        yield os.path.join(job["output_dir"], ".access")
+
+
+def get_export_acl(storage, owner, key):
+    """Returns the frozenset of identities permitted to access an export, or None if it has no access descriptor."""
+    for path in _local_access_paths(storage, owner, key):
+        if not path:
+            continue
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        acl = _acl_cache.get(path, mtime)
+        if acl is None:
+            with open(path, 'rb') as af:
+                acl = parse_access_descriptor(af.read())
+            _acl_cache.put(path, mtime, acl)
+        return acl
+
+    cache_key = (owner, key)
+    acl = _acl_cache.get(cache_key)
+    if acl is None:
+        data = storage.read_metadata(owner, key, ".access")
+        if data is None:
+            return None
+        acl = parse_access_descriptor(data)
+        _acl_cache.put(cache_key, None, acl)
+    return acl
+
+
+def forget_export_acls(storage, exports):
+    """Evicts the cached ACLs of deleted exports, given as (owner, key) tuples, from the cache of this process."""
+    for owner, key in exports:
+        _acl_cache.discard((owner, key))
+        path = storage.local_path(owner, key, ".access")
+        if path:
+            _acl_cache.discard(path)
+
+
+def check_access(storage, owner, key):
     if not AUTHENTICATION:
         return True
 
-    with open(os.path.abspath(os.path.join(directory, ".access")), 'r') as access:
-        for identity in access.readlines():
-            if client_has_identity(identity.strip()):
-                return True
-    return False
+    acl = get_export_acl(storage, owner, key)
+    if acl is None:
+        return False
+    return "*" in acl or not acl.isdisjoint(get_client_attribute_ids())
+
+
+def get_bag_archiver(requested, archive_policy):
+    archiver = (requested or archive_policy["default_archiver"]).lower()
+    allowed = [a.lower() for a in archive_policy["allowed_archivers"]]
+    if archiver not in allowed or not is_archiver_available(archiver):
+        raise BadRequest("Unsupported bag archiver \"%s\". Supported values are: %s" %
+                         (archiver, ", ".join([a for a in allowed if is_archiver_available(a)])))
+    return archiver
+
+
+def publish_output_dir(storage, output_dir, owner=None):
+    try:
+        with traced("export.publish", {"deriva.export.key": os.path.basename(output_dir)}):
+            storage.publish(owner if owner is not None else get_staging_subdir(), os.path.basename(output_dir),
+                            output_dir)
+    except Exception as e:
+        sys_logger.error("Unable to publish export [%s]: %s" % (output_dir, format_exception(e)))
+        raise BadGateway("Unable to publish export: %s" % format_exception(e))
+
+
+def discard_output_dir(output_dir):
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def notify_job(key, status, service_url=None, files=None, detail=None, callback_url=None, webhooks=None):
+    data = {"key": key, "status": status, "url": service_url}
+    if files is not None:
+        data["files"] = files
+    if detail:
+        data["detail"] = detail
+    try:
+        emit_event(key, status, data)
+        if callback_url:
+            queue_webhook(key, callback_url, data,
+                          max_attempts=webhooks.get("max_attempts", 5),
+                          backoff_secs=webhooks.get("backoff_secs", 2))
+    except Exception as e:
+        sys_logger.warning("Unable to send notifications for export [%s]: %s" % (key, format_exception(e)))
+
+
+@contextmanager
+def tracked_job(output_dir, storage, service_url=None, webhooks=None, owner=None):
+    key = os.path.basename(output_dir)
+    job = {"key": key, "callback_url": None}
+    try:
+        yield job
+    except BaseException as e:
+        if is_job_cancelled(key):
+            discard_output_dir(output_dir)
+            notify_job(key, EVENT_CANCELLED, service_url, callback_url=job["callback_url"], webhooks=webhooks)
+            raise
+        detail = format_exception(e)
+        finish_job(key, JOB_FAILED, detail=detail)
+        # publish anyway, so that the export log is available to the client for diagnostics
+        try:
+            publish_output_dir(storage, output_dir, owner)
+        except BadGateway:
+            pass
+        renew_export_expiry(key)
+        notify_job(key, EVENT_FAILED, service_url, detail=detail, callback_url=job["callback_url"], webhooks=webhooks)
+        raise
+    else:
+        if is_job_cancelled(key):
+            # an export which ran in-process could not be stopped, so its result is discarded instead
+            discard_output_dir(output_dir)
+            notify_job(key, EVENT_CANCELLED, service_url, callback_url=job["callback_url"], webhooks=webhooks)
+            raise Conflict("The export was cancelled.")
+        files = list_output_files(output_dir)
+        finish_job(key, JOB_COMPLETE, files=files)
+        publish_output_dir(storage, output_dir, owner)
+        renew_export_expiry(key)
+        notify_job(key, EVENT_COMPLETE, service_url, files=files, callback_url=job["callback_url"],
+                   webhooks=webhooks)
+
+
+def get_callback_url(config, webhooks):
+    callback_url = config.pop("callback_url", None) if isinstance(config, dict) else None
+    if not callback_url:
+        return None
+    if not stob(webhooks.get("enabled", False)):
+        raise BadRequest("Export completion callbacks are not enabled on this server.")
+    if not is_webhook_allowed(callback_url, webhooks.get("allowed_url_patterns")):
+        raise BadRequest("The callback_url \"%s\" is not permitted by this server." % callback_url)
+    return callback_url
+
+
+def parse_server(catalog_config):
+    server = dict()
+    host = catalog_config["host"]
+    if host.startswith("http"):
+        url = urlparse(host)
+        server["protocol"] = url.scheme
+        server["host"] = url.netloc
+    else:
+        server["protocol"] = "https"
+        server["host"] = host
+    server["catalog_id"] = catalog_config.get('catalog_id', "1")
+    return server
+
+
+def prepare_bag_config(config, files_only, archive_policy):
+    """Validate the bag parameters of an export config. Returns the bag archiver and the deferred post processors."""
+    archiver = None
+    post_processors = list()
+    if "bag" in config:
+        if files_only:
+            del config["bag"]
+        else:
+            archiver = get_bag_archiver(config["bag"].get("bag_archiver"), archive_policy)
+            # the service serializes the bag itself (see archive_outputs), which means that any
+            # post processors must be deferred until after the archive has been created
+            config["bag"]["bag_archiver"] = None
+            post_processors = config.pop("post_processors", None) or list()
+    return archiver, post_processors
 
 
 def get_bearer_token(header):
@@ -138,8 +461,76 @@ def get_bearer_token(header):
     return token if bearer == 'Bearer' else None
 
 
+class ExportClient(object):
+    """The client on whose behalf an export is run: its identity, wallet, staging subdirectory, address and request
+    credentials. These are normally read from the context of the current request. A batch of exports captures them
+    once, in the request thread, and runs its exports on behalf of the client in other threads, where the trace of the
+    request (if any) is resumed from trace_context."""
+
+    def __init__(self, identity=None, wallet=None, owner=None, ip=None, webauthn_token=None, bearer_token=None,
+                 trace_context=None):
+        self.identity = identity
+        self.wallet = wallet
+        self.owner = owner
+        self.ip = ip
+        self.webauthn_token = webauthn_token
+        self.bearer_token = bearer_token
+        self.trace_context = trace_context
+        self.credentials = dict()
+
+    @classmethod
+    def from_request(cls):
+        identity = get_client_identity()
+        wallet = None
+        if identity:
+            try:
+                wallet = get_client_wallet()
+            except (KeyError, AttributeError) as e:
+                raise BadRequest(format_exception(e))
+        return cls(identity=identity,
+                   wallet=wallet,
+                   owner=get_staging_subdir(),
+                   ip=get_client_ip(),
+                   webauthn_token=flask.request.cookies.get("webauthn"),
+                   bearer_token=get_bearer_token(flask.request.environ.get('HTTP_AUTHORIZATION')),
+                   trace_context=trace_context())
+
+    def get_credentials(self, server, catalog_config, require_authentication=True):
+        """Returns the credentials for the catalog server of an export, validating the webauthn token of the export
+        config, if any. Credentials are reused by all the exports of the client with the same server and config
+        credential params."""
+        token = catalog_config.get("token", None)
+        oauth2_token = catalog_config.get("oauth2_token", None)
+        username = catalog_config.get("username", "anonymous")
+        password = catalog_config.get("password", None)
+        cache_key = (server["protocol"], server["host"], token, oauth2_token, username, password)
+        if cache_key in self.credentials:
+            return self.credentials[cache_key]
+
+        credentials = None
+        try:
+            if token:
+                auth_url = ''.join([server["protocol"], "://", server["host"], "/authn/session"])
+                with get_new_requests_session() as session, \
+                        traced("authn.session", {"url.full": auth_url}, kind=SPAN_KIND_CLIENT):
+                    session.cookies.set("webauthn", token, domain=server["host"], path='/')
+                    response = session.get(auth_url)
+                    response.raise_for_status()
+            if server["protocol"] == "https":
+                credentials = format_credential(token=token if token else self.webauthn_token,
+                                                oauth2_token=oauth2_token if oauth2_token else self.bearer_token,
+                                                username=username,
+                                                password=password)
+        except (ValueError, HTTPError) as e:
+            if require_authentication:
+                raise Unauthorized(format_exception(e))
+        self.credentials[cache_key] = credentials
+        return credentials
+
+
 def get_lockfile_path():
     directory = get_staging_path()
+    os.makedirs(directory, exist_ok=True)
     lockfile = os.path.abspath(os.path.join(directory, ".lock"))
     if not os.path.isfile(lockfile):
         with open(lockfile, 'w') as lock:
@@ -147,6 +538,18 @@ def get_lockfile_path():
     return lockfile
 
 
+@contextmanager
+def user_export_lock(exclusive=True):
+    """Holds the export lock of the requesting user, which is exclusive unless concurrent exports are allowed."""
+    try:
+        with lock_file(get_lockfile_path(), mode='w', exclusive=exclusive, timeout=5):
+            yield
+    except AlreadyLocked as al:
+        raise Forbidden("Multiple concurrent exports per user are not supported. %s" % format_exception(al))
+    except LockException as le:
+        raise BadGateway("Unable to acquire the required resource lock: %s" % format_exception(le))
+
+
 def export(config=None,
            base_dir=None,
            service_url=None,
@@ -159,99 +562,120 @@ def export(config=None,
            allow_concurrent_export=False,
            max_payload_size_mb=None,
            timeout=None,
+           enable_blob_cache=False,
+           blob_cache_max_size_mb=0,
+           archive_policy=None,
+           storage=None,
+           webhooks=None,
+           additional_acl=None,
+           isolation=None,
+           template=None,
+           envars=None,
+           client=None,
+           user_lock=True,
            dcctx_cid="export/unknown",
            request_ip="ip-unknown"):
-    try:
-        with lock_file(get_lockfile_path(), mode='w', exclusive=not allow_concurrent_export, timeout=5) as lf:
+    # the transfer machinery is only loaded by processes which actually run exports
+    from deriva.transfer import GenericDownloader
+    from deriva.transfer.download import DerivaDownloadAuthenticationError, DerivaDownloadAuthorizationError, \
+        DerivaDownloadConfigurationError
+    from .runner import run_export, run_profiled_export
+
+    webhooks = webhooks or {}
+    isolation = isolation if isolation is not None else DEFAULT_ISOLATION_CONFIG
+    with TRACER.resumed(client.trace_context if client else None, "export",
+                        {"deriva.export.key": os.path.basename(base_dir), "deriva.dcctx_cid": dcctx_cid}), \
+            tracked_job(base_dir, storage or get_export_storage(), service_url, webhooks,
+                        owner=client.owner if client else None) as job:
+        if is_job_cancelled(job["key"]):
+            # an export which is queued, e.g. in a batch, may be cancelled before it starts
+            raise Conflict("The export was cancelled.")
+        job["callback_url"] = get_callback_url(config, webhooks)
+        archive_policy = get_archive_policy(archive_policy)
+        progress = ProgressReporter(job["key"])
+        with user_export_lock(exclusive=not allow_concurrent_export) if user_lock else nullcontext():
             log_handler = configure_logging(logging.WARN if quiet else logging.INFO,
                                             log_path=os.path.abspath(os.path.join(base_dir, '.log')),
                                             propagate=propagate_logs)
             try:
                 if not config:
                     raise BadRequest("No configuration specified.")
-                server = dict()
                 try:
                     # parse host/catalog params
                     catalog_config = config["catalog"]
-                    host = catalog_config["host"]
-                    if host.startswith("http"):
-                        url = urlparse(host)
-                        server["protocol"] = url.scheme
-                        server["host"] = url.netloc
-                    else:
-                        server["protocol"] = "https"
-                        server["host"] = host
-                    server["catalog_id"] = catalog_config.get('catalog_id', "1")
+                    server = parse_server(catalog_config) if not template else dict(template.server)
 
-                    # parse credential params, if found in the request payload (unlikely)
-                    token = catalog_config.get("token", None)
-                    oauth2_token = catalog_config.get("oauth2_token", None)
+                    # the username of the credential params, if found in the request payload (unlikely)
                     username = catalog_config.get("username", "anonymous")
-                    password = catalog_config.get("password", None)
 
-                    # sanity-check some bag params
-                    if "bag" in config:
-                        if files_only:
-                            del config["bag"]
-                        else:
-                            if not config["bag"].get("bag_archiver"):
-                                config["bag"]["bag_archiver"] = "zip"
+                    # sanity-check some bag params, unless the config is from a template that was checked on load
+                    if template:
+                        archiver, post_processors = template.archiver, copy.deepcopy(template.post_processors)
+                    else:
+                        archiver, post_processors = prepare_bag_config(config, files_only, archive_policy)
 
                 except (KeyError, AttributeError) as e:
                     raise BadRequest('Error parsing configuration: %s' % format_exception(e))
 
-                credentials = None
-                session = get_new_requests_session()
-                try:
-                    if token:
-                        auth_url = ''.join([server["protocol"], "://", server["host"], "/authn/session"])
-                        session.cookies.set("webauthn", token, domain=server["host"], path='/')
-                        response = session.get(auth_url)
-                        response.raise_for_status()
-                    if not oauth2_token:
-                        oauth2_token = get_bearer_token(flask.request.environ.get('HTTP_AUTHORIZATION'))
-                    if server["protocol"] == "https":
-                        credentials = format_credential(token=token if token else flask.request.cookies.get("webauthn"),
-                                                        oauth2_token=oauth2_token,
-                                                        username=username,
-                                                        password=password)
-                except (ValueError, HTTPError) as e:
-                    if require_authentication:
-                        raise Unauthorized(format_exception(e))
-                finally:
-                    if session:
-                        session.close()
-                        del session
-
-                wallet = None
-                identity = get_client_identity()
-                if identity:
-                    try:
-                        wallet = get_client_wallet()
-                    except (KeyError, AttributeError) as e:
-                        raise BadRequest(format_exception(e))
-                    if require_authentication and not (identity and wallet):
-                        raise Unauthorized()
+                client = client or ExportClient.from_request()
+                with traced("export.authenticate"):
+                    credentials = client.get_credentials(server, catalog_config, require_authentication)
+                identity, wallet = client.identity, client.wallet
+                if identity and require_authentication and not wallet:
+                    raise Unauthorized()
 
                 user_id = username if not identity else identity.get('display_name', identity.get('id'))
                 create_access_descriptor(base_dir,
                                          identity=None if not identity else identity.get('id'),
-                                         public=public or not require_authentication)
+                                         public=public or not require_authentication,
+                                         additional_acl=additional_acl)
                 try:
-                    sys_logger.info("Creating export at [%s] on behalf of %s at %s" % (base_dir, user_id, request_ip))
-                    envars = {"request_ip": request_ip}
+                    sys_logger.info("Creating export at [%s] on behalf of %s at %s" %
+                                    (base_dir, user_id, request_ip))
+                    envars = dict(envars or {})
+                    envars["request_ip"] = request_ip
                     if service_url:
                         envars.update({GenericDownloader.SERVICE_URL_KEY: service_url})
-                    downloader = GenericDownloader(server=server,
-                                                   output_dir=base_dir,
-                                                   envars=envars,
-                                                   config=config,
-                                                   credentials=credentials,
-                                                   allow_anonymous=allow_anonymous_download,
-                                                   max_payload_size_mb=max_payload_size_mb,
-                                                   timeout=timeout,
-                                                   dcctx_cid=dcctx_cid)
-                    return downloader.download(identity=identity, wallet=wallet)
+                    export_args = dict(server=server,
+                                       base_dir=base_dir,
+                                       envars=envars,
+                                       config=config,
+                                       credentials=credentials,
+                                       identity=identity,
+                                       wallet=wallet,
+                                       archiver=archiver,
+                                       archive_policy=archive_policy,
+                                       post_processors=post_processors,
+                                       allow_anonymous_download=allow_anonymous_download,
+                                       max_payload_size_mb=max_payload_size_mb,
+                                       timeout=timeout,
+                                       enable_blob_cache=enable_blob_cache,
+                                       blob_cache_max_size_mb=blob_cache_max_size_mb,
+                                       progress=progress,
+                                       dcctx_cid=dcctx_cid)
+                    with traced("export.run") as run_span:
+                        if stob(isolation.get("enabled", True)) and is_isolation_available():
+                            target = run_export
+                            profile = getattr(deriva_ctx, "derivaweb_profile", None)
+                            if profile is not None:
+                                # the export is profiled in the child process, while this request only waits for it
+                                target = run_profiled_export
+                                export_args["profile_path"] = PROFILER.get_profile_path(
+                                    deriva_ctx.derivaweb_profile_id, EXPORT_PROFILE_SUFFIX)
+                            # the child process traces the export as part of the trace of this request
+                            run_span.set_attribute("deriva.export.isolated", True)
+                            export_args["trace_context"] = trace_context()
+                            with paused(profile):
+                                return run_isolated(target,
+                                                    kwargs=export_args,
+                                                    limits=isolation,
+                                                    timeout=timeout,
+                                                    is_cancelled=lambda: is_job_cancelled(job["key"]),
+                                                    log_path=log_handler.baseFilename if log_handler else None,
+                                                    log_level=logger.level)
+                        return run_export(**export_args)
+                except ExportCancelledError as e:
+                    raise Conflict(format_exception(e))
                 except DerivaDownloadAuthenticationError as e:
                     raise Unauthorized(format_exception(e))
                 except DerivaDownloadAuthorizationError as e:
@@ -264,8 +688,39 @@ def export(config=None,
             finally:
                 if log_handler:
                     logger.removeHandler(log_handler)
+                    log_handler.close()
 
-    except AlreadyLocked as al:
-        raise Forbidden("Multiple concurrent exports per user are not supported. %s" % format_exception(al))
-    except LockException as le:
-        raise BadGateway("Unable to acquire the required resource lock: %s" % format_exception(le))
+
+def _run_submitted_export(key, run, resources):
+    with resources:
+        try:
+            run()
+        except Exception as e:
+            # the outcome is recorded by the export itself, and reported to the client by its events
+            sys_logger.info("Submitted export [%s] did not complete: %s" % (key, format_exception(e)))
+
+
+def submit_export(run, allow_concurrent_export=False):
+    """Runs an export in the background, for a request which does not wait for it to finish. The client's export lock
+    is acquired by the request, so that a conflicting export is refused at once, and is released when the export has
+    finished.
+
+    :param run: a functools.partial of export() for the export, without its client and user_lock arguments
+    :return: the thread running the export
+    """
+    key = os.path.basename(run.keywords["base_dir"])
+    with ExitStack() as resources:
+        try:
+            client = ExportClient.from_request()
+            resources.enter_context(user_export_lock(exclusive=not allow_concurrent_export))
+        except BaseException as e:
+            finish_job(key, JOB_FAILED, detail=format_exception(e))
+            discard_output_dir(run.keywords["base_dir"])
+            raise
+        run = functools.partial(run, client=client, user_lock=False)
+        thread = threading.Thread(target=_run_submitted_export,
+                                  args=(key, run, resources.pop_all()),
+                                  name="export-%s" % key[:8],
+                                  daemon=True)
+        thread.start()
+        return thread
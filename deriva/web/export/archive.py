@@ -0,0 +1,187 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Policy driven serialization of export bags.
+
+This replaces the fixed-level archiving performed by `bdbag_api.archive_bag` so that the service can skip compression
+of payload files which are already compressed, raise the compression level for text, and offer zstd.
+"""
+import os
+import gzip
+import time
+import fnmatch
+import logging
+import mimetypes
+import shutil
+import tarfile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = {
+    "zip": ".zip",
+    "tar": ".tar",
+    "tgz": ".tgz",
+    "bz2": ".bz2",
+    "tzst": ".tar.zst"
+}
+
+DEFAULT_ARCHIVE_POLICY = {
+    "default_archiver": "zip",
+    "allowed_archivers": ["zip", "tgz", "tar", "bz2"],
+    "compression_level": 6,
+    "text_compression_level": 9,
+    "store_only_mime_types": [
+        "image/jpeg", "image/png", "image/gif", "image/webp", "image/jp2",
+        "video/*", "audio/*",
+        "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2", "application/x-xz",
+        "application/zstd", "application/x-7z-compressed", "application/x-rar-compressed"
+    ],
+    "text_mime_types": ["text/*", "application/json", "application/x-json-stream", "application/xml"],
+    "zstd_level": 3,
+    "zstd_threads": -1
+}
+
+
+def get_archive_policy(config=None):
+    policy = DEFAULT_ARCHIVE_POLICY.copy()
+    policy.update(config or {})
+    return policy
+
+
+def is_archiver_available(archiver):
+    return archiver in ARCHIVE_EXTENSIONS and (archiver != "tzst" or zstandard is not None)
+
+
+def _matches(content_type, patterns):
+    return content_type is not None and any(fnmatch.fnmatch(content_type, p) for p in patterns)
+
+
+def get_member_compression(file_path, policy):
+    """Returns the (compress_type, level) pair that the policy assigns to a zip member."""
+    content_type, encoding = mimetypes.guess_type(file_path, strict=False)
+    if encoding or _matches(content_type, policy["store_only_mime_types"]):
+        return ZIP_STORED, None
+    if _matches(content_type, policy["text_mime_types"]):
+        return ZIP_DEFLATED, policy["text_compression_level"]
+    return ZIP_DEFLATED, policy["compression_level"]
+
+
+def _archive_entries(bag_path):
+    entries = []
+    for root, dirs, files in os.walk(bag_path):
+        for d in dirs:
+            entries.append(os.path.relpath(os.path.join(root, d), os.path.dirname(bag_path)) + os.path.sep)
+        for f in files:
+            entries.append(os.path.relpath(os.path.join(root, f), os.path.dirname(bag_path)))
+    entries.sort()
+    return entries
+
+
+def zip_bag_dir(bag_path, zip_file_path, policy, stats, idempotent=False):
+    # same member layout as bdbag_api.zip_bag_dir, but with per-member compression chosen by the archive policy
+    with ZipFile(zip_file_path, 'w', ZIP_DEFLATED, allowZip64=True) as zf:
+        for e in _archive_entries(bag_path):
+            filepath = os.path.join(os.path.dirname(bag_path), e)
+            if e.endswith(os.path.sep):
+                if idempotent:
+                    date_time = (1980, 1, 1, 0, 0, 0)
+                else:
+                    date_time = time.localtime(os.stat(filepath).st_mtime)[0:6]
+                info = ZipInfo(filename=e, date_time=date_time)
+                info.create_system = 3  # unix
+                info.external_attr = 0o40755 << 16 | 0x010
+                info.compress_type = ZIP_STORED
+                info.CRC = 0
+                zf.writestr(info, b'')
+                continue
+            compress_type, level = get_member_compression(filepath, policy)
+            stats["archive_members_stored" if compress_type == ZIP_STORED else "archive_members_deflated"] += 1
+            if idempotent:
+                # a member opened by name has the fixed date of 1980-01-01, and the compression of the archive
+                zf.compression, zf.compresslevel = compress_type, level
+                with open(filepath, 'rb') as data, zf.open(e, 'w') as out:
+                    shutil.copyfileobj(data, out)
+            else:
+                zf.write(filepath, e, compress_type=compress_type, compresslevel=level)
+            # the mode is only recorded in the central directory, which is written when the archive is closed
+            zf.getinfo(e).external_attr = 0o100644 << 16
+    return zip_file_path
+
+
+def tar_bag_dir(bag_path, tar_file_path, archiver, policy, idempotent=False):
+
+    def filter_mtime(tarinfo):
+        tarinfo.mtime = 0
+        return tarinfo
+
+    arcname = os.path.relpath(bag_path, os.path.dirname(bag_path))
+    with open(tar_file_path, 'wb') as f:
+        if archiver == "tgz":
+            # compress in the same pass as the tar stream, including the idempotent (mtime=0) case
+            stream = gzip.GzipFile(filename="", mode='wb', fileobj=f, mtime=0 if idempotent else None,
+                                   compresslevel=policy["compression_level"])
+        elif archiver == "tzst":
+            cctx = zstandard.ZstdCompressor(level=policy["zstd_level"], threads=policy["zstd_threads"])
+            stream = cctx.stream_writer(f, closefd=False)
+        else:
+            stream = None
+        mode = "w|bz2" if archiver == "bz2" else "w|"
+        with tarfile.open(fileobj=stream or f, mode=mode) as t:
+            t.add(bag_path, arcname, recursive=True, filter=filter_mtime if idempotent else None)
+        if stream:
+            stream.close()
+    return tar_file_path
+
+
+def archive_bag(bag_path, archiver, policy, idempotent=False):
+    """Serialize a bag directory according to the archive policy.
+
+    :return: a tuple of the archive file path and a dictionary of archiving statistics
+    """
+    archiver = archiver.lower()
+    if not is_archiver_available(archiver):
+        raise RuntimeError("Archive format not supported for bag file: %s" % archiver)
+    bag_path = bag_path.rstrip(os.path.sep)
+    from bdbag import bdbag_api as bdb
+    bdb.validate_bag_structure(bag_path, skip_remote=True)
+
+    logger.info("Archiving bag (%s): %s" % (archiver, bag_path))
+    archive_path = os.path.join(os.path.dirname(bag_path), os.path.basename(bag_path) + ARCHIVE_EXTENSIONS[archiver])
+    stats = {"archive_members_stored": 0, "archive_members_deflated": 0}
+    payload_bytes = sum(os.path.getsize(os.path.join(root, f))
+                        for root, dirs, files in os.walk(bag_path) for f in files)
+    start_cpu = time.process_time()
+    start = time.monotonic()
+    if archiver == "zip":
+        zip_bag_dir(bag_path, archive_path, policy, stats, idempotent)
+    else:
+        tar_bag_dir(bag_path, archive_path, archiver, policy, idempotent)
+    stats.update({
+        "archiver": archiver,
+        "archive_cpu_secs": round(time.process_time() - start_cpu, 3),
+        "archive_wall_secs": round(time.monotonic() - start, 3),
+        "archive_input_bytes": payload_bytes,
+        "archive_output_bytes": os.path.getsize(archive_path)
+    })
+    logger.info("Created bag archive: %s (%d bytes from %d input bytes in %.3f CPU seconds)" % (
+        archive_path, stats["archive_output_bytes"], payload_bytes, stats["archive_cpu_secs"]))
+
+    return archive_path, stats
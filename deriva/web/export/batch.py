@@ -0,0 +1,192 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Batches of exports submitted in a single request.
+
+A batch is a list of exports of one type, given either as a list of export requests or as one export template with a
+list of parameter sets. The client is authenticated, its export lock is acquired and the output directories of all the
+items are created once, by the request which submits the batch. The items are then run in the background by a bounded
+pool of threads, and the batch manifest, which is kept in the shared state database, lists the status and URL of each.
+"""
+import time
+import uuid
+import logging
+import threading
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from deriva.core import format_exception
+from ..state import get_shared_state
+from .jobs import get_job, cancel_job, is_job_alive, is_job_cancelled, JOB_RUNNING, JOB_COMPLETE, JOB_FAILED, \
+    JOB_CANCELLED
+
+logger = logging.getLogger(__name__)
+
+BATCH_QUEUED = "queued"
+BATCH_RETENTION_SECS = 7 * 86400
+
+DEFAULT_BATCH_CONFIG = {
+    "enabled": True,
+    "max_items": 500,
+    "max_parallel": 4
+}
+
+EXPORT_BATCHES_DDL = """
+CREATE TABLE IF NOT EXISTS export_batches (
+  key TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  type TEXT NOT NULL,
+  created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS export_batches_created ON export_batches (created);
+CREATE TABLE IF NOT EXISTS export_batch_items (
+  batch TEXT NOT NULL,
+  position INTEGER NOT NULL,
+  key TEXT NOT NULL,
+  url TEXT NOT NULL,
+  status TEXT NOT NULL,
+  detail TEXT,
+  PRIMARY KEY (batch, position)
+);
+"""
+
+_registered = False
+
+
+def _state():
+    global _registered
+    state = get_shared_state()
+    if not _registered:
+        state.register_schema(EXPORT_BATCHES_DDL)
+        _registered = True
+    return state
+
+
+def get_batch_config(config):
+    return dict(DEFAULT_BATCH_CONFIG, **(config or {}))
+
+
+def create_batch(owner, export_type, items):
+    """Records a new batch, and removes the batches which have outlived their retention period.
+
+    :param items: a list of (key, url, status) tuples, where the status of an item which is still to be run is "queued"
+    :return: the key of the batch
+    """
+    key = str(uuid.uuid4())
+    now = time.time()
+    with _state().transaction() as conn:
+        conn.execute("DELETE FROM export_batch_items WHERE batch IN (SELECT key FROM export_batches WHERE created < ?)",
+                     (now - BATCH_RETENTION_SECS,))
+        conn.execute("DELETE FROM export_batches WHERE created < ?", (now - BATCH_RETENTION_SECS,))
+        conn.execute("INSERT INTO export_batches (key, owner, type, created) VALUES (?, ?, ?, ?)",
+                     (key, owner, export_type, now))
+        conn.executemany("INSERT INTO export_batch_items (batch, position, key, url, status) VALUES (?, ?, ?, ?, ?)",
+                         [(key, position, item_key, url, status) for position, (item_key, url, status) in
+                          enumerate(items)])
+    return key
+
+
+def set_item_status(batch_key, position, status, detail=None):
+    _state().execute("UPDATE export_batch_items SET status = ?, detail = ? WHERE batch = ? AND position = ?",
+                     (status, detail, batch_key, position))
+
+
+def _current_status(item):
+    """The status of an unfinished item is checked against its job, in case the process running it has died."""
+    if item["status"] not in (BATCH_QUEUED, JOB_RUNNING):
+        return item["status"], item["detail"]
+    job = get_job(item["key"])
+    if job is not None and is_job_alive(job):
+        return item["status"], item["detail"]
+    if job is not None and job["status"] != JOB_RUNNING:
+        return job["status"], job["detail"]
+    return JOB_FAILED, "The export was interrupted."
+
+
+def get_batch(key):
+    """Returns the manifest of a batch, with the current status of each of its items, or None if it does not exist."""
+    batch = _state().query_one("SELECT * FROM export_batches WHERE key = ?", (key,))
+    if batch is None:
+        return None
+    items = list()
+    for row in _state().query("SELECT * FROM export_batch_items WHERE batch = ? ORDER BY position", (key,)):
+        status, detail = _current_status(dict(row))
+        item = {"index": row["position"], "key": row["key"], "url": row["url"], "status": status}
+        if detail:
+            item["detail"] = detail
+        items.append(item)
+    counts = dict()
+    for item in items:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    if counts.get(BATCH_QUEUED) or counts.get(JOB_RUNNING):
+        status = JOB_RUNNING
+    else:
+        status = JOB_COMPLETE if counts.get(JOB_COMPLETE, 0) == len(items) else JOB_FAILED
+    return {"key": batch["key"],
+            "owner": batch["owner"],
+            "type": batch["type"],
+            "created": batch["created"],
+            "status": status,
+            "counts": counts,
+            "items": items}
+
+
+def cancel_batch(key):
+    """Requests cancellation of the unfinished items of a batch. Returns the number of items which were cancelled."""
+    cancelled = 0
+    for row in _state().query("SELECT key FROM export_batch_items WHERE batch = ? AND status IN (?, ?)",
+                              (key, BATCH_QUEUED, JOB_RUNNING)):
+        if cancel_job(row["key"]):
+            cancelled += 1
+    return cancelled
+
+
+def _run_item(batch_key, position, key, run):
+    # an item which was cancelled while it was queued is stopped (and cleaned up) as soon as its export starts
+    set_item_status(batch_key, position, JOB_RUNNING)
+    try:
+        run()
+    except BaseException as e:
+        if is_job_cancelled(key):
+            set_item_status(batch_key, position, JOB_CANCELLED)
+        else:
+            set_item_status(batch_key, position, JOB_FAILED, format_exception(e))
+    else:
+        set_item_status(batch_key, position, JOB_COMPLETE)
+
+
+def _run_batch(batch_key, tasks, max_parallel, resources):
+    with resources:
+        try:
+            with ThreadPoolExecutor(max_workers=max_parallel,
+                                    thread_name_prefix="export-batch-%s" % batch_key[:8]) as executor:
+                for position, key, run in tasks:
+                    executor.submit(_run_item, batch_key, position, key, run)
+        except Exception as e:
+            logger.warning("Export batch [%s] error: %s" % (batch_key, format_exception(e)))
+
+
+def start_batch(batch_key, tasks, max_parallel=DEFAULT_BATCH_CONFIG["max_parallel"], resources=None):
+    """Runs the items of a batch in the background, at most max_parallel at a time.
+
+    :param tasks: a list of (position, key, callable) tuples, where each callable runs the export of one item
+    :param resources: a context manager (e.g. an ExitStack holding the client's export lock) which is exited once all
+        the items have finished
+    """
+    thread = threading.Thread(target=_run_batch,
+                              args=(batch_key, tasks, max(1, int(max_parallel)), resources or ExitStack()),
+                              name="export-batch-%s" % batch_key[:8],
+                              daemon=True)
+    thread.start()
+    return thread
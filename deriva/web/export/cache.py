@@ -0,0 +1,155 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Content-addressed blob store for export payload files.
+
+Blobs are keyed by the hex MD5 digest of their content and are shared between exports via hard links, so a blob whose
+link count has dropped back to one is no longer referenced by any export directory and may be evicted. The size of
+each blob and the time it was last used are kept in an index in the shared state database, which is updated when a
+blob is added or linked into an export, so that eviction neither walks the store nor depends on file access times.
+"""
+import os
+import re
+import time
+import errno
+import shutil
+import logging
+import uuid
+from deriva.core import format_exception
+from ..state import get_shared_state
+
+logger = logging.getLogger(__name__)
+
+MD5_HEX_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+EXPORT_BLOBS_DDL = """
+CREATE TABLE IF NOT EXISTS export_blobs (
+  store TEXT NOT NULL,
+  md5 TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  used REAL NOT NULL,
+  PRIMARY KEY (store, md5)
+);
+CREATE INDEX IF NOT EXISTS export_blobs_used ON export_blobs (store, used);
+"""
+
+_registered = False
+
+
+def _state():
+    global _registered
+    state = get_shared_state()
+    if not _registered:
+        state.register_schema(EXPORT_BLOBS_DDL)
+        _registered = True
+    return state
+
+
+def link_file(source, file_path):
+    """Hard link source at file_path, replacing any existing file, or copy it if a link is not possible. Returns False
+    if source does not exist."""
+    if os.path.lexists(file_path):
+        if os.path.exists(source) and os.path.samefile(source, file_path):
+            return True
+        os.remove(file_path)
+    try:
+        os.link(source, file_path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        # cross-device or link limit reached: degrade to a plain copy
+        shutil.copyfile(source, file_path)
+    return True
+
+
+class BlobStore(object):
+
+    def __init__(self, base_dir, max_size_mb=0):
+        self.base_dir = os.path.abspath(base_dir)
+        self.max_bytes = int(max_size_mb or 0) * 1024 * 1024
+
+    def blob_path(self, md5):
+        md5 = md5.lower()
+        if not MD5_HEX_PATTERN.match(md5):
+            raise ValueError("Invalid MD5 hex digest: %s" % md5)
+        return os.path.join(self.base_dir, "md5", md5[:2], md5)
+
+    def contains(self, md5, size=None):
+        try:
+            st = os.stat(self.blob_path(md5))
+        except (OSError, ValueError):
+            return False
+        return size is None or st.st_size == int(size)
+
+    def record_use(self, md5, size):
+        _state().execute("INSERT OR REPLACE INTO export_blobs (store, md5, size, used) VALUES (?, ?, ?, ?)",
+                         (self.base_dir, md5.lower(), size, time.time()))
+
+    def link_to(self, md5, file_path):
+        """Materialize the blob identified by md5 at file_path. Returns True on success."""
+        if not link_file(self.blob_path(md5), file_path):
+            return False
+        self.record_use(md5, os.path.getsize(file_path))
+        return True
+
+    def add(self, md5, file_path):
+        """Adopt file_path into the store under md5 (the caller is responsible for having verified the digest)."""
+        blob = self.blob_path(md5)
+        if os.path.isfile(blob):
+            self.record_use(md5, os.path.getsize(blob))
+            return
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp = "%s.%s.tmp" % (blob, uuid.uuid4().hex)
+        try:
+            os.link(file_path, tmp)
+        except OSError:
+            shutil.copyfile(file_path, tmp)
+        try:
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, blob)
+        except OSError as e:
+            logger.warning("Unable to add blob %s to cache: %s" % (md5, format_exception(e)))
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            return
+        self.record_use(md5, os.path.getsize(blob))
+
+    def prune(self):
+        """Evict unreferenced blobs, least recently used first, until the indexed blobs are within the size budget."""
+        if self.max_bytes < 1:
+            return 0
+        row = _state().query_one("SELECT SUM(size) AS total FROM export_blobs WHERE store = ?", (self.base_dir,))
+        total = row["total"] or 0
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        rows = _state().query("SELECT md5, size FROM export_blobs WHERE store = ? ORDER BY used", (self.base_dir,))
+        for row in rows:
+            if total <= self.max_bytes:
+                break
+            path = self.blob_path(row["md5"])
+            try:
+                if os.stat(path).st_nlink > 1:
+                    continue
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(format_exception(e))
+                continue
+            _state().execute("DELETE FROM export_blobs WHERE store = ? AND md5 = ?", (self.base_dir, row["md5"]))
+            total -= row["size"]
+        return removed
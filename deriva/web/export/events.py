@@ -0,0 +1,309 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Export progress and completion events, delivered by server-sent events and webhooks.
+
+Events are appended to the shared state database by whichever process runs an export. Each service process runs at
+most one poller thread, which reads new events on behalf of all of the SSE subscribers in that process and wakes them
+up, so that subscribers do not each poll the database. Each subscriber still holds a request thread of its process for
+as long as its stream lasts, so streams are limited in number and duration (see streams.py), and a client reconnects
+to resume its stream. Webhook deliveries are queued in the same database and are claimed and retried with exponential
+backoff by a delivery thread in any process. Webhooks are only ever POSTed to the URLs which the configured patterns
+allow, and redirects are not followed.
+"""
+import os
+import re
+import json
+import time
+import fnmatch
+import urllib.parse
+import logging
+import threading
+import requests
+from deriva.core import format_exception
+from ..state import get_shared_state
+
+logger = logging.getLogger(__name__)
+
+EVENT_PROGRESS = "progress"
+EVENT_COMPLETE = "complete"
+EVENT_FAILED = "failed"
+EVENT_CANCELLED = "cancelled"
+TERMINAL_EVENTS = frozenset([EVENT_COMPLETE, EVENT_FAILED, EVENT_CANCELLED])
+
+EXPORT_EVENTS_DDL = """
+CREATE TABLE IF NOT EXISTS export_events (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  key TEXT NOT NULL,
+  event TEXT NOT NULL,
+  data TEXT,
+  created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS export_events_key ON export_events (key, id);
+CREATE TABLE IF NOT EXISTS export_webhooks (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  key TEXT NOT NULL,
+  url TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  max_attempts INTEGER NOT NULL,
+  backoff_secs REAL NOT NULL,
+  next_attempt REAL NOT NULL,
+  delivered INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS export_webhooks_due ON export_webhooks (delivered, next_attempt);
+"""
+
+POLL_INTERVAL_SECS = 1.0
+WEBHOOK_TIMEOUT_SECS = 10
+
+WEBHOOK_DEFAULT_PORTS = {"http": 80, "https": 443}
+WEBHOOK_HOST_PATTERN = re.compile(r"^[a-z0-9.:-]+$")
+
+_registered = False
+
+
+def _state():
+    global _registered
+    state = get_shared_state()
+    if not _registered:
+        state.register_schema(EXPORT_EVENTS_DDL)
+        _registered = True
+    return state
+
+
+def emit_event(key, event, data=None):
+    _state().execute("INSERT INTO export_events (key, event, data, created) VALUES (?, ?, ?, ?)",
+                     (key, event, json.dumps(data or {}), time.time()))
+
+
+def get_events(key, after_id=0):
+    return [dict(row) for row in _state().query(
+        "SELECT id, event, data FROM export_events WHERE key = ? AND id > ? ORDER BY id", (key, after_id))]
+
+
+def delete_events(keys):
+    """Deletes the events of exports, and their webhook deliveries."""
+    if keys:
+        with _state().transaction() as conn:
+            conn.executemany("DELETE FROM export_events WHERE key = ?", [(key,) for key in keys])
+            conn.executemany("DELETE FROM export_webhooks WHERE key = ?", [(key,) for key in keys])
+
+
+class ProgressReporter(object):
+    """Rate-limited emitter of progress events for a single export."""
+
+    def __init__(self, key, min_interval_secs=1.0):
+        self.key = key
+        self.min_interval = min_interval_secs
+        self.last = 0
+
+    def __call__(self, message, **data):
+        now = time.monotonic()
+        if now - self.last < self.min_interval:
+            return
+        self.last = now
+        data["message"] = message
+        try:
+            emit_event(self.key, EVENT_PROGRESS, data)
+        except Exception as e:
+            logger.warning("Unable to record export progress event: %s" % format_exception(e))
+
+
+class EventNotifier(object):
+    """Per-process poller which fans new events out to the subscriber threads waiting on them."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.last_id = 0
+        self.subscribers = 0
+        self.thread = None
+
+    def _poll(self):
+        while True:
+            with self.condition:
+                if self.subscribers == 0:
+                    self.thread = None
+                    return
+            row = _state().query_one("SELECT MAX(id) AS id FROM export_events")
+            last_id = row["id"] or 0
+            with self.condition:
+                if last_id != self.last_id:
+                    self.last_id = last_id
+                    self.condition.notify_all()
+            time.sleep(POLL_INTERVAL_SECS)
+
+    def subscribe(self, key, after_id=0, max_duration_secs=60, keepalive_secs=15):
+        """Generate events for key, as they happen, until a terminal event is seen or max_duration_secs elapses."""
+        with self.condition:
+            self.subscribers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._poll, name="export-event-notifier", daemon=True)
+                self.thread.start()
+        try:
+            deadline = time.monotonic() + max_duration_secs
+            while time.monotonic() < deadline:
+                events = get_events(key, after_id)
+                for event in events:
+                    after_id = event["id"]
+                    yield event
+                    if event["event"] in TERMINAL_EVENTS:
+                        return
+                with self.condition:
+                    if not self.condition.wait(timeout=keepalive_secs):
+                        yield None
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+
+notifier = EventNotifier()
+
+
+def format_sse(event):
+    if event is None:
+        return ": keepalive\n\n"
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (event["id"], event["event"], event["data"])
+
+
+def _split_url(url):
+    """Returns the (scheme, host, port, path) of a URL, where the port is empty if it is the default of the scheme,
+    and the path includes any query. Raises ValueError if the URL is not an absolute http(s) URL without
+    credentials."""
+    parsed = urllib.parse.urlsplit(url)
+    scheme = parsed.scheme.lower()
+    if scheme not in WEBHOOK_DEFAULT_PORTS or parsed.username is not None or not parsed.hostname:
+        raise ValueError("Unsupported URL: %s" % url)
+    port = parsed.port
+    path = (parsed.path or "/") + ("?" + parsed.query if parsed.query else "")
+    return scheme, parsed.hostname, str(port) if port and port != WEBHOOK_DEFAULT_PORTS[scheme] else "", path
+
+
+def _split_pattern(pattern):
+    """Returns the (scheme, host, port, path) patterns of a URL pattern such as https://*.example.org/*, where the
+    port pattern may also be a wildcard."""
+    parsed = urllib.parse.urlsplit(pattern)
+    host, sep, port = parsed.netloc.lower().rpartition(":")
+    if not sep or not (port.isdigit() or port == "*") or host.endswith(":"):
+        host, port = parsed.netloc.lower(), ""
+    path = (parsed.path or "/*") + ("?" + parsed.query if parsed.query else "")
+    return parsed.scheme.lower(), host, port, path
+
+
+def is_webhook_allowed(url, patterns):
+    """Returns whether url matches one of the shell-style URL patterns. The scheme, host, port and path of the URL are
+    matched separately, so that a wildcard in the host of a pattern can only ever match a host name."""
+    try:
+        scheme, host, port, path = _split_url(url)
+    except ValueError:
+        return False
+    if not WEBHOOK_HOST_PATTERN.match(host):
+        return False
+    for pattern in patterns or []:
+        scheme_pattern, host_pattern, port_pattern, path_pattern = _split_pattern(pattern)
+        if scheme == scheme_pattern and fnmatch.fnmatchcase(host, host_pattern) and \
+                fnmatch.fnmatchcase(port, port_pattern) and fnmatch.fnmatchcase(path, path_pattern):
+            return True
+    return False
+
+
+def queue_webhook(key, url, payload, max_attempts=5, backoff_secs=2.0):
+    _state().execute("INSERT INTO export_webhooks (key, url, payload, max_attempts, backoff_secs, next_attempt) "
+                     "VALUES (?, ?, ?, ?, ?, ?)",
+                     (key, url, json.dumps(payload), max_attempts, backoff_secs, time.time()))
+    start_webhook_delivery()
+
+
+def _claim_webhook(claim_secs):
+    now = time.time()
+    with _state().transaction() as conn:
+        row = conn.execute("SELECT * FROM export_webhooks WHERE delivered = 0 AND next_attempt <= ? "
+                           "ORDER BY next_attempt LIMIT 1", (now,)).fetchone()
+        if row is None:
+            return None
+        # push the next attempt time out, so that no other process claims the delivery while we attempt it
+        conn.execute("UPDATE export_webhooks SET attempts = attempts + 1, next_attempt = ? WHERE id = ?",
+                     (now + claim_secs, row["id"]))
+        return dict(row)
+
+
+def deliver_webhooks():
+    """Attempt delivery of all due webhooks. Returns the number of deliveries attempted."""
+    attempted = 0
+    while True:
+        hook = _claim_webhook(WEBHOOK_TIMEOUT_SECS * 2)
+        if hook is None:
+            return attempted
+        attempted += 1
+        attempt = hook["attempts"] + 1
+        try:
+            # a redirect is not followed, since its target has not been allowed
+            r = requests.post(hook["url"], data=hook["payload"], timeout=WEBHOOK_TIMEOUT_SECS,
+                              headers={"Content-Type": "application/json"}, allow_redirects=False)
+            r.raise_for_status()
+            if r.is_redirect:
+                raise requests.HTTPError("Redirected to %s" % r.headers.get("Location"), response=r)
+            _state().execute("UPDATE export_webhooks SET delivered = 1 WHERE id = ?", (hook["id"],))
+        except Exception as e:
+            if attempt >= hook["max_attempts"]:
+                logger.warning("Giving up on webhook delivery to %s for export %s after %d attempts: %s" %
+                               (hook["url"], hook["key"], attempt, format_exception(e)))
+                _state().execute("UPDATE export_webhooks SET delivered = -1 WHERE id = ?", (hook["id"],))
+            else:
+                _state().execute("UPDATE export_webhooks SET next_attempt = ? WHERE id = ?",
+                                 (time.time() + hook["backoff_secs"] * (2 ** (attempt - 1)), hook["id"]))
+
+
+def has_pending_webhooks():
+    return _state().query_one("SELECT id FROM export_webhooks WHERE delivered = 0 LIMIT 1") is not None
+
+
+_delivery_thread = None
+_delivery_lock = threading.Lock()
+_resumed_pid = None
+
+
+def _delivery_loop():
+    global _delivery_thread
+    idle = 0
+    while idle < 600:
+        try:
+            attempted = deliver_webhooks()
+        except Exception as e:
+            logger.warning("Webhook delivery error: %s" % format_exception(e))
+            attempted = 0
+        idle = 0 if (attempted or has_pending_webhooks()) else idle + 1
+        time.sleep(1)
+    with _delivery_lock:
+        _delivery_thread = None
+
+
+def start_webhook_delivery():
+    global _delivery_thread
+    with _delivery_lock:
+        if _delivery_thread is None:
+            _delivery_thread = threading.Thread(target=_delivery_loop, name="export-webhook-delivery", daemon=True)
+            _delivery_thread.start()
+
+
+def resume_webhook_delivery():
+    """Starts the delivery thread of this process if any deliveries are pending, e.g. those left in backoff by a
+    process which has since exited. Later deliveries start the thread when they are queued."""
+    global _resumed_pid
+    if _resumed_pid == os.getpid():
+        return
+    _resumed_pid = os.getpid()
+    if has_pending_webhooks():
+        start_webhook_delivery()
@@ -0,0 +1,186 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Expiry of exports after their time to live.
+
+Every export with a time to live (TTL) is recorded in an index in the shared state database when it is created, and
+its expiry time is reset to one TTL after it finishes. A sweeper thread in each service process periodically claims
+the entries which have expired, in order of expiry, deletes their exports from storage, and only then removes them
+from the index. The sweepers of all processes share the index, and claiming an entry postpones its expiry, so an
+expired export is deleted by exactly one of them, and an export which could not be deleted is tried again later. A
+sweep only ever reads the entries which have expired rather than scanning the export storage.
+"""
+import os
+import time
+import logging
+import threading
+from deriva.core import format_exception
+from ..state import get_shared_state
+from .jobs import get_job, is_job_alive, delete_jobs
+from .events import delete_events
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_SWEEP_BATCH_SIZE = 500
+# how long a claimed export is left before it is claimed again, if it could not be deleted
+EXPIRY_RETRY_SECS = 3600
+
+EXPORT_EXPIRY_DDL = """
+CREATE TABLE IF NOT EXISTS export_expiry (
+  key TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  ttl REAL NOT NULL,
+  expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS export_expiry_expires ON export_expiry (expires);
+CREATE TABLE IF NOT EXISTS export_expiry_backfills (
+  path TEXT PRIMARY KEY,
+  completed REAL NOT NULL
+);
+"""
+
+_registered = False
+
+
+def _state():
+    global _registered
+    state = get_shared_state()
+    if not _registered:
+        state.register_schema(EXPORT_EXPIRY_DDL)
+        _registered = True
+    return state
+
+
+def set_export_expiry(owner, key, ttl_secs, now=None):
+    _state().execute("INSERT OR REPLACE INTO export_expiry (key, owner, ttl, expires) VALUES (?, ?, ?, ?)",
+                     (key, owner, ttl_secs, (now or time.time()) + ttl_secs))
+
+
+def renew_export_expiry(key, now=None):
+    """Resets the expiry time of an export to one TTL from now, e.g. when it has finished."""
+    _state().execute("UPDATE export_expiry SET expires = ? + ttl WHERE key = ?", (now or time.time(), key))
+
+
+def get_export_expiry(key):
+    """Returns the expiry time of an export, or None if it does not expire."""
+    row = _state().query_one("SELECT expires FROM export_expiry WHERE key = ?", (key,))
+    return row["expires"] if row is not None else None
+
+
+def delete_export_expiry(keys):
+    if keys:
+        with _state().transaction() as conn:
+            conn.executemany("DELETE FROM export_expiry WHERE key = ?", [(key,) for key in keys])
+
+
+def claim_expired_exports(now=None, limit=EXPIRY_SWEEP_BATCH_SIZE):
+    """Claims up to limit expired exports, and returns them as (owner, key) tuples. A claimed export stays in the
+    index, with its expiry postponed by EXPIRY_RETRY_SECS, until it has been deleted, so that no other sweeper claims
+    it meanwhile, and so that it is claimed again if it cannot be deleted. An export which is still running is left
+    in the index, to expire one TTL after it finishes."""
+    now = now or time.time()
+    with _state().transaction() as conn:
+        rows = conn.execute("SELECT key, owner FROM export_expiry WHERE expires <= ? ORDER BY expires LIMIT ?",
+                            (now, limit)).fetchall()
+        expired = list()
+        for row in rows:
+            job = get_job(row["key"])
+            if job is None or not is_job_alive(job):
+                expired.append((row["owner"], row["key"]))
+        conn.executemany("UPDATE export_expiry SET expires = ? WHERE key = ?",
+                         [(now + EXPIRY_RETRY_SECS, key) for owner, key in expired])
+    return expired
+
+
+def sweep_expired_exports(storage, now=None, limit=EXPIRY_SWEEP_BATCH_SIZE, on_deleted=None):
+    """Deletes the expired exports from storage, and calls on_deleted(storage, exports) with the (owner, key) tuples
+    of each batch of exports which were deleted. Returns the number of exports which were deleted."""
+    deleted = 0
+    while True:
+        expired = claim_expired_exports(now, limit)
+        exports = list()
+        for owner, key in expired:
+            try:
+                storage.delete(owner, key)
+            except Exception as e:
+                logger.warning("Unable to delete expired export [%s] of %s, it will be retried in %d seconds: %s" %
+                               (key, owner, EXPIRY_RETRY_SECS, format_exception(e)))
+                continue
+            exports.append((owner, key))
+        keys = [key for owner, key in exports]
+        delete_export_expiry(keys)
+        delete_jobs(keys)
+        delete_events(keys)
+        if on_deleted and exports:
+            on_deleted(storage, exports)
+        deleted += len(keys)
+        if len(expired) < limit:
+            return deleted
+
+
+def backfill_export_expiry(storage, ttl_secs, exclude_owners=(), now=None):
+    """Adds the exports of a local storage directory which are not yet in the index (e.g. those created before the
+    index existed) to the index, to expire one TTL after they were created. Each directory is only scanned once."""
+    path = getattr(storage, "base_path", None)
+    if not (storage.is_local and path and ttl_secs) or \
+            _state().query_one("SELECT path FROM export_expiry_backfills WHERE path = ?", (path,)):
+        return
+    entries = list()
+    if os.path.isdir(path):
+        for owner_entry in os.scandir(path):
+            if owner_entry.is_dir() and not owner_entry.name.startswith(".") and owner_entry.name not in exclude_owners:
+                entries.extend((key, owner_entry.name, ttl_secs, created + ttl_secs)
+                               for key, created in storage.list_exports(owner_entry.name))
+    with _state().transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO export_expiry (key, owner, ttl, expires) VALUES (?, ?, ?, ?)", entries)
+        conn.execute("INSERT OR REPLACE INTO export_expiry_backfills (path, completed) VALUES (?, ?)",
+                     (path, now or time.time()))
+    logger.info("Added %d existing export(s) in %s to the export expiry index" % (len(entries), path))
+
+
+def run_expiry_sweeper(storage, interval_secs, on_deleted=None, backfill_ttl_secs=None, backfill_exclude_owners=()):
+    backfilled = not backfill_ttl_secs
+    while True:
+        try:
+            if not backfilled:
+                backfill_export_expiry(storage, backfill_ttl_secs, exclude_owners=backfill_exclude_owners)
+                backfilled = True
+            deleted = sweep_expired_exports(storage, on_deleted=on_deleted)
+            if deleted:
+                logger.info("Deleted %d expired export(s)" % deleted)
+        except Exception as e:
+            logger.warning("Export expiry sweep error: %s" % format_exception(e))
+        time.sleep(interval_secs)
+
+
+_sweeper_thread = None
+_sweeper_lock = threading.Lock()
+
+
+def start_expiry_sweeper(storage, interval_secs, on_deleted=None, backfill_ttl_secs=None, backfill_exclude_owners=()):
+    """Start the expiry sweeper thread of this process, unless the sweep interval is 0. See sweep_expired_exports()
+    for on_deleted. If backfill_ttl_secs is set, the thread first runs backfill_export_expiry() with it and
+    backfill_exclude_owners."""
+    global _sweeper_thread
+    if not interval_secs or float(interval_secs) <= 0:
+        return
+    with _sweeper_lock:
+        if _sweeper_thread is None:
+            _sweeper_thread = threading.Thread(target=run_expiry_sweeper,
+                                               args=(storage, float(interval_secs), on_deleted, backfill_ttl_secs,
+                                                     backfill_exclude_owners),
+                                               name="export-expiry-sweeper",
+                                               daemon=True)
+            _sweeper_thread.start()
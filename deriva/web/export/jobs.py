@@ -0,0 +1,119 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Export job tracking shared by all service processes."""
+import os
+import json
+import time
+import socket
+from ..state import get_shared_state
+
+JOB_RUNNING = "running"
+JOB_COMPLETE = "complete"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+EXPORT_JOBS_DDL = """
+CREATE TABLE IF NOT EXISTS export_jobs (
+  key TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  output_dir TEXT NOT NULL,
+  status TEXT NOT NULL,
+  host TEXT,
+  pid INTEGER,
+  created REAL NOT NULL,
+  updated REAL NOT NULL,
+  files TEXT,
+  detail TEXT
+);
+CREATE INDEX IF NOT EXISTS export_jobs_owner ON export_jobs (owner, created);
+"""
+
+_registered = False
+
+
+def _state():
+    global _registered
+    state = get_shared_state()
+    if not _registered:
+        state.register_schema(EXPORT_JOBS_DDL)
+        _registered = True
+    return state
+
+
+def create_job(key, owner, output_dir):
+    now = time.time()
+    _state().execute("INSERT OR REPLACE INTO export_jobs (key, owner, output_dir, status, host, pid, created, updated) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (key, owner, output_dir, JOB_RUNNING, socket.gethostname(), os.getpid(), now, now))
+
+
+def finish_job(key, status, files=None, detail=None):
+    _state().execute("UPDATE export_jobs SET status = ?, updated = ?, files = ?, detail = ? WHERE key = ?",
+                     (status, time.time(), json.dumps(files) if files is not None else None, detail, key))
+
+
+def cancel_job(key):
+    """Request cancellation of a running job. Returns True if the job was running."""
+    cursor = _state().execute("UPDATE export_jobs SET status = ?, updated = ? WHERE key = ? AND status = ?",
+                              (JOB_CANCELLED, time.time(), key, JOB_RUNNING))
+    return cursor.rowcount > 0
+
+
+def is_job_cancelled(key):
+    row = _state().query_one("SELECT status FROM export_jobs WHERE key = ?", (key,))
+    return row is not None and row["status"] == JOB_CANCELLED
+
+
+def get_job(key):
+    row = _state().query_one("SELECT * FROM export_jobs WHERE key = ?", (key,))
+    if row is None:
+        return None
+    job = dict(row)
+    job["files"] = json.loads(job["files"]) if job["files"] else None
+    return job
+
+
+def delete_jobs(keys):
+    if keys:
+        with _state().transaction() as conn:
+            conn.executemany("DELETE FROM export_jobs WHERE key = ?", [(key,) for key in keys])
+
+
+def is_job_alive(job):
+    """A running job is alive if its owning process still exists (which can only be checked on the same host)."""
+    if job["status"] != JOB_RUNNING:
+        return False
+    if job["host"] != socket.gethostname():
+        return True
+    try:
+        os.kill(job["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def interrupted_jobs():
+    """Returns the jobs of this host which are still marked as running, but whose owning process no longer exists."""
+    rows = _state().query("SELECT * FROM export_jobs WHERE status = ? AND host = ?",
+                          (JOB_RUNNING, socket.gethostname()))
+    return [job for job in (dict(row) for row in rows) if not is_job_alive(job)]
+
+
+def running_job_keys(owner):
+    rows = _state().query("SELECT * FROM export_jobs WHERE owner = ? AND status = ?", (owner, JOB_RUNNING))
+    return set(row["key"] for row in rows if is_job_alive(dict(row)))
@@ -0,0 +1,154 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Incremental reads of export logs.
+
+The log of an export is only ever appended to, so a client which has read it up to some byte offset only needs what
+follows. Logs are read from that offset on, either once, after waiting for more of the log to be written (long
+polling), or continuously as server-sent events, and are never loaded into memory as a whole.
+"""
+import os
+import time
+
+LOG_POLL_INTERVAL_SECS = 0.5
+# a long poll sends nothing while it waits, so it must end well within the server's I/O timeout (60 s by default)
+LOG_MAX_WAIT_SECS = 20
+LOG_ERROR_TAIL_BYTES = 16 * 1024
+LOG_READ_CHUNK_SIZE = 64 * 1024
+
+
+class LogSource(object):
+    """The current location of an export log. A running export writes its log in the scratch area, and the log moves
+    to the export storage when the export is published, so the location is looked up again on every poll.
+
+    :param locate: a callable which returns the local path of the log (or None if it is only available from a remote
+        storage backend), and whether the export is still running, i.e. the log may still grow
+    :param read_remote: a callable which returns the log content after a byte offset, from a remote storage backend
+    """
+
+    def __init__(self, locate, read_remote=None):
+        self.locate = locate
+        self.read_remote = read_remote
+
+    def exists(self):
+        path, running = self.locate()
+        if path:
+            return os.path.isfile(path)
+        return self.read_remote is not None and self.read_remote(-1) is not None
+
+    def size(self):
+        """Returns the current size of the log, or None if it is only available remotely, and the running flag."""
+        path, running = self.locate()
+        try:
+            return os.path.getsize(path) if path else None, running
+        except OSError:
+            return 0, running
+
+    def open(self, offset):
+        """Returns a binary file-like object positioned at offset, or None if the log does not exist locally."""
+        path, running = self.locate()
+        if not path:
+            return None
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        f.seek(offset)
+        return f
+
+    def read(self, offset, length=None):
+        """Yields the log content after offset, in chunks. The file is opened before the first chunk is produced, so
+        that a log which is moved while it is being sent is still sent in full."""
+        f = self.open(offset)
+        if f is None:
+            data = self.read_remote(offset) if self.read_remote else None
+            return iter([data] if data else [])
+
+        def chunks(remaining=length):
+            with f:
+                while remaining is None or remaining > 0:
+                    data = f.read(LOG_READ_CHUNK_SIZE if remaining is None else min(LOG_READ_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    if remaining is not None:
+                        remaining -= len(data)
+                    yield data
+        return chunks()
+
+    def wait(self, offset, wait_secs):
+        """Waits until the log grows beyond offset, the export finishes, or wait_secs elapse.
+
+        :return: the size of the log (None if it is only available remotely), and whether the export is still running
+        """
+        deadline = time.monotonic() + min(wait_secs, LOG_MAX_WAIT_SECS)
+        while True:
+            size, running = self.size()
+            if size is None or size > offset or not running or time.monotonic() >= deadline:
+                return size, running
+            time.sleep(LOG_POLL_INTERVAL_SECS)
+
+    def follow(self, offset=0, max_duration_secs=60, keepalive_secs=15):
+        """Generates server-sent events with the lines of the log after offset, as they are written. Each event id is
+        the offset following its line, so a reconnecting client resumes where it left off with Last-Event-ID. An "eof"
+        event is sent when the export has finished and the whole log has been sent."""
+        yield "retry: 5000\n\n"
+        deadline = time.monotonic() + max_duration_secs
+        idle_since = time.monotonic()
+        partial = b""
+        while time.monotonic() < deadline:
+            size, running = self.size()
+            if size is None or size > offset + len(partial):
+                for data in self.read(offset + len(partial)):
+                    lines = (partial + data).split(b"\n")
+                    partial = lines.pop()
+                    for line in lines:
+                        offset += len(line) + 1
+                        yield format_log_event(offset, line)
+                    if lines:
+                        idle_since = time.monotonic()
+            if not running:
+                if partial:
+                    offset += len(partial)
+                    yield format_log_event(offset, partial)
+                yield "id: %d\nevent: eof\ndata: \n\n" % offset
+                return
+            if time.monotonic() - idle_since >= keepalive_secs:
+                idle_since = time.monotonic()
+                yield ": keepalive\n\n"
+            time.sleep(LOG_POLL_INTERVAL_SECS)
+
+
+def format_log_event(offset, line):
+    return "id: %d\nevent: log\ndata: %s\n\n" % (offset, line.decode("utf-8", "replace").rstrip("\r"))
+
+
+def read_log_tail(source, max_bytes=LOG_ERROR_TAIL_BYTES):
+    """Returns (at most) the last max_bytes of a log as text, starting with a whole line, or None if there is no log."""
+    size, running = source.size()
+    if size is None:
+        data = source.read_remote(-max_bytes) if source.read_remote else None
+        if data is None:
+            return None
+        truncated = len(data) >= max_bytes
+    else:
+        f = source.open(max(0, size - max_bytes))
+        if f is None:
+            return None
+        with f:
+            data = f.read(max_bytes)
+        truncated = size > max_bytes
+    if truncated:
+        data = b"...\n" + data.partition(b"\n")[2]
+    return data.decode("utf-8", "replace")
@@ -0,0 +1,187 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import datetime
+import functools
+import flask
+from contextlib import ExitStack
+from ....core import app, deriva_ctx, RestHandler, BadRequest, Forbidden, NotFound
+from ...api import create_output_dir, purge_output_dirs, export, get_export_storage, get_export_url, \
+    get_staging_subdir, get_export_ttl, discard_output_dir, user_export_lock, forget_export_acls, ExportClient, \
+    HANDLER_CONFIG_FILE, DEFAULT_HANDLER_CONFIG
+from ...batch import create_batch, get_batch, cancel_batch, start_batch, get_batch_config, BATCH_QUEUED
+from ...jobs import finish_job, JOB_COMPLETE, JOB_FAILED
+from ...warm import find_warm_export, start_warm_scheduler, WARM_OWNER
+from ...recovery import start_recovery
+from ...expiry import start_expiry_sweeper
+from ...templates import resolve_export_request
+from deriva.core import stob
+
+BATCH_EXPORT_TYPES = ("bdbag", "file")
+
+
+class ExportBatch(RestHandler):
+    def __init__(self):
+        RestHandler.__init__(self,
+                             handler_config_file=HANDLER_CONFIG_FILE,
+                             default_handler_config=DEFAULT_HANDLER_CONFIG)
+        self.batch_config = get_batch_config(self.config.get("batch_exports"))
+        start_warm_scheduler(self.config.get("warm_exports"))
+        start_recovery(self.config)
+        start_expiry_sweeper(get_export_storage(self.config.get("storage")),
+                             self.config.get("expiry_sweep_interval_secs", 300), forget_export_acls,
+                             backfill_ttl_secs=self.config.get("ttl_secs", DEFAULT_HANDLER_CONFIG["ttl_secs"]),
+                             backfill_exclude_owners=(WARM_OWNER,))
+
+    def parse_batch_request(self, batch_request):
+        """Returns the export type of a batch, and the export requests of its items."""
+        if not isinstance(batch_request, dict):
+            raise BadRequest("A batch export request must be a JSON object.")
+        export_type = batch_request.get("type", "bdbag")
+        if export_type not in BATCH_EXPORT_TYPES:
+            raise BadRequest("Unsupported export type \"%s\". Supported values are: %s" %
+                             (export_type, ", ".join(BATCH_EXPORT_TYPES)))
+        if "template" in batch_request:
+            parameter_sets = batch_request.get("parameters")
+            if not isinstance(parameter_sets, list):
+                raise BadRequest("A batch export of a template requires a list of \"parameters\" objects.")
+            requests = [{"template": batch_request["template"], "parameters": parameters}
+                        for parameters in parameter_sets]
+        else:
+            requests = batch_request.get("exports")
+            if not isinstance(requests, list):
+                raise BadRequest("A batch export requires a list of \"exports\", or a \"template\".")
+        if not requests:
+            raise BadRequest("A batch export requires at least one export.")
+        max_items = int(self.batch_config["max_items"])
+        if len(requests) > max_items:
+            raise BadRequest("A batch export may contain at most %d exports." % max_items)
+        return export_type, requests
+
+    def get_batch(self, key):
+        batch = get_batch(key)
+        if batch is None or batch["owner"] != get_staging_subdir():
+            raise NotFound("The export batch %s does not exist. It was never created or has expired." % key)
+        return batch
+
+    def batch_response(self, batch, status='200 OK', set_location_header=False):
+        url = get_export_url(batch["key"], "export/batch")
+        manifest = {"key": batch["key"],
+                    "url": url,
+                    "type": batch["type"],
+                    "created": datetime.datetime.fromtimestamp(batch["created"], datetime.timezone.utc).isoformat(),
+                    "status": batch["status"],
+                    "counts": batch["counts"],
+                    "items": batch["items"]}
+        deriva_ctx.deriva_response.status = status
+        deriva_ctx.deriva_response.content_type = 'application/json'
+        if set_location_header:
+            deriva_ctx.deriva_response.location = url
+        deriva_ctx.deriva_response.set_data(json.dumps(manifest, indent=2))
+        return deriva_ctx.deriva_response
+
+    def POST(self):
+        if not stob(self.batch_config["enabled"]):
+            raise Forbidden("Batch export submission is not enabled on this server.")
+        require_authentication = stob(self.config.get("require_authentication", True))
+        if require_authentication:
+            self.check_authenticated()
+        export_type, requests = self.parse_batch_request(json.loads(flask.request.stream.read().decode()))
+        resolved = [resolve_export_request(request, export_type, self.config, HANDLER_CONFIG_FILE)
+                    for request in requests]
+
+        # the client is authenticated, and its export lock is acquired, once for the whole batch
+        client = ExportClient.from_request()
+        storage = get_export_storage(self.config.get("storage"))
+        export_path = "export/%s" % export_type
+        public = stob(flask.request.args.get("public", False))
+        with ExitStack() as resources:
+            resources.enter_context(
+                user_export_lock(exclusive=not stob(self.config.get("allow_concurrent_export", False))))
+            purge_output_dirs(self.config.get("dir_auto_purge_threshold", 5), count=len(resolved), storage=storage)
+            items, tasks = list(), list()
+            try:
+                for position, (config, settings, template, envars) in enumerate(resolved):
+                    warm_export = find_warm_export(export_type, config, self.config) if not template else None
+                    if warm_export:
+                        # a matching pre-built export is current, so there is nothing to do
+                        items.append((warm_export["key"], get_export_url(warm_export["key"], export_path),
+                                      JOB_COMPLETE))
+                        continue
+                    key, output_dir = create_output_dir(self.config.get("scratch_path"),
+                                                        get_export_ttl(settings, flask.request.args.get("ttl")))
+                    url = get_export_url(key, export_path)
+                    items.append((key, url, BATCH_QUEUED))
+                    run = functools.partial(
+                        export,
+                        config=config,
+                        base_dir=output_dir,
+                        service_url=url,
+                        files_only=export_type == "file",
+                        public=public,
+                        quiet=stob(settings.get("quiet_logging", False)),
+                        propagate_logs=stob(self.config.get("propagate_logs", True)),
+                        require_authentication=require_authentication,
+                        allow_anonymous_download=stob(self.config.get("allow_anonymous_download", False)),
+                        max_payload_size_mb=settings.get("max_payload_size_mb"),
+                        timeout=settings.get("timeout_secs"),
+                        enable_blob_cache=stob(settings.get("enable_blob_cache", False)),
+                        blob_cache_max_size_mb=settings.get("blob_cache_max_size_mb", 0),
+                        archive_policy=settings.get("bag_archive_policy"),
+                        storage=storage,
+                        webhooks=self.config.get("webhooks"),
+                        additional_acl=self.config.get("additional_read_acl"),
+                        isolation=settings.get("isolation"),
+                        template=template,
+                        envars=envars,
+                        client=client,
+                        user_lock=False,
+                        dcctx_cid="export/batch",
+                        request_ip=client.ip)
+                    tasks.append((position, key, run))
+                batch_key = create_batch(client.owner, export_type, items)
+            except BaseException:
+                for position, key, run in tasks:
+                    finish_job(key, JOB_FAILED, detail="The export batch could not be created.")
+                    discard_output_dir(run.keywords["base_dir"])
+                raise
+            # the lock is released by the batch once all of its items have finished
+            start_batch(batch_key, tasks, self.batch_config["max_parallel"], resources.pop_all())
+        return self.batch_response(self.get_batch(batch_key), '202 Accepted', set_location_header=True)
+
+    def GET(self, key):
+        return self.batch_response(self.get_batch(key))
+
+    def DELETE(self, key):
+        self.get_batch(key)
+        cancel_batch(key)
+        return self.batch_response(self.get_batch(key), '202 Accepted')
+
+
+@app.route('/export/batch', methods=['POST'])
+@app.route('/export/batch/', methods=['POST'])
+def _export_batch_handler():
+    return ExportBatch().POST()
+
+
+@app.route('/export/batch/<key>', methods=['GET'])
+def _export_batch_retrieve_handler(key):
+    return ExportBatch().GET(key)
+
+
+@app.route('/export/batch/<key>', methods=['DELETE'])
+def _export_batch_delete_handler(key):
+    return ExportBatch().DELETE(key)
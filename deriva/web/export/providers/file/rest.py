@@ -16,48 +16,82 @@
 import os
 import json
 import flask
+from functools import partial
 from ....core import app, get_client_identity, RestHandler
-from ...api import create_output_dir, purge_output_dirs, export, HANDLER_CONFIG_FILE
+from ...api import create_output_dir, purge_output_dirs, export, submit_export, get_export_storage, get_export_url, \
+    get_export_ttl, forget_export_acls, HANDLER_CONFIG_FILE, DEFAULT_HANDLER_CONFIG, REMOTE_PATHS_KEY
+from ...warm import find_warm_export, start_warm_scheduler, WARM_OWNER
+from ...recovery import start_recovery
+from ...expiry import start_expiry_sweeper
+from ...templates import resolve_export_request
+from ...jobs import JOB_RUNNING
 from deriva.core import stob
-from deriva.transfer import GenericDownloader
 
 
 class ExportFiles(RestHandler):
     def __init__(self):
         RestHandler.__init__(self, handler_config_file=HANDLER_CONFIG_FILE)
+        start_warm_scheduler(self.config.get("warm_exports"))
+        start_recovery(self.config)
+        start_expiry_sweeper(get_export_storage(self.config.get("storage")),
+                             self.config.get("expiry_sweep_interval_secs", 300), forget_export_acls,
+                             backfill_ttl_secs=self.config.get("ttl_secs", DEFAULT_HANDLER_CONFIG["ttl_secs"]),
+                             backfill_exclude_owners=(WARM_OWNER,))
 
     def POST(self):
         require_authentication = stob(self.config.get("require_authentication", True))
         if require_authentication:
             self.check_authenticated()
-        purge_output_dirs(self.config.get("dir_auto_purge_threshold", 5))
-        key, output_dir = create_output_dir()
-        url = "%s/%s/%s" % (
-            flask.request.root_url.rstrip('/'),
-            flask.request.path.strip('/'),
-            key.lstrip('/'),
-        )
-        params = flask.request.args
-        public = stob(params.get("public", False))
+        config, settings, template, envars = resolve_export_request(json.loads(flask.request.stream.read().decode()),
+                                                                    "file", self.config, HANDLER_CONFIG_FILE)
+        warm_export = find_warm_export("file", config, self.config) if not template else None
+        if warm_export:
+            # a matching pre-built export is current, so there is nothing to do
+            key, output = warm_export["key"], warm_export["outputs"]
+            url = get_export_url(key)
+        else:
+            storage = get_export_storage(self.config.get("storage"))
+            purge_output_dirs(self.config.get("dir_auto_purge_threshold", 5), storage=storage)
+            params = flask.request.args
+            key, output_dir = create_output_dir(self.config.get("scratch_path"),
+                                                get_export_ttl(settings, params.get("ttl")))
+            url = get_export_url(key)
+            public = stob(params.get("public", False))
 
-        # perform the export
-        output = export(config=json.loads(flask.request.stream.read().decode()),
-                        base_dir=output_dir,
-                        service_url=url,
-                        files_only=True,
-                        public=public,
-                        quiet=stob(self.config.get("quiet_logging", False)),
-                        propagate_logs=stob(self.config.get("propagate_logs", True)),
-                        require_authentication=require_authentication,
-                        allow_anonymous_download=stob(self.config.get("allow_anonymous_download", False)),
-                        allow_concurrent_export=stob(self.config.get("allow_concurrent_export", False)),
-                        max_payload_size_mb=self.config.get("max_payload_size_mb"),
-                        timeout=self.config.get("timeout_secs"),
-                        dcctx_cid="export/file")
+            # perform the export
+            build = partial(export,
+                            config=config,
+                            base_dir=output_dir,
+                            service_url=url,
+                            files_only=True,
+                            public=public,
+                            quiet=stob(settings.get("quiet_logging", False)),
+                            propagate_logs=stob(self.config.get("propagate_logs", True)),
+                            require_authentication=require_authentication,
+                            allow_anonymous_download=stob(self.config.get("allow_anonymous_download", False)),
+                            allow_concurrent_export=stob(settings.get("allow_concurrent_export", False)),
+                            max_payload_size_mb=settings.get("max_payload_size_mb"),
+                            timeout=settings.get("timeout_secs"),
+                            enable_blob_cache=stob(settings.get("enable_blob_cache", False)),
+                            blob_cache_max_size_mb=settings.get("blob_cache_max_size_mb", 0),
+                            archive_policy=settings.get("bag_archive_policy"),
+                            storage=storage,
+                            webhooks=self.config.get("webhooks"),
+                            additional_acl=self.config.get("additional_read_acl"),
+                            isolation=settings.get("isolation"),
+                            template=template,
+                            envars=envars,
+                            dcctx_cid="export/file")
+            if stob(params.get("async", False)):
+                # the export runs in the background, and the client follows it by its events or its log
+                submit_export(build, allow_concurrent_export=stob(settings.get("allow_concurrent_export", False)))
+                return self.accepted_response({"key": key, "url": url, "events": url + "/events",
+                                               "status": JOB_RUNNING}, url)
+            output = build()
         uri_list = list()
         set_location_header = False if len(output.keys()) > 1 else True
         for file_path, file_metadata in output.items():
-            remote_paths = file_metadata.get(GenericDownloader.REMOTE_PATHS_KEY)
+            remote_paths = file_metadata.get(REMOTE_PATHS_KEY)
             if remote_paths:
                 target_url = remote_paths[0]
             else:
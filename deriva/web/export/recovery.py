@@ -0,0 +1,130 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Recovery of exports interrupted by a crash or restart of the service.
+
+Exports are built in a scratch area and only published for retrieval once they are finished, so an export whose
+service process died leaves behind a job marked as running and a partial build in the scratch area. Each service
+process sweeps both in a background thread, started by the first export request it handles: interrupted jobs of this
+host are marked as failed, with only their log published for diagnostics, and scratch directories which no longer
+belong to a running job are removed.
+"""
+import os
+import time
+import shutil
+import logging
+import threading
+from portalocker import LockException
+from deriva.core import format_exception, lock_file
+from .api import get_scratch_path, get_export_storage, notify_job
+from .events import EVENT_FAILED
+from .jobs import get_job, finish_job, interrupted_jobs, JOB_RUNNING, JOB_FAILED
+
+logger = logging.getLogger(__name__)
+
+# scratch directories without a running job are only removed once they are older than this, so that an export which
+# is just being created or published is never mistaken for an orphan
+RECOVERY_GRACE_SECS = 300
+
+# the files of an interrupted export which are kept and published, so that the client can find out what happened
+RECOVERED_FILES = frozenset([".access", ".log"])
+
+_recovered_pid = None
+
+
+def fail_interrupted_job(job, storage):
+    key, output_dir = job["key"], job["output_dir"]
+    detail = "The export was interrupted: the service process (%s) running it no longer exists." % job["pid"]
+    finish_job(key, JOB_FAILED, detail=detail)
+    if os.path.isdir(output_dir):
+        for name in os.listdir(output_dir):
+            if name in RECOVERED_FILES:
+                continue
+            path = os.path.join(output_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        with open(os.path.join(output_dir, ".log"), "a") as log:
+            log.write("%s\n" % detail)
+        storage.publish(job["owner"], key, output_dir)
+    notify_job(key, EVENT_FAILED, detail=detail)
+    logger.info("Recovered interrupted export [%s] of %s" % (key, job["owner"]))
+
+
+def remove_orphaned_dirs(scratch_path, orphan_age_secs=None):
+    """Removes the scratch directories which do not belong to a running job. Directories without any job (e.g.
+    warm export builds) are only removed when older than orphan_age_secs, and kept if it is not set."""
+    now = time.time()
+    for owner_entry in os.scandir(scratch_path):
+        if not owner_entry.is_dir():
+            continue
+        for entry in os.scandir(owner_entry.path):
+            if not entry.is_dir():
+                continue
+            job = get_job(entry.name)
+            if job is None:
+                if not orphan_age_secs or now - entry.stat().st_mtime < orphan_age_secs + RECOVERY_GRACE_SECS:
+                    continue
+            elif job["status"] == JOB_RUNNING or now - job["updated"] < RECOVERY_GRACE_SECS:
+                continue
+            logger.info("Removing orphaned export scratch directory: %s" % entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def recover_exports(handler_config):
+    """Runs the recovery sweep, unless another process is running it. Returns True if the sweep ran."""
+    scratch_path = get_scratch_path(handler_config.get("scratch_path"))
+    os.makedirs(scratch_path, exist_ok=True)
+    try:
+        with lock_file(os.path.join(scratch_path, ".recovery.lock"), mode='w', exclusive=True, timeout=0):
+            storage = get_export_storage(handler_config.get("storage"))
+            for job in interrupted_jobs():
+                try:
+                    fail_interrupted_job(job, storage)
+                except Exception as e:
+                    logger.warning("Unable to recover interrupted export [%s]: %s" % (job["key"], format_exception(e)))
+            remove_orphaned_dirs(scratch_path, handler_config.get("timeout_secs"))
+            return True
+    except LockException:
+        return False
+
+
+def run_recovery(handler_config):
+    global _recovered_pid
+    try:
+        if recover_exports(handler_config):
+            _recovered_pid = os.getpid()
+    except Exception as e:
+        logger.warning("Export recovery error: %s" % format_exception(e))
+
+
+_recovery_thread = None
+_recovery_lock = threading.Lock()
+
+
+def start_recovery(handler_config):
+    """Start the recovery sweep of this process in a background thread, unless it already ran or is running. A sweep
+    which could not take the recovery lock, or which failed, is started again by the next request."""
+    global _recovery_thread
+    if _recovered_pid == os.getpid():
+        return
+    with _recovery_lock:
+        if _recovered_pid != os.getpid() and (_recovery_thread is None or not _recovery_thread.is_alive()):
+            _recovery_thread = threading.Thread(target=run_recovery,
+                                                args=(handler_config,),
+                                                name="export-recovery",
+                                                daemon=True)
+            _recovery_thread.start()
@@ -14,75 +14,338 @@
 # limitations under the License.
 #
 import os
+import json
+import time
 import flask
 import urllib
+from zipfile import BadZipFile, ZIP_DEFLATED
 from deriva.core.utils.mime_utils import guess_content_type
-from ..core import app, deriva_ctx, deriva_debug, RestHandler, NotFound, Forbidden, BadRequest, STORAGE_PATH
-from .api import check_access, get_staging_path, HANDLER_CONFIG_FILE
+from ..core import app, deriva_ctx, deriva_debug, RestHandler, NotFound, Forbidden, BadRequest, NotImplemented, \
+    Conflict, STORAGE_PATH
+from werkzeug.http import http_date
+from ..compression import parse_accept_encoding
+from .events import notifier, get_events, delete_events, format_sse, resume_webhook_delivery, TERMINAL_EVENTS, \
+    EVENT_COMPLETE, EVENT_FAILED
+from .jobs import get_job, cancel_job, delete_jobs, is_job_alive, JOB_RUNNING
+from .api import check_access, get_export_acl, forget_export_acls, get_staging_subdir, get_export_files, \
+    get_export_storage, HANDLER_CONFIG_FILE, DEFAULT_HANDLER_CONFIG
+from .warm import is_warm_key, start_warm_scheduler, WARM_OWNER
+from .recovery import start_recovery
+from .expiry import start_expiry_sweeper, get_export_expiry, delete_export_expiry
+from .zipindex import get_zip_index
+from .logtail import LogSource, read_log_tail
+from .streams import get_streams_config, limited_stream, stream_slots
+
+STREAM_REFUSED_RETRY_MS = 30000
 
 
 class ExportRetrieve (RestHandler):
 
     def __init__(self):
         RestHandler.__init__(self, handler_config_file=HANDLER_CONFIG_FILE)
+        self.storage = get_export_storage(self.config.get("storage"))
+        self.owner = get_staging_subdir()
+        start_warm_scheduler(self.config.get("warm_exports"))
+        start_recovery(self.config)
+        start_expiry_sweeper(self.storage, self.config.get("expiry_sweep_interval_secs", 300), forget_export_acls,
+                             backfill_ttl_secs=self.config.get("ttl_secs", DEFAULT_HANDLER_CONFIG["ttl_secs"]),
+                             backfill_exclude_owners=(WARM_OWNER,))
+        resume_webhook_delivery()
+
+    def resolve_owner(self, key):
+        # warm exports are shared by everyone that their ACL permits, rather than owned by the requesting client
+        if is_warm_key(key):
+            self.owner = WARM_OWNER
+
+    def send_metadata(self, key, name, content_type):
+        deriva_ctx.deriva_response.content_type = content_type
+        if self.storage.is_local:
+            return self.get_content(self.storage.local_path(self.owner, key, name))
+        data = self.storage.read_metadata(self.owner, key, name) or b''
+        deriva_ctx.deriva_response.status = '200 OK'
+        deriva_ctx.deriva_response.content_length = len(data)
+        if flask.request.method.upper() != 'HEAD':
+            deriva_ctx.deriva_response.set_data(data)
+        return deriva_ctx.deriva_response
+
+    def get_log_source(self, key):
+        def locate():
+            # a running export writes its log in the scratch area, until the export is published
+            job = get_job(key)
+            if job is not None and job["owner"] == self.owner:
+                path = os.path.join(job["output_dir"], ".log")
+                if os.path.isfile(path):
+                    return path, is_job_alive(job)
+            return self.storage.local_path(self.owner, key, ".log"), False
+
+        def read_remote(offset):
+            return self.storage.read_metadata(self.owner, key, ".log", offset)
+
+        return LogSource(locate, read_remote)
+
+    def send_log(self, key):
+        """Sends the export log. A client can follow the log as it is written, by requesting it from a byte offset
+        (optionally waiting for it to grow), or as a stream of server-sent events."""
+        source = self.get_log_source(key)
+        response = deriva_ctx.deriva_response
+        args = flask.request.args
+        streams = get_streams_config(self.config.get("streams"))
+        if 'text/event-stream' in flask.request.headers.get('accept', ''):
+            offset = self.get_log_offset(flask.request.headers.get("Last-Event-ID", args.get("offset", "0")))
+            response.status = '200 OK'
+            response.content_type = 'text/event-stream'
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            response.response = limited_stream(source.follow(offset, max_duration_secs=streams["max_secs"]),
+                                               streams["max_per_process"],
+                                               refused="retry: %d\n\n" % STREAM_REFUSED_RETRY_MS)
+            return response
+
+        if "offset" not in args and "wait" not in args:
+            path, running = source.locate()
+            if path and running:
+                response.content_type = 'text/plain'
+                response.headers['Cache-Control'] = 'no-cache'
+                return self.get_content(path, growing=True)
+            return self.send_metadata(key, ".log", 'text/plain')
+
+        offset = self.get_log_offset(args.get("offset", "0"))
+        try:
+            wait_secs = float(args.get("wait", 0))
+        except ValueError:
+            raise BadRequest("Invalid wait time: %s" % args.get("wait"))
+        # a long poll holds a request thread while it waits, so it only waits if this process has a stream slot free
+        with stream_slots.held(int(streams["max_per_process"])) as waiting:
+            size, running = source.wait(offset, wait_secs if waiting else 0)
+        length = None if size is None else max(0, size - offset)
+        body = source.read(offset, length)
+        if size is None:
+            # from a remote storage backend, the whole remainder of the log has to be read to know its length
+            data = b"".join(body)
+            length, body = len(data), [data]
+        response.status = '200 OK'
+        response.content_type = 'text/plain'
+        response.content_length = length
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Log-Offset'] = str(offset + length)
+        response.headers['X-Log-Complete'] = 'false' if running else 'true'
+        if flask.request.method.upper() != 'HEAD':
+            response.response = body
+        return response
+
+    @staticmethod
+    def get_log_offset(value):
+        try:
+            offset = int(value)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise BadRequest("Invalid log offset: %s" % value)
+        return offset
 
-    def send_log(self, file_path):
-        deriva_ctx.deriva_response.content_type = 'text/plain'
-        return self.get_content(file_path, deriva_ctx.webauthn2_context)
+    def send_stats(self, key):
+        return self.send_metadata(key, ".stats", 'application/json')
 
-    def send_content(self, file_path, guess_content=True):
+    def set_cache_headers(self, key):
+        """The files of an export never change once it is published, so they may be cached until it expires."""
+        expires = get_export_expiry(key)
+        max_age = int(expires - time.time()) if expires else 0
+        if max_age <= 0:
+            return
+        acl = get_export_acl(self.storage, self.owner, key)
+        deriva_ctx.deriva_response.headers['Cache-Control'] = \
+            "%s, max-age=%d" % ("public" if acl and "*" in acl else "private", max_age)
+        deriva_ctx.deriva_response.headers['Expires'] = http_date(expires)
+
+    def send_content(self, key, filename, guess_content=True):
+        url = self.storage.get_download_url(self.owner, key, filename)
+        if url:
+            return self.redirect_response(url)
+        self.set_cache_headers(key)
+        file_path = self.storage.local_path(self.owner, key, filename)
         deriva_ctx.deriva_response.content_type = \
             'application/octet-stream' if not guess_content else guess_content_type(file_path)
-        deriva_ctx.deriva_response.headers['Content-Disposition'] = "filename*=UTF-8''%s" % urllib.parse.quote(os.path.basename(file_path))
+        deriva_ctx.deriva_response.headers['Content-Disposition'] = \
+            "filename*=UTF-8''%s" % urllib.parse.quote(os.path.basename(file_path))
         return self.get_content(file_path)
 
+    def send_archive_member(self, key, archive, member_path):
+        file_path = self.storage.local_path(self.owner, key, archive)
+        if not file_path:
+            raise NotImplemented("Retrieval of archive members is not supported by the configured export storage.")
+        try:
+            index = get_zip_index(file_path)
+        except (OSError, BadZipFile):
+            raise BadRequest("The file \"%s\" is not a readable zip archive." % archive)
+
+        # a path ending with a slash lists the members under it
+        if not member_path or member_path.endswith("/"):
+            listing = json.dumps([member.describe() for member in index.list(member_path)], indent=2)
+            deriva_ctx.deriva_response.status = '200 OK'
+            deriva_ctx.deriva_response.content_type = 'application/json'
+            deriva_ctx.deriva_response.set_data(listing)
+            return deriva_ctx.deriva_response
+
+        member = index.get(member_path)
+        if member is None or member.is_dir:
+            raise NotFound("The archive \"%s\" has no member \"%s\"." % (archive, member_path))
+        if member.encrypted:
+            raise NotImplemented("Retrieval of encrypted archive members is not supported.")
+
+        self.set_cache_headers(key)
+        response = deriva_ctx.deriva_response
+        response.content_type = guess_content_type(member_path)
+        response.headers['Content-Disposition'] = \
+            "filename*=UTF-8''%s" % urllib.parse.quote(os.path.basename(member_path))
+        response.headers['Accept-Ranges'] = 'bytes'
+        if member.compress_type == ZIP_DEFLATED:
+            response.vary.add('Accept-Encoding')
+        accepted = parse_accept_encoding(flask.request.headers.get('accept-encoding'))
+        byte_range = self.get_byte_range(member.file_size)
+        if byte_range:
+            first, last = byte_range
+            response.status = '206 Partial Content'
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, member.file_size)
+            response.content_length = last - first + 1
+            body = index.read(member, first, last - first + 1)
+        elif member.compress_type == ZIP_DEFLATED and accepted.get("gzip", accepted.get("*", 0.0)) > 0:
+            # the deflated member data is sent as-is, in a gzip wrapper
+            response.status = '200 OK'
+            response.content_encoding = 'gzip'
+            response.content_length = index.gzip_size(member)
+            body = index.read_gzip(member)
+        else:
+            response.status = '200 OK'
+            response.content_length = member.file_size
+            body = index.read(member)
+        if flask.request.method.upper() != 'HEAD':
+            response.response = body
+            response.direct_passthrough = True
+        return response
+
     def GET(self, key, requested_file=None):
-        export_dir = os.path.abspath(os.path.join(get_staging_path(), key))
-        if not os.path.isdir(export_dir):
+        self.resolve_owner(key)
+        if not self.storage.exists(self.owner, key):
+            # an export is only published for retrieval once it is finished, but its log can be followed until then
+            job = get_job(key)
+            if job is not None and job["owner"] == self.owner and is_job_alive(job) and \
+                    check_access(self.storage, self.owner, key):
+                if requested_file == 'log':
+                    return self.send_log(key)
+                raise Conflict("The resource %s is still being created, retry when it is finished." % key)
             raise NotFound("The resource %s does not exist. It was never created or has been deleted." % key)
-        if not check_access(export_dir):
+        if not check_access(self.storage, self.owner, key):
             raise Forbidden("The currently authenticated user is not permitted to access the specified resource.")
 
-        for dirname, dirnames, filenames in os.walk(export_dir):
-            # first, deal with the special case "metadata" files...
-            if ".access" in filenames:
-                filenames.remove(".access")
-            log_path = os.path.abspath(os.path.join(dirname, ".log"))
-            if ".log" in filenames:
-                if requested_file and requested_file == 'log':
-                    return self.send_log(log_path)
-                filenames.remove(".log")
-
-            # if there are no remaining files in the dir list, we don't have anything to reply with.
-            # so, raise a 404 but also try to send back the log (if it exists) as additional diagnostic info.
-            if not filenames:
-                log_text = 'No additional diagnostic information available.\n'
-                if os.path.isfile(log_path):
-                    with open(log_path) as log:
-                        log_text = log.read()
-                raise NotFound(log_text)
-            else:
-                # otherwise we've got at least one file to reply with...
-                for filename in filenames:
-                    file_path = os.path.abspath(os.path.join(dirname, filename))
-                    if not requested_file:
-                        # if there is more than one file in the resource bucket and the caller wasn't explicit about
-                        # which one to retrieve, it is a bad request.
-                        if len(filenames) > 1:
-                            raise BadRequest("The resource %s contains more than one file, it is therefore necessary "
-                                             "to specify a filename in the request URL." % key)
-                        else:
-                            return self.send_content(file_path)
-                    else:
-                        # otherwise keep looping until we find a match
-                        if requested_file == filename:
-                            return self.send_content(file_path)
-                        else:
-                            continue
+        # first, deal with the special case "metadata" files...
+        if requested_file == 'log' and self.get_log_source(key).exists():
+            return self.send_log(key)
+        if requested_file == 'stats' and self.storage.read_metadata(self.owner, key, ".stats") is not None:
+            return self.send_stats(key)
+
+        # if there are no remaining files in the dir list, we don't have anything to reply with.
+        # so, raise a 404 but also try to send back the log (if it exists) as additional diagnostic info.
+        filenames = get_export_files(key, self.storage, self.owner)
+        if not filenames:
+            log_text = read_log_tail(self.get_log_source(key))
+            raise NotFound(log_text if log_text is not None else 'No additional diagnostic information available.\n')
+
+        if not requested_file:
+            # if there is more than one file in the resource bucket and the caller wasn't explicit about
+            # which one to retrieve, it is a bad request.
+            if len(filenames) > 1:
+                raise BadRequest("The resource %s contains more than one file, it is therefore necessary "
+                                 "to specify a filename in the request URL." % key)
+            return self.send_content(key, filenames[0])
+        elif requested_file in filenames:
+            return self.send_content(key, requested_file)
+
+        # a path of the form <archive>.zip/<member> refers to a single member of a zipped bag
+        for filename in filenames:
+            if filename.lower().endswith(".zip") and requested_file.startswith(filename + "/"):
+                return self.send_archive_member(key, filename, requested_file[len(filename) + 1:])
 
         # if we got here it means the caller asked for something that does not exist.
         raise NotFound("The requested file \"%s\" does not exist." % requested_file)
 
+    def DELETE(self, key):
+        if is_warm_key(key):
+            raise Forbidden("Pre-generated exports are managed by the server and cannot be deleted.")
+        job = get_job(key)
+        running = job is not None and job["owner"] == self.owner and is_job_alive(job)
+        if not (running or self.storage.exists(self.owner, key)):
+            raise NotFound("The resource %s does not exist. It was never created or has been deleted." % key)
+        if not check_access(self.storage, self.owner, key):
+            raise Forbidden("The currently authenticated user is not permitted to access the specified resource.")
+
+        if running and cancel_job(key):
+            # the process running the export stops it and removes its output, then sends a "cancelled" event
+            deriva_ctx.deriva_response.status = '202 Accepted'
+            return deriva_ctx.deriva_response
+
+        self.storage.delete(self.owner, key)
+        delete_jobs([key])
+        delete_events([key])
+        delete_export_expiry([key])
+        forget_export_acls(self.storage, [(self.owner, key)])
+        return self.delete_response()
+
+
+class ExportEvents (ExportRetrieve):
+
+    def __init__(self):
+        ExportRetrieve.__init__(self)
+
+    def GET(self, key):
+        self.resolve_owner(key)
+        job = get_job(key)
+        if not ((job and job["owner"] == self.owner) or self.storage.exists(self.owner, key)):
+            raise NotFound("The resource %s does not exist. It was never created or has been deleted." % key)
+        if not check_access(self.storage, self.owner, key):
+            raise Forbidden("The currently authenticated user is not permitted to access the specified resource.")
+
+        last_event_id = flask.request.headers.get("Last-Event-ID", flask.request.args.get("last_event_id", "0"))
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            raise BadRequest("Invalid event id: %s" % last_event_id)
+
+        events = None
+        if not job or job["status"] != JOB_RUNNING:
+            # the export has already finished: replay its events, or synthesize the outcome if they are gone
+            events = get_events(key, last_event_id)
+            if not any(e["event"] in TERMINAL_EVENTS for e in events):
+                files = get_export_files(key, self.storage, self.owner)
+                events.append({"id": 0,
+                               "event": EVENT_COMPLETE if files else EVENT_FAILED,
+                               "data": json.dumps({"key": key, "files": files})})
+
+        def stream():
+            yield "retry: 5000\n\n"
+            for event in events if events is not None else \
+                    notifier.subscribe(key, after_id=last_event_id, max_duration_secs=streams["max_secs"]):
+                yield format_sse(event)
+
+        streams = get_streams_config(self.config.get("streams"))
+        deriva_ctx.deriva_response.status = '200 OK'
+        deriva_ctx.deriva_response.content_type = 'text/event-stream'
+        deriva_ctx.deriva_response.headers['Cache-Control'] = 'no-cache'
+        deriva_ctx.deriva_response.headers['X-Accel-Buffering'] = 'no'
+        if events is None:
+            # a live stream holds a request thread until it ends; if this process is busy, the client retries later
+            deriva_ctx.deriva_response.response = limited_stream(stream(), streams["max_per_process"],
+                                                                 refused="retry: %d\n\n" % STREAM_REFUSED_RETRY_MS)
+        else:
+            deriva_ctx.deriva_response.response = stream()
+        return deriva_ctx.deriva_response
+
+
+@app.route('/export/bdbag/<key>/events', methods=['GET'])
+@app.route('/export/file/<key>/events', methods=['GET'])
+def _export_events_handler(key):
+    return ExportEvents().GET(key)
+
+
 @app.route('/export/bdbag/<key>', methods=['GET'])
 @app.route('/export/bdbag/<key>/', methods=['GET'])
 @app.route('/export/bdbag/<key>/<path:requested_file>', methods=['GET'])
@@ -92,3 +355,9 @@ class ExportRetrieve (RestHandler):
 def _export_retrieve_handler(key, requested_file=None):
     return ExportRetrieve().GET(key, requested_file=requested_file)
 
+
+@app.route('/export/bdbag/<key>', methods=['DELETE'])
+@app.route('/export/file/<key>', methods=['DELETE'])
+def _export_delete_handler(key):
+    return ExportRetrieve().DELETE(key)
+
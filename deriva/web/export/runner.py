@@ -0,0 +1,192 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Export execution: everything which needs the (heavy) transfer and bagging machinery.
+
+This module is imported on first use by `api.export()`, so that service processes which only serve retrievals never
+load `deriva.transfer` or `bdbag`.
+"""
+import os
+import json
+import shutil
+import logging
+from bdbag import bdbag_api as bdb
+from deriva.core import stob
+from deriva.transfer import GenericDownloader
+from deriva.transfer.download.processors import find_post_processor
+from deriva.transfer.download import DerivaDownloadTimeoutError
+from .archive import archive_bag
+from .cache import BlobStore
+from .processors import export_context, plan_export
+from ..core import STORAGE_PATH, TRACER
+from ..profiling import profiled
+from ..tracing import traced
+
+logger = logging.getLogger()
+
+SCRATCH_DIR_NAME = ".scratch"
+
+
+def log_export_plan(config, envars, stats):
+    plan, shared = plan_export(config, dict(envars or {}, **(config.get("env") or {})))
+    stats.update(plan)
+    logger.info("Export plan: %d query processor(s), %d distinct catalog quer%s, %d shared by more than one processor; "
+                "%d query execution(s) planned, %d avoided" % (
+                    plan["plan_query_processors"],
+                    plan["plan_distinct_queries"],
+                    "y" if plan["plan_distinct_queries"] == 1 else "ies",
+                    plan["plan_shared_queries"],
+                    plan["plan_query_executions"],
+                    plan["plan_query_executions_saved"]))
+    for query, processor_types in shared.items():
+        logger.info("Export plan: query [%s] is shared by processors: %s" % (query, ", ".join(processor_types)))
+
+
+def log_deduplication_stats(stats):
+    logger.info("Export deduplication: %d catalog quer%s executed, %d reused (%d bytes); "
+                "%d duplicate remote file(s) linked (%d bytes)" % (
+                    stats.get("queries_executed", 0),
+                    "y" if stats.get("queries_executed", 0) == 1 else "ies",
+                    stats.get("query_dedup_hits", 0),
+                    stats.get("query_dedup_bytes", 0),
+                    stats.get("remote_dedup_hits", 0),
+                    stats.get("remote_dedup_bytes", 0)))
+
+
+def log_fixity_stats(stats):
+    logger.info("Bag fixity: digests of %d payload file(s) (%d bytes) were computed during download, "
+                "%d file(s) (%d bytes) were read again" % (
+                    stats.get("fixity_files_reused", 0),
+                    stats.get("fixity_bytes_reused", 0),
+                    stats.get("fixity_files_read", 0),
+                    stats.get("fixity_bytes_read", 0)))
+
+
+def write_export_stats(directory, stats):
+    with open(os.path.abspath(os.path.join(directory, ".stats")), 'w') as sf:
+        json.dump(stats, sf, indent=2, sort_keys=True)
+
+
+def get_blob_store(max_size_mb=0):
+    return BlobStore(os.path.join(STORAGE_PATH, "cache", "blobs"), max_size_mb=max_size_mb)
+
+
+def archive_outputs(outputs, archiver, archive_policy, idempotent, stats):
+    archived = dict()
+    for output in outputs.values():
+        bag_path = output[GenericDownloader.LOCAL_PATH_KEY]
+        archive, archive_stats = archive_bag(bag_path, archiver, archive_policy, idempotent=idempotent)
+        bdb.cleanup_bag(bag_path)
+        stats.update(archive_stats)
+        archived[os.path.basename(archive)] = {GenericDownloader.LOCAL_PATH_KEY: archive}
+    return archived
+
+
+def post_process_outputs(downloader, post_processors, outputs, identity, wallet):
+    # equivalent to the post processing stage of GenericDownloader.download(), run after service-side archiving
+    for processor in post_processors:
+        processor_name = processor["processor"]
+        post_processor = find_post_processor(processor_name, processor.get('processor_type'))
+        processor = post_processor(downloader.envars,
+                                   inputs=outputs,
+                                   processor_params=processor.get('processor_params'),
+                                   identity=identity,
+                                   wallet=wallet,
+                                   allow_anonymous=downloader.allow_anonymous,
+                                   timeout=downloader.timeout)
+        outputs = processor.process()
+        if processor.should_abort():
+            raise DerivaDownloadTimeoutError("Timeout (%s seconds) waiting for processor [%s] to complete." %
+                                             (downloader.timeout_secs, processor_name))
+        downloader.check_payload_size(outputs)
+    return outputs
+
+
+def run_export(server,
+               base_dir,
+               envars,
+               config,
+               credentials,
+               identity,
+               wallet,
+               archiver,
+               archive_policy,
+               post_processors,
+               allow_anonymous_download,
+               max_payload_size_mb,
+               timeout,
+               enable_blob_cache,
+               blob_cache_max_size_mb,
+               progress,
+               dcctx_cid,
+               trace_context=None):
+    """Download, bag and archive an export. This runs without a request context, possibly in a child process, in which
+    case the trace of the export (if any) is resumed from trace_context."""
+    downloader = GenericDownloader(server=server,
+                                   output_dir=base_dir,
+                                   envars=envars,
+                                   config=config,
+                                   credentials=credentials,
+                                   allow_anonymous=allow_anonymous_download,
+                                   max_payload_size_mb=max_payload_size_mb,
+                                   timeout=timeout,
+                                   dcctx_cid=dcctx_cid)
+    blob_store = get_blob_store(blob_cache_max_size_mb) if enable_blob_cache else None
+    scratch_dir = os.path.join(base_dir, SCRATCH_DIR_NAME)
+    os.makedirs(scratch_dir, exist_ok=True)
+    bag_config = config.get("bag")
+    digest_algorithms = bag_config.get("bag_algorithms", ["sha256"]) if bag_config else []
+    with TRACER.resumed(trace_context, "export.process", {"process.pid": os.getpid()}), \
+            export_context(blob_store=blob_store,
+                           progress=progress,
+                           scratch_dir=scratch_dir,
+                           digest_algorithms=digest_algorithms) as context:
+        try:
+            with traced("export.plan"):
+                log_export_plan(config, envars, context.stats)
+            progress("Export started")
+            with traced("export.download"):
+                outputs = downloader.download(identity=identity, wallet=wallet)
+            if archiver:
+                progress("Archiving bag")
+                with traced("export.archive", {"deriva.export.archiver": archiver}):
+                    outputs = archive_outputs(outputs,
+                                              archiver,
+                                              archive_policy,
+                                              stob(config["bag"].get("bag_idempotent", False)),
+                                              context.stats)
+                with traced("export.post_process"):
+                    outputs = post_process_outputs(downloader, post_processors, outputs, identity, wallet)
+            return outputs
+        finally:
+            if blob_store:
+                logger.info("Blob cache: %d hit(s) (%d bytes), %d miss(es) (%d bytes)" % (
+                    context.stats.get("blob_cache_hits", 0),
+                    context.stats.get("blob_cache_hit_bytes", 0),
+                    context.stats.get("blob_cache_misses", 0),
+                    context.stats.get("blob_cache_miss_bytes", 0)))
+                blob_store.prune()
+            log_deduplication_stats(context.stats)
+            if bag_config:
+                log_fixity_stats(context.stats)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            write_export_stats(base_dir, context.stats)
+
+
+def run_profiled_export(profile_path, **kwargs):
+    """Runs an export under the profiler, e.g. in an isolated child process, and writes its statistics to
+    profile_path."""
+    with profiled(profile_path):
+        return run_export(**kwargs)
@@ -0,0 +1,247 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Storage backends for published exports.
+
+Exports are always built in a local staging directory, because the downloader and bagging code need a file system to
+write to. When an export finishes (successfully or not) its staging directory, including the `.access`, `.log` and
+`.stats` metadata files, is published to the configured backend, which then serves all retrievals:
+
+  * `local`: the staging directory is the published export, i.e. the historical behavior.
+  * `posix`: the export is moved to a different (typically shared) file system path, so that any web node which mounts
+    that path can serve it.
+  * `s3`: the export is uploaded to an S3-compatible object store and the staging directory is removed. File downloads
+    are answered with a redirect to a presigned URL, so that payload bytes do not pass through the web tier.
+"""
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ExportStorage(object):
+    """Interface for export storage backends. Exports are addressed by an owner (the staging subdirectory of the
+    requesting client) and a key."""
+
+    is_local = False
+
+    def publish(self, owner, key, staging_dir):
+        raise NotImplementedError()
+
+    def exists(self, owner, key):
+        raise NotImplementedError()
+
+    def list_files(self, owner, key):
+        """Returns the names of the retrievable (non-metadata) files at the top level of an export."""
+        raise NotImplementedError()
+
+    def list_exports(self, owner):
+        """Returns a list of (key, creation timestamp) tuples for all of the exports of owner."""
+        raise NotImplementedError()
+
+    def read_metadata(self, owner, key, name, offset=0):
+        """Returns the content of a metadata file (e.g. ".access") as bytes, or None if it does not exist. A positive
+        offset skips that many bytes, and a negative offset returns (at most) that many bytes from its end."""
+        raise NotImplementedError()
+
+    def local_path(self, owner, key, filename=None):
+        """Returns a local file system path for an export (or a file within it), if the backend has one."""
+        return None
+
+    def get_download_url(self, owner, key, filename):
+        """Returns a URL which the client can be redirected to in order to download a file, if supported."""
+        return None
+
+    def delete(self, owner, key):
+        raise NotImplementedError()
+
+
+def _is_metadata(filename):
+    return filename.startswith(".")
+
+
+class LocalStorage(ExportStorage):
+
+    is_local = True
+
+    def __init__(self, base_path):
+        self.base_path = os.path.abspath(base_path)
+
+    def local_path(self, owner, key, filename=None):
+        path = os.path.join(self.base_path, owner, key)
+        return os.path.abspath(os.path.join(path, filename) if filename else path)
+
+    def publish(self, owner, key, staging_dir):
+        target = self.local_path(owner, key)
+        if os.path.abspath(staging_dir) == target:
+            return
+        parent = os.path.dirname(target)
+        os.makedirs(parent, exist_ok=True)
+        source = staging_dir
+        if os.stat(staging_dir).st_dev != os.stat(parent).st_dev:
+            # the export was built on a different file system (e.g. a scratch volume): copy it next to its target
+            # first, so that it only becomes visible, by rename, once it is complete
+            source = os.path.join(parent, ".%s.%d.incoming" % (key, os.getpid()))
+            shutil.copytree(staging_dir, source)
+        previous = None
+        if os.path.isdir(target):
+            # republishing under the same key: swap the new export in, so it is never missing for long
+            previous = os.path.join(parent, ".%s.%d" % (key, os.getpid()))
+            os.rename(target, previous)
+        os.rename(source, target)
+        if previous:
+            shutil.rmtree(previous, ignore_errors=True)
+        if source != staging_dir:
+            # only removed once published, so that the export (and its log) can always be found in one place or other
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def exists(self, owner, key):
+        return os.path.isdir(self.local_path(owner, key))
+
+    def list_files(self, owner, key):
+        path = self.local_path(owner, key)
+        return sorted(f for f in os.listdir(path) if not _is_metadata(f) and os.path.isfile(os.path.join(path, f)))
+
+    def list_exports(self, owner):
+        path = os.path.join(self.base_path, owner)
+        if not os.path.isdir(path):
+            return []
+        exports = list()
+        for entry in os.scandir(path):
+            if entry.is_dir() and not _is_metadata(entry.name):
+                exports.append((entry.name, entry.stat().st_ctime))
+        return exports
+
+    def read_metadata(self, owner, key, name, offset=0):
+        path = self.local_path(owner, key, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as mf:
+            if offset < 0:
+                mf.seek(max(0, os.fstat(mf.fileno()).st_size + offset))
+            else:
+                mf.seek(offset)
+            return mf.read()
+
+    def delete(self, owner, key):
+        path = self.local_path(owner, key)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+class S3Storage(ExportStorage):
+
+    def __init__(self, bucket, prefix="export", endpoint_url=None, region_name=None, aws_access_key_id=None,
+                 aws_secret_access_key=None, presigned_url_expiration_secs=3600):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("The 's3' export storage backend requires the boto3 package.")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.expiration = int(presigned_url_expiration_secs)
+        self.client = boto3.client("s3",
+                                   endpoint_url=endpoint_url,
+                                   region_name=region_name,
+                                   aws_access_key_id=aws_access_key_id,
+                                   aws_secret_access_key=aws_secret_access_key)
+
+    def object_key(self, owner, key, filename=""):
+        return "/".join([p for p in (self.prefix, owner, key) if p] + [filename])
+
+    def publish(self, owner, key, staging_dir):
+        uploaded = set()
+        for dirname, dirnames, filenames in os.walk(staging_dir):
+            for filename in filenames:
+                path = os.path.join(dirname, filename)
+                rel_path = os.path.relpath(path, staging_dir).replace(os.path.sep, "/")
+                object_key = self.object_key(owner, key, rel_path)
+                self.client.upload_file(path, self.bucket, object_key)
+                uploaded.add(object_key)
+        # when republishing under the same key, remove any objects left over from the previous export
+        stale = [{"Key": o["Key"]} for o in self._list(self.object_key(owner, key)) if o["Key"] not in uploaded]
+        for i in range(0, len(stale), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": stale[i:i + 1000]})
+        shutil.rmtree(staging_dir)
+
+    def _list(self, prefix, delimiter=None):
+        paginator = self.client.get_paginator("list_objects_v2")
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        if delimiter:
+            kwargs["Delimiter"] = delimiter
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get("Contents", []):
+                yield obj
+
+    def exists(self, owner, key):
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.object_key(owner, key), MaxKeys=1)
+        return response.get("KeyCount", 0) > 0
+
+    def list_files(self, owner, key):
+        prefix = self.object_key(owner, key)
+        return sorted(o["Key"][len(prefix):] for o in self._list(prefix, delimiter="/")
+                      if not _is_metadata(o["Key"][len(prefix):]))
+
+    def list_exports(self, owner):
+        prefix = self.object_key(owner, "")
+        exports = dict()
+        for obj in self._list(prefix):
+            key = obj["Key"][len(prefix):].split("/", 1)[0]
+            created = obj["LastModified"].timestamp()
+            exports[key] = min(created, exports.get(key, created))
+        return list(exports.items())
+
+    def read_metadata(self, owner, key, name, offset=0):
+        from botocore.exceptions import ClientError
+        params = dict(Bucket=self.bucket, Key=self.object_key(owner, key, name))
+        if offset:
+            params["Range"] = "bytes=%d-" % offset if offset > 0 else "bytes=%d" % offset
+        try:
+            response = self.client.get_object(**params)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in ("NoSuchKey", "404"):
+                return None
+            if code == "InvalidRange":
+                return b""
+            raise
+        return response["Body"].read()
+
+    def get_download_url(self, owner, key, filename):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket,
+                    "Key": self.object_key(owner, key, filename),
+                    "ResponseContentDisposition": "attachment; filename=\"%s\"" % os.path.basename(filename)},
+            ExpiresIn=self.expiration)
+
+    def delete(self, owner, key):
+        objects = [{"Key": o["Key"]} for o in self._list(self.object_key(owner, key))]
+        for i in range(0, len(objects), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects[i:i + 1000]})
+
+
+def create_export_storage(config, default_path):
+    """Create a storage backend from the "storage" object of the export handler config."""
+    config = dict(config or {})
+    storage_type = config.pop("type", "local")
+    if storage_type == "local":
+        return LocalStorage(default_path)
+    if storage_type == "posix":
+        return LocalStorage(config["path"])
+    if storage_type == "s3":
+        return S3Storage(**config)
+    raise ValueError("Unknown export storage type: %s" % storage_type)
@@ -0,0 +1,74 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Limits on the long-lived responses of the export service: event streams, followed logs and long polls of logs.
+
+Each of these responses holds one of the few request threads of its service process for as long as it lasts, so a
+process only serves a limited number of them at a time, and each one ends after a limited time, after which the client
+reconnects. A stream which is refused a slot ends at once, and a long poll which is refused one does not wait.
+"""
+import threading
+from contextlib import contextmanager
+
+DEFAULT_STREAMS_CONFIG = {
+    "max_secs": 60,
+    "max_per_process": 2
+}
+
+
+def get_streams_config(config):
+    return dict(DEFAULT_STREAMS_CONFIG, **(config or {}))
+
+
+class StreamSlots(object):
+    """Counts the streaming responses of this process which are in progress."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def acquire(self, limit):
+        with self.lock:
+            if limit and self.active >= limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    @contextmanager
+    def held(self, limit):
+        """Holds a slot for the enclosed code, if one is free. Yields whether it is held."""
+        acquired = self.acquire(limit)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release()
+
+
+stream_slots = StreamSlots()
+
+
+def limited_stream(stream, limit, refused=None):
+    """Generates the items of stream while holding one of at most limit slots (0 is unlimited), or only the item
+    refused if no slot is free. A slot is only held once the response is actually being sent."""
+    with stream_slots.held(int(limit)) as acquired:
+        if acquired:
+            yield from stream
+        elif refused is not None:
+            yield refused
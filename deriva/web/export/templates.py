@@ -0,0 +1,244 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Named export templates managed on the server.
+
+A template is an export config kept in the file `<name>.json` of the templates directory, so that clients can request
+an export by name with a few parameters instead of sending the whole config. Each template is parsed, validated and
+prepared once per service process, and again only when its file changes. Request parameters are validated against the
+patterns declared by the template and passed to the export as environment variables, so they can be referenced in
+query paths (e.g. `{RID_urlencoded}`), output paths and bag names (but not URL-encoded in bag names). A template may
+also override some of the export handler settings, so that its exports can be tuned centrally.
+"""
+import os
+import re
+import copy
+import json
+import string
+import logging
+import threading
+from collections import OrderedDict
+from deriva.core import format_exception
+from ..core import DEFAULT_HANDLER_CONFIG_DIR, RestException, BadRequest, NotFound, InternalServerError
+from .api import parse_server, prepare_bag_config
+from .archive import get_archive_policy
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATES_PATH = os.path.join(DEFAULT_HANDLER_CONFIG_DIR, "export", "templates")
+
+TEMPLATE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+TEMPLATE_TYPES = ("bdbag", "file")
+
+PARAMETER_NAME_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+DEFAULT_PARAMETER_PATTERN = r"[A-Za-z0-9_.~-]+"
+
+# environment variables which are set by the service or by the downloader, and cannot be template parameters
+RESERVED_PARAMETERS = frozenset(["request_ip", "deriva_service_url", "hostname"])
+
+# the export handler settings which a template may override
+TEMPLATE_SETTINGS = frozenset(["allow_concurrent_export", "max_payload_size_mb", "timeout_secs", "enable_blob_cache",
+                               "blob_cache_max_size_mb", "bag_archive_policy", "isolation", "quiet_logging",
+                               "ttl_secs"])
+
+# the config values which are formatted with the export environment by the downloader
+FORMATTED_PARAMS = ("query_path", "output_path", "output_filename")
+
+
+class ExportTemplateError(ValueError):
+    pass
+
+
+def _placeholders(text):
+    names = set()
+    for _, field, _, _ in string.Formatter().parse(text):
+        if field:
+            names.add(re.split(r"[.\[]", field, 1)[0])
+    return names
+
+
+def _formatted_values(config):
+    bag = config.get("bag") or {}
+    if isinstance(bag.get("bag_name"), str):
+        yield bag["bag_name"]
+    for processor in (config.get("catalog") or {}).get("query_processors") or []:
+        params = processor.get("processor_params") or {}
+        for key in FORMATTED_PARAMS:
+            if isinstance(params.get(key), str):
+                yield params[key]
+
+
+class ExportTemplate(object):
+    """A validated export template. Its config is prepared as by a regular export request, so only a copy of it has
+    to be made for each export."""
+
+    def __init__(self, name, document, handler_config):
+        self.name = name
+        if not isinstance(document, dict):
+            raise ExportTemplateError("the template must be a JSON object")
+        self.type = document.get("type", "bdbag")
+        if self.type not in TEMPLATE_TYPES:
+            raise ExportTemplateError("unsupported export type: %s" % self.type)
+        self.description = document.get("description")
+
+        self.settings = document.get("settings") or {}
+        unknown = set(self.settings) - TEMPLATE_SETTINGS
+        if unknown:
+            raise ExportTemplateError("unsupported settings: %s" % ", ".join(sorted(unknown)))
+
+        self.parameters = OrderedDict()
+        for param, spec in (document.get("parameters") or {}).items():
+            if not PARAMETER_NAME_PATTERN.match(param) or param in RESERVED_PARAMETERS or \
+                    param.endswith("_urlencoded"):
+                raise ExportTemplateError("invalid parameter name: %s" % param)
+            spec = spec or {}
+            pattern = re.compile(spec.get("pattern", DEFAULT_PARAMETER_PATTERN))
+            default = spec.get("default")
+            if default is not None and not pattern.fullmatch(str(default)):
+                raise ExportTemplateError("the default value of parameter %s does not match its pattern" % param)
+            self.parameters[param] = (pattern, None if default is None else str(default))
+
+        config = document.get("config")
+        if not (isinstance(config, dict) and isinstance(config.get("catalog"), dict)):
+            raise ExportTemplateError("the template has no export config")
+        if "callback_url" in config:
+            raise ExportTemplateError("callback_url must be set by the export request")
+        self.server = parse_server(config["catalog"])
+        self.check_placeholders(config)
+        archive_policy = get_archive_policy(self.get_settings(handler_config).get("bag_archive_policy"))
+        try:
+            self.archiver, self.post_processors = prepare_bag_config(config, self.type == "file", archive_policy)
+        except RestException as e:
+            raise ExportTemplateError(format_exception(e))
+        self.config = config
+
+    def check_placeholders(self, config):
+        # the downloader formats the bag name with the plain environment, so only query parameters are URL-encoded
+        bag_name = (config.get("bag") or {}).get("bag_name")
+        if isinstance(bag_name, str):
+            encoded = [name for name in _placeholders(bag_name) if name.endswith("_urlencoded")]
+            if encoded:
+                raise ExportTemplateError("bag_name cannot reference URL-encoded parameters: %s" %
+                                          ", ".join(sorted(encoded)))
+        known = set(self.parameters) | RESERVED_PARAMETERS | set(config.get("env") or {})
+        for processor in config["catalog"].get("query_processors") or []:
+            if processor.get("processor") == "env":
+                query_keys = (processor.get("processor_params") or {}).get("query_keys")
+                if query_keys is None:
+                    return  # any column of the query result may be referenced
+                known.update(query_keys)
+        known.update(["%s_urlencoded" % name for name in known])
+        for value in _formatted_values(config):
+            unknown = _placeholders(value) - known
+            if unknown:
+                raise ExportTemplateError("undeclared parameters referenced: %s" % ", ".join(sorted(unknown)))
+
+    def get_settings(self, handler_config):
+        """Returns the export handler config, with the settings of this template applied."""
+        settings = dict(handler_config)
+        settings.update(self.settings)
+        return settings
+
+    def get_envars(self, parameters):
+        if not isinstance(parameters, dict):
+            raise BadRequest("The template parameters must be a JSON object.")
+        unknown = set(parameters) - set(self.parameters)
+        if unknown:
+            raise BadRequest("Unknown parameters for export template \"%s\": %s" %
+                             (self.name, ", ".join(sorted(unknown))))
+        envars = dict()
+        for param, (pattern, default) in self.parameters.items():
+            value = parameters.get(param, default)
+            if value is None:
+                raise BadRequest("The export template \"%s\" requires the parameter \"%s\"." % (self.name, param))
+            value = str(value)
+            # a path segment of only dots would let a bag name or output path refer to a parent directory
+            if not pattern.fullmatch(value) or any(segment and not segment.strip(".") for segment in value.split("/")):
+                raise BadRequest("Invalid value for parameter \"%s\" of export template \"%s\"." % (param, self.name))
+            envars[param] = value
+        return envars
+
+    def create_config(self):
+        return copy.deepcopy(self.config)
+
+
+class ExportTemplateCache(object):
+    """Per-process cache of loaded templates, validated against the mtime and size of the template file and the mtime
+    of the export handler config file (which supplies the default settings)."""
+
+    def __init__(self):
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+    def get(self, file_path, name, handler_config, handler_mtime=None):
+        st = os.stat(file_path)
+        version = (st.st_mtime_ns, st.st_size, handler_mtime)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+        try:
+            with open(file_path) as tf:
+                template = ExportTemplate(name, json.load(tf), handler_config)
+        except (ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+            template = ExportTemplateError("Invalid export template \"%s\": %s" % (name, format_exception(e)))
+            logger.error(str(template))
+        with self.lock:
+            self.entries[file_path] = (version, template)
+        return template
+
+
+_template_cache = ExportTemplateCache()
+
+
+def get_export_template(name, handler_config, handler_config_file=None):
+    """Returns the named export template.
+
+    :raise NotFound: if there is no such template
+    :raise InternalServerError: if the template is invalid
+    """
+    templates_path = handler_config.get("templates_path") or DEFAULT_TEMPLATES_PATH
+    if not (isinstance(name, str) and TEMPLATE_NAME_PATTERN.match(name)):
+        raise BadRequest("Invalid export template name.")
+    file_path = os.path.join(templates_path, name + ".json")
+    handler_mtime = None
+    if handler_config_file and os.path.isfile(handler_config_file):
+        handler_mtime = os.path.getmtime(handler_config_file)
+    try:
+        template = _template_cache.get(file_path, name, handler_config, handler_mtime)
+    except FileNotFoundError:
+        raise NotFound("There is no export template named \"%s\"." % name)
+    if isinstance(template, ExportTemplateError):
+        raise InternalServerError(str(template))
+    return template
+
+
+def resolve_export_request(request, export_type, handler_config, handler_config_file=None):
+    """Resolves the body of an export request, which is either a complete export config, or the name and parameters of
+    an export template, as in `{"template": "<name>", "parameters": {...}}`.
+
+    :return: a tuple of the export config, the export handler settings, the template (or None), and the environment
+        variables set by the template parameters
+    """
+    if not (isinstance(request, dict) and "template" in request and "catalog" not in request):
+        return request, handler_config, None, {}
+    template = get_export_template(request["template"], handler_config, handler_config_file)
+    if template.type != export_type:
+        raise BadRequest("The export template \"%s\" is a %s export." % (template.name, template.type))
+    envars = template.get_envars(request.get("parameters") or {})
+    config = template.create_config()
+    if request.get("callback_url"):
+        config["callback_url"] = request["callback_url"]
+    return config, template.get_settings(handler_config), template, envars
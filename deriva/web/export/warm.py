@@ -0,0 +1,345 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Pre-generated ("warm") exports.
+
+An administrator may configure a set of export configs, typically for a few popular datasets, which a background
+scheduler rebuilds during off-peak hours and publishes under stable keys. Each build is pinned to the catalog snapshot
+that was current when it started. A live export request whose config matches a warm export, from a client permitted by
+the warm export's ACL, is answered with the pre-built export for as long as the catalog snapshot is unchanged.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import datetime
+import threading
+from deriva.core import ErmrestCatalog, get_credential, format_exception, stob
+from ..core import AUTHENTICATION, get_client_attribute_ids, read_handler_config
+from ..state import get_shared_state
+from .api import parse_server, prepare_bag_config, write_access_descriptor, configure_logging, get_export_storage, \
+    get_scratch_path, HANDLER_CONFIG_FILE, DEFAULT_HANDLER_CONFIG
+from .archive import get_archive_policy
+from .events import ProgressReporter, delete_events
+from .worker import run_isolated, is_isolation_available, DEFAULT_ISOLATION_CONFIG
+
+logger = logging.getLogger(__name__)
+
+WARM_OWNER = "warm"
+WARM_KEY_PREFIX = "warm-"
+WARM_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]*$")
+WARM_EXPORT_TYPES = ("bdbag", "file")
+
+DEFAULT_WARM_EXPORTS_CONFIG = {
+    "enabled": False,
+    "off_peak_hours": None,
+    "check_interval_secs": 300,
+    "exports": []
+}
+DEFAULT_REFRESH_INTERVAL_SECS = 86400
+
+# request parameters which do not affect the content of an export
+VOLATILE_CONFIG_KEYS = ("callback_url",)
+VOLATILE_CATALOG_KEYS = ("token", "oauth2_token", "username", "password")
+
+WARM_EXPORTS_DDL = """
+CREATE TABLE IF NOT EXISTS warm_exports (
+  name TEXT PRIMARY KEY,
+  config_digest TEXT,
+  snaptime TEXT,
+  built REAL,
+  stale INTEGER NOT NULL DEFAULT 0,
+  claimed_until REAL NOT NULL DEFAULT 0,
+  outputs TEXT,
+  detail TEXT
+);
+"""
+
+_registered = False
+
+
+def _state():
+    global _registered
+    state = get_shared_state()
+    if not _registered:
+        state.register_schema(WARM_EXPORTS_DDL)
+        _registered = True
+    return state
+
+
+def warm_key(name):
+    return WARM_KEY_PREFIX + name
+
+
+def is_warm_key(key):
+    return key.startswith(WARM_KEY_PREFIX)
+
+
+def config_digest(export_type, config):
+    """A digest of the content-determining parts of an export config, used to match requests to warm exports."""
+    config = json.loads(json.dumps(config))
+    for key in VOLATILE_CONFIG_KEYS:
+        config.pop(key, None)
+    catalog = config.get("catalog")
+    if isinstance(catalog, dict):
+        for key in VOLATILE_CATALOG_KEYS:
+            catalog.pop(key, None)
+    return hashlib.sha256(json.dumps([export_type, config], sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def get_warm_config(config):
+    warm_config = DEFAULT_WARM_EXPORTS_CONFIG.copy()
+    warm_config.update(config or {})
+    return warm_config
+
+
+def get_warm_exports(warm_config):
+    """Returns a dictionary of the valid warm export definitions, keyed by name."""
+    exports = dict()
+    for entry in warm_config.get("exports") or []:
+        name = entry.get("name") or ""
+        if not (WARM_NAME_PATTERN.match(name) and entry.get("type") in WARM_EXPORT_TYPES and entry.get("config")):
+            logger.warning("Ignoring invalid warm export definition: %s" % (name or "<unnamed>"))
+            continue
+        exports[name] = entry
+    return exports
+
+
+def is_off_peak(hours, now=None):
+    """Is the local time within the [start, end) hour window? The window may span midnight."""
+    if not hours:
+        return True
+    start, end = int(hours[0]) % 24, int(hours[1]) % 24
+    hour = (now or datetime.datetime.now()).hour
+    if start == end:
+        return True
+    return start <= hour < end if start < end else (hour >= start or hour < end)
+
+
+def get_service_credentials(server):
+    if server["protocol"] != "https":
+        return None
+    try:
+        return get_credential(server["host"])
+    except Exception as e:
+        logger.warning("Unable to get service credentials for %s: %s" % (server["host"], format_exception(e)))
+        return None
+
+
+def get_catalog_snaptime(server, credentials=None):
+    catalog = ErmrestCatalog(server["protocol"], server["host"], server["catalog_id"], credentials, caching=False)
+    return catalog.latest_snapshot().snaptime
+
+
+def get_warm_state(name):
+    row = _state().query_one("SELECT * FROM warm_exports WHERE name = ?", (name,))
+    return dict(row) if row is not None else None
+
+
+def mark_warm_export_stale(name):
+    _state().execute("UPDATE warm_exports SET stale = 1 WHERE name = ?", (name,))
+
+
+def claim_warm_build(name, digest, refresh_interval_secs, claim_secs):
+    """Claim the (re)build of a warm export, if it is due and no other process is building it."""
+    now = time.time()
+    with _state().transaction() as conn:
+        row = conn.execute("SELECT * FROM warm_exports WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            if row["claimed_until"] > now:
+                return False
+            if row["built"] and not row["stale"] and row["config_digest"] == digest and \
+                    row["built"] + refresh_interval_secs > now:
+                return False
+        conn.execute("INSERT OR IGNORE INTO warm_exports (name) VALUES (?)", (name,))
+        conn.execute("UPDATE warm_exports SET claimed_until = ? WHERE name = ?", (now + claim_secs, name))
+        return True
+
+
+def _finish_build(name, **columns):
+    columns["claimed_until"] = 0
+    assignments = ", ".join("%s = ?" % column for column in columns)
+    _state().execute("UPDATE warm_exports SET %s WHERE name = ?" % assignments, tuple(columns.values()) + (name,))
+
+
+def build_warm_export(name, entry, handler_config):
+    """Build a warm export and publish it under its stable key, unless the catalog has not changed since the last
+    build."""
+    from deriva.transfer import GenericDownloader
+    from .runner import run_export
+
+    storage = get_export_storage(handler_config.get("storage"))
+    key = warm_key(name)
+    config = json.loads(json.dumps(entry["config"]))
+    digest = config_digest(entry["type"], config)
+    server = parse_server(config["catalog"])
+    credentials = get_service_credentials(server)
+    snaptime = get_catalog_snaptime(server, credentials)
+
+    state = get_warm_state(name)
+    if state and state["built"] and state["config_digest"] == digest and state["snaptime"] == snaptime and \
+            storage.exists(WARM_OWNER, key):
+        logger.info("Warm export [%s] is up to date with catalog snapshot %s" % (name, snaptime))
+        _finish_build(name, built=time.time(), stale=0)
+        return
+
+    if "@" not in server["catalog_id"]:
+        server["catalog_id"] = "%s@%s" % (server["catalog_id"], snaptime)
+    # warm exports never expire, so the events of each build are deleted when it is replaced
+    delete_events([key])
+    staging_dir = os.path.join(get_scratch_path(handler_config.get("scratch_path")), ".warm", str(uuid.uuid4()))
+    os.makedirs(staging_dir)
+    log_handler = configure_logging(logging.INFO, log_path=os.path.join(staging_dir, ".log"))
+    try:
+        logger.info("Building warm export [%s] from catalog snapshot %s" % (name, snaptime))
+        archive_policy = get_archive_policy(handler_config.get("bag_archive_policy"))
+        archiver, post_processors = prepare_bag_config(config, entry["type"] == "file", archive_policy)
+        write_access_descriptor(staging_dir, entry.get("acl") or [])
+        export_args = dict(server=server,
+                           base_dir=staging_dir,
+                           envars={},
+                           config=config,
+                           credentials=credentials,
+                           identity=None,
+                           wallet=None,
+                           archiver=archiver,
+                           archive_policy=archive_policy,
+                           post_processors=post_processors,
+                           allow_anonymous_download=stob(handler_config.get("allow_anonymous_download", False)),
+                           max_payload_size_mb=handler_config.get("max_payload_size_mb"),
+                           timeout=handler_config.get("timeout_secs"),
+                           enable_blob_cache=stob(handler_config.get("enable_blob_cache", False)),
+                           blob_cache_max_size_mb=handler_config.get("blob_cache_max_size_mb", 0),
+                           progress=ProgressReporter(key),
+                           dcctx_cid="export/warm")
+        isolation = handler_config.get("isolation") or DEFAULT_ISOLATION_CONFIG
+        if stob(isolation.get("enabled", True)) and is_isolation_available():
+            outputs = run_isolated(run_export, kwargs=export_args, limits=isolation,
+                                   timeout=handler_config.get("timeout_secs"),
+                                   log_path=log_handler.baseFilename if log_handler else None,
+                                   log_level=logging.INFO)
+        else:
+            outputs = run_export(**export_args)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    finally:
+        if log_handler:
+            logging.getLogger().removeHandler(log_handler)
+            log_handler.close()
+
+    # the local paths refer to the staging directory, only the remaining output metadata is kept
+    outputs = {output: {k: v for k, v in (metadata or {}).items() if k != GenericDownloader.LOCAL_PATH_KEY}
+               for output, metadata in outputs.items()}
+    storage.publish(WARM_OWNER, key, staging_dir)
+    _finish_build(name, config_digest=digest, snaptime=snaptime, built=time.time(), stale=0,
+                  outputs=json.dumps(outputs, default=str), detail=None)
+    logger.info("Published warm export [%s] as %s" % (name, key))
+
+
+def find_warm_export(export_type, config, handler_config):
+    """Find a current, pre-built warm export matching an export request, which the client is permitted to access.
+
+    :return: a dictionary with the "key" and "outputs" of the warm export, or None
+    """
+    warm_config = get_warm_config(handler_config.get("warm_exports"))
+    if not (stob(warm_config["enabled"]) and warm_config["exports"]):
+        return None
+    try:
+        digest = config_digest(export_type, config)
+    except (TypeError, ValueError):
+        return None
+    for name, entry in get_warm_exports(warm_config).items():
+        if entry["type"] != export_type or config_digest(entry["type"], entry["config"]) != digest:
+            continue
+        state = get_warm_state(name)
+        if not state or not state["built"] or state["stale"] or state["config_digest"] != digest:
+            return None
+        acl = frozenset(entry.get("acl") or [])
+        if AUTHENTICATION and "*" not in acl and acl.isdisjoint(get_client_attribute_ids()):
+            return None
+        try:
+            server = parse_server(config["catalog"])
+            snaptime = get_catalog_snaptime(server, get_service_credentials(server))
+        except Exception as e:
+            logger.warning("Unable to check the catalog snapshot of warm export [%s]: %s" % (name, format_exception(e)))
+            return None
+        if snaptime != state["snaptime"]:
+            # the catalog has changed, so rebuild at the next opportunity
+            mark_warm_export_stale(name)
+            return None
+        key = warm_key(name)
+        if not get_export_storage(handler_config.get("storage")).exists(WARM_OWNER, key):
+            return None
+        return {"key": key, "outputs": json.loads(state["outputs"] or "{}")}
+    return None
+
+
+def load_handler_config():
+    config = DEFAULT_HANDLER_CONFIG.copy()
+    if os.path.isfile(HANDLER_CONFIG_FILE):
+        config.update(read_handler_config(HANDLER_CONFIG_FILE))
+    return config
+
+
+def run_warm_scheduler():
+    """Rebuild due warm exports, while warm exports are enabled. The handler config is re-read on every pass."""
+    while True:
+        handler_config = load_handler_config()
+        warm_config = get_warm_config(handler_config.get("warm_exports"))
+        if not stob(warm_config["enabled"]):
+            return
+        if is_off_peak(warm_config.get("off_peak_hours")):
+            claim_secs = 2 * float(handler_config.get("timeout_secs") or 3600)
+            for name, entry in get_warm_exports(warm_config).items():
+                refresh = float(entry.get("refresh_interval_secs", DEFAULT_REFRESH_INTERVAL_SECS))
+                if not claim_warm_build(name, config_digest(entry["type"], entry["config"]), refresh, claim_secs):
+                    continue
+                try:
+                    build_warm_export(name, entry, handler_config)
+                except Exception as e:
+                    logger.warning("Unable to build warm export [%s]: %s" % (name, format_exception(e)))
+                    _finish_build(name, detail=format_exception(e))
+        time.sleep(float(warm_config.get("check_interval_secs") or DEFAULT_WARM_EXPORTS_CONFIG["check_interval_secs"]))
+
+
+_scheduler_thread = None
+_scheduler_lock = threading.Lock()
+
+
+def _scheduler_main():
+    global _scheduler_thread
+    try:
+        run_warm_scheduler()
+    except Exception as e:
+        logger.warning("Warm export scheduler error: %s" % format_exception(e))
+    finally:
+        with _scheduler_lock:
+            _scheduler_thread = None
+
+
+def start_warm_scheduler(warm_config):
+    """Start the warm export scheduler thread of this process, if warm exports are enabled."""
+    global _scheduler_thread
+    if not (warm_config and stob(warm_config.get("enabled", False))):
+        return
+    with _scheduler_lock:
+        if _scheduler_thread is None:
+            _scheduler_thread = threading.Thread(target=_scheduler_main, name="export-warm-scheduler", daemon=True)
+            _scheduler_thread.start()
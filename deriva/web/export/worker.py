@@ -0,0 +1,185 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Isolated execution of exports in child processes.
+
+An export runs in a child process, optionally constrained by resource limits on address space, CPU time and open
+files. Whatever memory the export uses is returned to the system when the child exits, instead of accumulating in a
+long-lived server process, and the parent can kill the child outright when it exceeds its wall clock timeout or when
+the export is cancelled.
+
+The web server process is multithreaded, and a child forked from it would inherit any lock which another thread held
+at the time, such as a logging or sqlite lock, and could deadlock on it. Children are therefore started by a fork
+server, a single-threaded process which has already imported the export machinery, or are spawned where there is no
+fork server. The target and arguments of a child are pickled, and a child writes its own log.
+"""
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from deriva.core import format_exception
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ISOLATION_CONFIG = {
+    "enabled": True,
+    "max_memory_mb": 0,
+    "max_cpu_secs": 0,
+    "max_open_files": 0
+}
+
+KILL_GRACE_SECS = 5
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# the start methods of children, in order of preference, and the modules that the fork server imports up front
+ISOLATION_START_METHODS = ("forkserver", "spawn")
+FORKSERVER_PRELOAD = ["deriva.web.export.runner"]
+
+_context = None
+_context_lock = threading.Lock()
+
+
+class ExportCancelledError(Exception):
+    pass
+
+
+class ExportProcessError(Exception):
+    pass
+
+
+def is_isolation_available():
+    return any(method in multiprocessing.get_all_start_methods() for method in ISOLATION_START_METHODS)
+
+
+def get_isolation_context():
+    global _context
+    with _context_lock:
+        if _context is None:
+            available = multiprocessing.get_all_start_methods()
+            method = [method for method in ISOLATION_START_METHODS if method in available][0]
+            _context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                _context.set_forkserver_preload(FORKSERVER_PRELOAD)
+        return _context
+
+
+def set_resource_limits(limits):
+    if resource is None:
+        return
+    for rlimit, name, scale in ((resource.RLIMIT_AS, "max_memory_mb", 1024 * 1024),
+                                (resource.RLIMIT_CPU, "max_cpu_secs", 1),
+                                (resource.RLIMIT_NOFILE, "max_open_files", 1)):
+        value = int(limits.get(name) or 0) * scale
+        if value <= 0:
+            continue
+        soft, hard = resource.getrlimit(rlimit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(rlimit, (value, hard))
+
+
+def configure_child_logging(log_path, log_level):
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    if log_path:
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(handler)
+
+
+def _run_child(conn, target, args, kwargs, limits, log_path, log_level):
+    try:
+        configure_child_logging(log_path, log_level)
+        set_resource_limits(limits)
+        result = ("ok", target(*args, **kwargs))
+    except BaseException as e:
+        result = ("error", e)
+    try:
+        try:
+            conn.send(result)
+        except Exception as e:
+            # the result or exception could not be pickled, so send back a description of it instead
+            cause = result[1] if result[0] == "error" else e
+            conn.send(("error", ExportProcessError(format_exception(cause))))
+    finally:
+        conn.close()
+
+
+def _describe_exit(exitcode):
+    if exitcode is not None and exitcode < 0:
+        signum = -exitcode
+        if signum == getattr(signal, "SIGXCPU", None):
+            return "the CPU time limit was exceeded"
+        if signum == signal.SIGKILL:
+            return "it was killed, possibly because it ran out of memory"
+        return "it received signal %d" % signum
+    return "it exited with status %s" % exitcode
+
+
+def _stop(process):
+    process.terminate()
+    process.join(KILL_GRACE_SECS)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+def run_isolated(target, args=(), kwargs=None, limits=None, timeout=None, is_cancelled=None, poll_interval=1.0,
+                 log_path=None, log_level=logging.INFO):
+    """Run target(*args, **kwargs) in a child process and return its result, or raise the exception that it raised.
+    The target must be a module-level function, and its arguments must be picklable.
+
+    The child is killed if it is still running after timeout seconds, or as soon as is_cancelled() returns True. The
+    is_cancelled callable is invoked in the parent process once every poll_interval seconds. The child logs records of
+    log_level and above to log_path, if it is given.
+    """
+    ctx = get_isolation_context()
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_child,
+                          args=(writer, target, args, kwargs or {}, limits or {}, log_path, log_level),
+                          name="deriva-web-export")
+    process.start()
+    writer.close()
+    deadline = time.monotonic() + float(timeout) if timeout else None
+    try:
+        while True:
+            if reader.poll(poll_interval):
+                try:
+                    status, value = reader.recv()
+                except EOFError:
+                    process.join()
+                    raise ExportProcessError("The export process ended unexpectedly because %s." %
+                                             _describe_exit(process.exitcode))
+                process.join()
+                if status == "error":
+                    raise value
+                return value
+            if deadline and time.monotonic() > deadline:
+                _stop(process)
+                from deriva.transfer.download import DerivaDownloadTimeoutError
+                raise DerivaDownloadTimeoutError("Timeout (%s seconds) waiting for the export to complete." % timeout)
+            if is_cancelled and is_cancelled():
+                _stop(process)
+                raise ExportCancelledError("The export was cancelled.")
+    finally:
+        if process.is_alive():
+            _stop(process)
+        reader.close()
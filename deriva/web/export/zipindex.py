@@ -0,0 +1,180 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Random access to the members of zip archives.
+
+The central directory of an archive is read once and kept in a bounded per-process cache, validated against the
+modification time and size of the archive file, so serving a member costs one read of its local header followed by a
+read of its data. Stored members are read as-is, and deflated members can be sent without decompressing them at all,
+wrapped in a gzip container built from the CRC and size in the central directory.
+"""
+import os
+import zlib
+import struct
+import datetime
+import threading
+from collections import OrderedDict
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+# the fixed part of a local file header, see section 4.3.7 of the zip APPNOTE
+LOCAL_HEADER_STRUCT = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+LOCAL_HEADER_NAME_LENGTH = 10
+LOCAL_HEADER_EXTRA_LENGTH = 11
+
+COMPRESSION_NAMES = {ZIP_STORED: "stored", ZIP_DEFLATED: "deflated", 12: "bzip2", 14: "lzma", 93: "zstd"}
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class ZipMember(object):
+
+    def __init__(self, info):
+        self.name = info.filename
+        self.header_offset = info.header_offset
+        self.compress_type = info.compress_type
+        self.compress_size = info.compress_size
+        self.file_size = info.file_size
+        self.crc = info.CRC
+        self.date_time = info.date_time
+        self.encrypted = bool(info.flag_bits & 0x1)
+        self.is_dir = info.is_dir()
+        self.data_offset = None
+
+    def describe(self):
+        return OrderedDict([("name", self.name),
+                            ("size", self.file_size),
+                            ("compressed_size", self.compress_size),
+                            ("compression", COMPRESSION_NAMES.get(self.compress_type, str(self.compress_type))),
+                            ("crc32", "%08x" % self.crc),
+                            ("modified", datetime.datetime(*self.date_time).isoformat())])
+
+
+class ZipIndex(object):
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with ZipFile(file_path) as zf:
+            self.members = OrderedDict((info.filename, ZipMember(info)) for info in zf.infolist())
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        return self.members.get(name)
+
+    def list(self, prefix=None):
+        return [member for name, member in self.members.items() if not prefix or name.startswith(prefix)]
+
+    def data_offset(self, member):
+        """Returns the archive offset of the member data, which follows its variable length local header."""
+        if member.data_offset is None:
+            with open(self.file_path, "rb") as f:
+                f.seek(member.header_offset)
+                header = LOCAL_HEADER_STRUCT.unpack(f.read(LOCAL_HEADER_STRUCT.size))
+            if header[0] != LOCAL_HEADER_SIGNATURE:
+                raise ValueError("Bad local file header for zip member %s" % member.name)
+            with self.lock:
+                member.data_offset = member.header_offset + LOCAL_HEADER_STRUCT.size + \
+                    header[LOCAL_HEADER_NAME_LENGTH] + header[LOCAL_HEADER_EXTRA_LENGTH]
+        return member.data_offset
+
+    def read_raw(self, member, offset=0, length=None):
+        """Yields the member data as it is stored in the archive, i.e. compressed unless the member is stored."""
+        start = self.data_offset(member) + offset
+        remaining = member.compress_size - offset if length is None else min(length, member.compress_size - offset)
+        with open(self.file_path, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                data = f.read(min(READ_CHUNK_SIZE, remaining))
+                if not data:
+                    raise ValueError("Zip member %s is truncated" % member.name)
+                remaining -= len(data)
+                yield data
+
+    def read(self, member, offset=0, length=None):
+        """Yields length bytes of the uncompressed member content, starting at offset."""
+        if member.compress_type == ZIP_STORED:
+            yield from self.read_raw(member, offset, length)
+            return
+        remaining = member.file_size - offset if length is None else length
+        for data in self._decompress(member):
+            if offset >= len(data):
+                offset -= len(data)
+                continue
+            data = data[offset:offset + remaining]
+            offset = 0
+            remaining -= len(data)
+            yield data
+            if remaining <= 0:
+                break
+
+    def _decompress(self, member):
+        if member.compress_type == ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            for data in self.read_raw(member):
+                data = decompressor.decompress(data)
+                if data:
+                    yield data
+            yield decompressor.flush()
+            return
+        # other compression methods are rare in bags, so let zipfile deal with them
+        with ZipFile(self.file_path) as zf, zf.open(member.name) as mf:
+            while True:
+                data = mf.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def read_gzip(self, member):
+        """Yields a deflated member as a gzip stream, without decompressing it."""
+        mtime = int(datetime.datetime(*member.date_time).timestamp())
+        yield b"\x1f\x8b\x08\x00" + struct.pack("<L", mtime) + b"\x00\xff"
+        yield from self.read_raw(member)
+        yield struct.pack("<2L", member.crc, member.file_size & 0xffffffff)
+
+    @staticmethod
+    def gzip_size(member):
+        return 10 + member.compress_size + 8
+
+
+class ZipIndexCache(object):
+    """Bounded per-process cache of zip archive indexes, validated against the archive mtime and size."""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        st = os.stat(file_path)
+        version = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(file_path)
+                return entry[1]
+        index = ZipIndex(file_path)
+        with self.lock:
+            self.entries[file_path] = (version, index)
+            self.entries.move_to_end(file_path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return index
+
+
+_zip_index_cache = ZipIndexCache()
+
+
+def get_zip_index(file_path):
+    return _zip_index_cache.get(file_path)
@@ -0,0 +1,154 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""On-demand profiling of single service requests.
+
+When profiling is enabled, a request made by a member of one of the admin groups with the profiling request header
+is run under cProfile, and the statistics are written to the profiles directory in the pstats format, which is read
+by `pstats`, `snakeviz`, `gprof2dot` and `flameprof`, among others. An export which runs in an isolated child process
+is profiled in that process instead, and its statistics are written to a second file. When profiling is disabled, a
+request only costs the check of a module attribute.
+"""
+import io
+import os
+import re
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from deriva.core import stob, format_exception
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILING_CONFIG = {
+    "enabled": False,
+    "admin_groups": [],
+    "header": "Deriva-Profile",
+    "path": None,
+    "max_profiles": 100
+}
+
+PROFILE_EXTENSION = ".prof"
+EXPORT_PROFILE_SUFFIX = "-export"
+PROFILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+PROFILE_SORT_KEYS = frozenset(key.value for key in pstats.SortKey)
+
+# a process can only run one profiler at a time (on Python 3.12 and later, profilers share one monitoring tool slot)
+_profiler_lock = threading.Lock()
+
+
+class RequestProfiler(object):
+
+    def __init__(self, config, default_path):
+        config = dict(DEFAULT_PROFILING_CONFIG, **(config or {}))
+        self.admin_groups = list(config["admin_groups"] or [])
+        self.enabled = stob(config["enabled"]) and bool(self.admin_groups)
+        self.header = config["header"]
+        self.path = os.path.abspath(config["path"] or default_path)
+        self.max_profiles = int(config["max_profiles"])
+
+    def is_requested(self, headers):
+        return self.enabled and self.header in headers
+
+    def start(self):
+        """Starts profiling the current thread. Returns the profiler, or None if another request is being profiled."""
+        if not _profiler_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            _profiler_lock.release()
+            return None
+        return profile
+
+    def stop(self, profile, profile_id):
+        profile.disable()
+        _profiler_lock.release()
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            profile.dump_stats(self.get_profile_path(profile_id))
+            self.prune()
+        except Exception as e:
+            logger.warning("Unable to write request profile %s: %s" % (profile_id, format_exception(e)))
+
+    def get_profile_path(self, profile_id, suffix=""):
+        if not PROFILE_ID_PATTERN.match(profile_id + suffix):
+            raise ValueError("Invalid profile id: %s" % profile_id)
+        return os.path.join(self.path, profile_id + suffix + PROFILE_EXTENSION)
+
+    def list_profiles(self):
+        """Returns a list of (profile id, size, modified time) tuples, most recent first."""
+        if not os.path.isdir(self.path):
+            return []
+        profiles = list()
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith(PROFILE_EXTENSION):
+                st = entry.stat()
+                profiles.append((entry.name[:-len(PROFILE_EXTENSION)], st.st_size, st.st_mtime))
+        return sorted(profiles, key=lambda p: p[2], reverse=True)
+
+    def prune(self):
+        for profile_id, size, mtime in self.list_profiles()[self.max_profiles:]:
+            try:
+                os.remove(os.path.join(self.path, profile_id + PROFILE_EXTENSION))
+            except OSError:
+                pass
+
+
+@contextmanager
+def paused(profile):
+    """Suspends a request profiler, e.g. while the request waits for a child process which profiles itself."""
+    if profile is None:
+        yield
+        return
+    profile.disable()
+    try:
+        yield
+    finally:
+        profile.enable()
+
+
+@contextmanager
+def profiled(profile_path):
+    """Profiles the enclosed code, if a path for its statistics is given."""
+    if not profile_path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        try:
+            os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+            profile.dump_stats(profile_path)
+        except Exception as e:
+            logger.warning("Unable to write profile %s: %s" % (profile_path, format_exception(e)))
+
+
+def format_profile(profile_path, sort="cumulative", limit=100):
+    """Renders the statistics of a profile as a text report."""
+    output = io.StringIO()
+    stats = pstats.Stats(profile_path, stream=output)
+    stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+def new_profile_id(request_guid):
+    return "%s-%s" % (time.strftime("%Y%m%dT%H%M%S"), re.sub(r"[^A-Za-z0-9]", "", request_guid))
@@ -0,0 +1,159 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Token bucket rate limiting of service requests.
+
+A limit is a bucket holding up to `burst` tokens, which refills continuously at `rate_per_min` tokens per minute. A
+request takes one token from every bucket that applies to it, and is rejected if any of them is empty. Buckets are
+kept in the shared state database, so a limit holds across all service processes, and checking a request costs one
+short transaction on a local sqlite file.
+"""
+import time
+from deriva.core import stob
+from .state import get_shared_state
+
+DEFAULT_RATE_LIMIT_CONFIG = {
+    "enabled": False,
+    "exempt_groups": [],
+    "routes": [
+        {
+            "name": "export",
+            "paths": ["/export/"],
+            "methods": ["POST"],
+            "identity": {"rate_per_min": 30, "burst": 10},
+            "anonymous": {"rate_per_min": 10, "burst": 5}
+        },
+        {
+            "name": "transform",
+            "paths": ["/transform/"],
+            "methods": ["GET"],
+            "identity": {"rate_per_min": 120, "burst": 30},
+            "anonymous": {"rate_per_min": 30, "burst": 10}
+        }
+    ]
+}
+
+# the scopes of a route's limits: one bucket per authenticated identity, one per anonymous client IP address, and
+# one shared by every client of the route
+LIMIT_SCOPES = ("identity", "anonymous", "total")
+
+PRUNE_INTERVAL_SECS = 300
+
+RATE_LIMIT_DDL = """
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+  key TEXT PRIMARY KEY,
+  tokens REAL NOT NULL,
+  updated REAL NOT NULL,
+  full_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rate_limit_buckets_full_at ON rate_limit_buckets (full_at);
+"""
+
+_registered = False
+
+
+def _state():
+    global _registered
+    state = get_shared_state()
+    if not _registered:
+        state.register_schema(RATE_LIMIT_DDL)
+        _registered = True
+    return state
+
+
+class RateLimit(object):
+
+    def __init__(self, rate_per_min, burst=1):
+        self.rate = float(rate_per_min) / 60.0
+        self.burst = float(burst)
+        if self.rate <= 0 or self.burst < 1:
+            raise ValueError("A rate limit requires a positive rate_per_min and a burst of at least 1.")
+
+
+class RouteLimits(object):
+
+    def __init__(self, config):
+        self.name = config["name"]
+        self.paths = tuple(config.get("paths") or ["/"])
+        self.methods = frozenset(method.upper() for method in config.get("methods") or [])
+        self.limits = [(scope, RateLimit(**config[scope])) for scope in LIMIT_SCOPES if config.get(scope)]
+
+    def matches(self, path, method):
+        return (not self.methods or method.upper() in self.methods) and path.startswith(self.paths)
+
+    def buckets(self, identity, ip):
+        for scope, limit in self.limits:
+            if scope == "total":
+                yield "%s total" % self.name, limit
+            elif scope == "identity" and identity:
+                yield "%s id %s" % (self.name, identity), limit
+            elif scope == "anonymous" and not identity:
+                yield "%s ip %s" % (self.name, ip or "unknown"), limit
+
+
+class RateLimiter(object):
+
+    def __init__(self, config=None, state=None, clock=time.time):
+        config = dict(DEFAULT_RATE_LIMIT_CONFIG, **(config or {}))
+        self.enabled = stob(config.get("enabled", False))
+        self.exempt_groups = frozenset(config.get("exempt_groups") or [])
+        self.routes = [RouteLimits(route) for route in config.get("routes") or []]
+        names = [route.name for route in self.routes]
+        if len(set(names)) != len(names):
+            raise ValueError("Rate limited routes must have unique names: %s" % ", ".join(names))
+        self.state = state
+        self.clock = clock
+        self.last_prune = 0
+
+    def check(self, path, method, identity=None, ip=None, attribute_ids=frozenset()):
+        """Take a token from every bucket that applies to a request.
+
+        :param path: the request path, relative to the service root
+        :param method: the request method
+        :param identity: the client identity ID, or None for an anonymous client
+        :param ip: the client IP address
+        :param attribute_ids: the client identity and group attribute IDs
+        :return: 0 if the request is allowed, otherwise the number of seconds after which it may be retried
+        """
+        if not self.enabled or not self.exempt_groups.isdisjoint(attribute_ids):
+            return 0
+        buckets = [bucket for route in self.routes if route.matches(path, method)
+                   for bucket in route.buckets(identity, ip)]
+        return self.take(buckets) if buckets else 0
+
+    def take(self, buckets):
+        """Take a token from every one of the buckets, or from none of them if any bucket is empty."""
+        state = self.state or _state()
+        now = self.clock()
+        retry_after = 0
+        available = list()
+        with state.transaction() as conn:
+            for key, limit in buckets:
+                row = conn.execute("SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+                tokens = limit.burst if row is None else \
+                    min(limit.burst, row["tokens"] + max(0.0, now - row["updated"]) * limit.rate)
+                if tokens < 1.0:
+                    retry_after = max(retry_after, (1.0 - tokens) / limit.rate)
+                available.append((key, tokens - 1.0, limit))
+            if not retry_after:
+                conn.executemany("INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated, full_at) "
+                                 "VALUES (?, ?, ?, ?)",
+                                 [(key, tokens, now, now + (limit.burst - tokens) / limit.rate)
+                                  for key, tokens, limit in available])
+        if now - self.last_prune > PRUNE_INTERVAL_SECS:
+            # a bucket that has refilled is equivalent to one that does not exist yet
+            self.last_prune = now
+            state.execute("DELETE FROM rate_limit_buckets WHERE full_at < ?", (now,))
+        return retry_after
@@ -0,0 +1,93 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Process-safe shared state for the deriva web service.
+
+The service may run as several mod_wsgi daemon processes, each with several threads. State that must be visible to
+all of them (export jobs, caches, counters) is kept in a single sqlite database under the storage path, opened in WAL
+mode so that readers never block writers. Connections are per-thread and are re-opened after a fork.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+STATE_DB_NAME = "deriva-web.db"
+
+
+class SharedState(object):
+
+    def __init__(self, db_path, timeout=30):
+        self.db_path = os.path.abspath(db_path)
+        self.timeout = timeout
+        self.schemas = list()
+        self._local = threading.local()
+
+    def register_schema(self, ddl):
+        """Register DDL statements (which must be idempotent) to run on every new connection."""
+        self.schemas.append(ddl)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and getattr(self._local, "pid", None) == os.getpid():
+            conn.executescript(ddl)
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for ddl in self.schemas:
+                conn.executescript(ddl)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchone()
+
+    @contextmanager
+    def transaction(self):
+        """An IMMEDIATE transaction, which serializes writers across all service processes."""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+
+_shared_state = None
+_shared_state_lock = threading.Lock()
+
+
+def get_shared_state():
+    global _shared_state
+    if _shared_state is None:
+        with _shared_state_lock:
+            if _shared_state is None:
+                from .core import STORAGE_PATH
+                _shared_state = SharedState(os.path.join(STORAGE_PATH, "state", STATE_DB_NAME))
+    return _shared_state
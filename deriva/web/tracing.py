@@ -0,0 +1,335 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Latency tracing of service requests, compatible with OpenTelemetry.
+
+When tracing is enabled, each sampled request records a tree of timed spans: the request itself, the lookup of its
+client session, and the work it does, such as the phases of an export, catalog queries, remote file fetches and local
+file reads. When the request ends, its spans are written as one line of OTLP/JSON to a local file (or to stdout), so
+no collector is needed; the file can be read as it is, or shipped to an OpenTelemetry collector with its
+`otlpjsonfile` receiver. Span and trace ids follow the W3C trace context, and a request with a `traceparent` header
+continues the trace of its caller.
+
+Spans are recorded per thread. Work which continues in another thread or process, such as a batch export or an
+isolated export, resumes the trace from the `trace_context()` of the span which started it, and its spans are written
+as a separate line of the same trace. When tracing is disabled, or a request is not sampled, a span only costs the
+check of a thread-local attribute.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from deriva.core import stob, format_exception
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRACING_CONFIG = {
+    "enabled": False,
+    "exporter": "file",
+    "path": None,
+    "service_name": "deriva-web",
+    "sample_rate": 1.0,
+    "min_duration_ms": 0,
+    "max_file_size_mb": 100
+}
+
+TRACE_EXPORTERS = ("file", "stdout")
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_CODE_ERROR = 2
+
+_local = threading.local()
+
+
+def _reset_after_fork():
+    # a forked child must neither add to nor write the trace of the thread which forked it
+    _local.segment = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def new_trace_id():
+    return "%032x" % random.getrandbits(128)
+
+
+def new_span_id():
+    return "%016x" % random.getrandbits(64)
+
+
+def parse_traceparent(value):
+    """Returns the (trace id, parent span id, sampled) of a W3C traceparent header value, or None if it is invalid."""
+    match = TRACEPARENT_PATTERN.match(value.strip().lower()) if value else None
+    if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+def format_attribute(key, value):
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+
+class Span(object):
+
+    def __init__(self, name, trace_id, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time_ns()) - self.start
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_error(self, message):
+        self.error = message
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.time_ns()
+
+    def to_otlp(self):
+        span = {"traceId": self.trace_id,
+                "spanId": self.span_id,
+                "name": self.name,
+                "kind": self.kind,
+                "startTimeUnixNano": str(self.start),
+                "endTimeUnixNano": str(self.end or self.start),
+                "attributes": [format_attribute(key, value) for key, value in self.attributes.items()],
+                "status": {}}
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": STATUS_CODE_ERROR, "message": self.error}
+        return span
+
+
+class NonRecordingSpan(object):
+    """Stands in for a span when the current thread is not being traced."""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, message):
+        pass
+
+
+NON_RECORDING_SPAN = NonRecordingSpan()
+
+
+class TraceSegment(object):
+    """The spans of one trace which are recorded by one thread, and written together when its first span ends."""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.open_spans = list()
+        self.spans = list()
+
+
+class Tracer(object):
+
+    def __init__(self, config, default_path):
+        config = dict(DEFAULT_TRACING_CONFIG, **(config or {}))
+        self.enabled = stob(config["enabled"])
+        self.exporter = config["exporter"]
+        if self.enabled and self.exporter not in TRACE_EXPORTERS:
+            logger.warning("Tracing is disabled because the trace exporter \"%s\" is not one of: %s" %
+                           (self.exporter, ", ".join(TRACE_EXPORTERS)))
+            self.enabled = False
+        self.path = os.path.abspath(config["path"] or default_path)
+        self.sample_rate = float(config["sample_rate"])
+        self.min_duration_ns = int(float(config["min_duration_ms"] or 0) * 1000000)
+        self.max_file_size = int(float(config["max_file_size_mb"] or 0) * 1024 * 1024)
+        self.resource = {"service.name": config["service_name"], "host.name": socket.gethostname()}
+        self._lock = threading.Lock()
+
+    def start_trace(self, name, traceparent=None, kind=SPAN_KIND_SERVER, attributes=None):
+        """Starts the root span of a trace on the current thread, continuing the trace of a W3C traceparent header
+        value, if one is given. Returns the span, or None if tracing is disabled or the trace is not sampled. Any
+        trace which was left unfinished on the current thread, e.g. by a response which was never closed, is dropped.
+        """
+        _local.segment = None
+        if not self.enabled:
+            return None
+        parent = parse_traceparent(traceparent)
+        if parent:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id, sampled = new_trace_id(), None, random.random() < self.sample_rate
+        if not sampled:
+            return None
+        return self._begin(Span(name, trace_id, parent_id, kind, attributes))
+
+    def resume_trace(self, context, name, attributes=None):
+        """Starts a span on the current thread as a child of the span of another thread or process, given the
+        trace_context() of that span. Returns the span, or None if there is nothing to resume."""
+        if not self.enabled or not context or getattr(_local, "segment", None) is not None:
+            return None
+        trace_id, parent_id = context
+        return self._begin(Span(name, trace_id, parent_id, SPAN_KIND_INTERNAL, attributes))
+
+    def _begin(self, span):
+        segment = TraceSegment(self)
+        segment.open_spans.append(span)
+        _local.segment = segment
+        return span
+
+    def end_trace(self, span, error=None):
+        """Ends a span returned by start_trace() or resume_trace(), and writes the spans recorded with it."""
+        segment = getattr(_local, "segment", None)
+        if segment is None or not segment.open_spans or segment.open_spans[0] is not span:
+            return
+        _local.segment = None
+        if error is not None:
+            span.set_error(format_exception(error))
+        # spans left open, e.g. of a generator which was never exhausted, end with their trace
+        for open_span in reversed(segment.open_spans):
+            open_span.finish()
+            segment.spans.append(open_span)
+        segment.open_spans = list()
+        if span.duration >= self.min_duration_ns:
+            self.write(segment.spans)
+
+    @contextmanager
+    def resumed(self, context, name, attributes=None):
+        """Resumes a trace for the enclosed code, unless the current thread is already being traced, in which case
+        the code is traced as part of the current trace."""
+        span = self.resume_trace(context, name, attributes)
+        if span is None:
+            with traced(name, attributes) as current:
+                yield current
+            return
+        try:
+            yield span
+        except BaseException as e:
+            self.end_trace(span, e)
+            raise
+        else:
+            self.end_trace(span)
+
+    def to_otlp(self, spans):
+        resource = dict(self.resource, **{"process.pid": os.getpid()})
+        return {"resourceSpans": [{
+            "resource": {"attributes": [format_attribute(key, value) for key, value in resource.items()]},
+            "scopeSpans": [{"scope": {"name": "deriva.web"},
+                            "spans": [span.to_otlp() for span in sorted(spans, key=lambda s: s.start)]}]}]}
+
+    def write(self, spans):
+        line = (json.dumps(self.to_otlp(spans), separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            with self._lock:
+                if self.exporter == "stdout":
+                    sys.stdout.buffer.write(line)
+                    sys.stdout.flush()
+                    return
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if self.max_file_size and os.path.isfile(self.path) and \
+                        os.path.getsize(self.path) + len(line) > self.max_file_size:
+                    os.replace(self.path, self.path + ".1")
+                # each trace is appended with a single write, so that processes which share the file do not interleave
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+        except Exception as e:
+            logger.warning("Unable to write trace: %s" % format_exception(e))
+
+
+@contextmanager
+def traced(name, attributes=None, kind=SPAN_KIND_INTERNAL):
+    """Traces the enclosed code as a child of the current span, if the current thread is being traced. Yields the
+    span, to which attributes can be added."""
+    segment = getattr(_local, "segment", None)
+    if segment is None:
+        yield NON_RECORDING_SPAN
+        return
+    parent = segment.open_spans[-1]
+    span = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+    segment.open_spans.append(span)
+    try:
+        yield span
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        span.set_error(format_exception(e))
+        raise
+    finally:
+        span.finish()
+        if span in segment.open_spans:
+            segment.open_spans.remove(span)
+            segment.spans.append(span)
+
+
+class TracedIterable(object):
+    """Traces the iteration of an iterable, e.g. a response body which is read from a file as it is sent. Closing it
+    closes the iterable, whether or not it was iterated."""
+
+    def __init__(self, name, iterable, attributes=None):
+        self.name = name
+        self.iterable = iterable
+        self.attributes = attributes
+
+    def __iter__(self):
+        with traced(self.name, self.attributes) as span:
+            size = 0
+            try:
+                for chunk in self.iterable:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                span.set_attribute("http.response.body.size", size)
+
+    def close(self):
+        if hasattr(self.iterable, "close"):
+            self.iterable.close()
+
+
+def trace_context():
+    """Returns the (trace id, span id) of the current span of the current thread, or None if it is not being traced.
+    """
+    segment = getattr(_local, "segment", None)
+    if segment is None or not segment.open_spans:
+        return None
+    span = segment.open_spans[-1]
+    return span.trace_id, span.span_id
@@ -21,7 +21,8 @@ import requests
 import warnings
 import flask
 from deriva.core import DerivaServer, urlunquote, format_exception, format_credential
-from .core import app, RestHandler, RestException, BadRequest
+from .core import app, deriva_ctx, RestHandler, RestException, BadRequest
+from .tracing import traced, SPAN_KIND_CLIENT
 
 #: logger for the module
 logger = logging.getLogger('deriva.web.transform')
@@ -46,7 +47,8 @@ class PatternTransformer (RestHandler):
         try:
             auth_token = flask.request.cookies.get("webauthn")
             credentials = format_credential(token=auth_token) if auth_token else None
-            return pattern_transformer(catalog_id, params, credentials)
+            pattern_transformer(catalog_id, params, credentials)
+            return self.compress_response()
         except requests.HTTPError as e:
             raise RestException.from_http_error(e)
         except ValueError as e:
@@ -92,7 +94,8 @@ def pattern_transformer(catalog_id, params, credentials=None):
                 _format_string = format_string
                 return _format_string.format(catalog=catalog_id, **entity)
 
-            entities = catalog.get(ermpath).json()
+            with traced("ermrest.query", {"deriva.query": ermpath}, kind=SPAN_KIND_CLIENT):
+                entities = catalog.get(ermpath).json()
             chain = itertools.chain(chain, map(_transform, entities))
 
     deriva_ctx.deriva_response.response = chain
@@ -37,7 +37,7 @@ setup(
     version="0.9.11",
     zip_safe=False,
     packages=find_packages(),
-    scripts=["bin/deriva-web-deploy", "bin/deriva-web-export-prune"],
+    scripts=["bin/deriva-web-deploy"],
     package_data={'deriva.web': ["*.wsgi"]},
     data_files=get_data_files(),
     test_suite="tests",
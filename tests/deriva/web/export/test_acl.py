@@ -0,0 +1,127 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from deriva.web.state import SharedState
+from deriva.web.export import api, jobs, events, expiry
+from deriva.web.export.storage import ExportStorage, LocalStorage
+
+
+class FakeRemoteStorage(ExportStorage):
+
+    def __init__(self):
+        self.descriptors = dict()
+        self.reads = 0
+
+    def read_metadata(self, owner, key, name, offset=0):
+        self.reads += 1
+        return self.descriptors.get((owner, key))
+
+    def delete(self, owner, key):
+        self.descriptors.pop((owner, key), None)
+
+
+class ExportACLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        for ddl in (jobs.EXPORT_JOBS_DDL, events.EXPORT_EVENTS_DDL, expiry.EXPORT_EXPIRY_DDL):
+            self.state.register_schema(ddl)
+        self.attributes = {"https://auth.example.org/alice", "https://auth.example.org/readers"}
+        for patcher in (mock.patch("deriva.web.state._shared_state", self.state),
+                        mock.patch.object(api, "_acl_cache", api.ACLCache()),
+                        mock.patch.object(api, "AUTHENTICATION", True),
+                        mock.patch.object(api, "get_client_attribute_ids", lambda: self.attributes)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.storage = LocalStorage(os.path.join(self.tmp_dir, "export"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_descriptor(self, directory, content, mtime=None):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, ".access")
+        with open(path, "w") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_rewritten_descriptor(self):
+        path = self.storage.local_path("owner", "key")
+        self.write_descriptor(path, json.dumps({"acl": ["https://auth.example.org/alice"]}), mtime=1000)
+        self.assertTrue(api.check_access(self.storage, "owner", "key"))
+        # a cached allow is not used once the descriptor has been rewritten
+        self.write_descriptor(path, json.dumps({"acl": ["https://auth.example.org/bob"]}), mtime=1010)
+        self.assertFalse(api.check_access(self.storage, "owner", "key"))
+
+    def test_public_descriptor(self):
+        os.makedirs(self.storage.local_path("owner", "key"))
+        api.create_access_descriptor(self.storage.local_path("owner", "key"), None)
+        self.attributes = set()
+        self.assertEqual(frozenset(["*"]), api.get_export_acl(self.storage, "owner", "key"))
+        self.assertTrue(api.check_access(self.storage, "owner", "key"))
+
+    def test_legacy_descriptor(self):
+        self.write_descriptor(self.storage.local_path("owner", "key"),
+                              "https://auth.example.org/bob\n\nhttps://auth.example.org/readers\n")
+        self.assertEqual(frozenset(["https://auth.example.org/bob", "https://auth.example.org/readers"]),
+                         api.get_export_acl(self.storage, "owner", "key"))
+        self.assertTrue(api.check_access(self.storage, "owner", "key"))
+
+    def test_missing_descriptor(self):
+        self.assertIsNone(api.get_export_acl(self.storage, "owner", "key"))
+        self.assertFalse(api.check_access(self.storage, "owner", "key"))
+
+    def test_in_progress_export(self):
+        output_dir = os.path.join(self.tmp_dir, "scratch", "other", "key")
+        os.makedirs(output_dir)
+        api.create_access_descriptor(output_dir, "https://auth.example.org/alice")
+        jobs.create_job("key", "other", output_dir)
+        # the scratch area of a running export is only consulted for the owner of its job
+        self.assertTrue(api.check_access(self.storage, "other", "key"))
+        self.assertIsNone(api.get_export_acl(self.storage, "owner", "key"))
+        self.assertFalse(api.check_access(self.storage, "owner", "key"))
+
+    def test_remote_descriptor(self):
+        storage = FakeRemoteStorage()
+        storage.descriptors[("owner", "key")] = json.dumps({"acl": ["https://auth.example.org/alice"]}).encode()
+        self.assertTrue(api.check_access(storage, "owner", "key"))
+        self.assertTrue(api.check_access(storage, "owner", "key"))
+        self.assertEqual(1, storage.reads)
+        # a deleted export is evicted from the cache, so that an export published later under its key is read again
+        storage.delete("owner", "key")
+        api.forget_export_acls(storage, [("owner", "key")])
+        self.assertFalse(api.check_access(storage, "owner", "key"))
+        self.assertEqual(2, storage.reads)
+
+    def test_expiry_sweep_forgets_acls(self):
+        storage = FakeRemoteStorage()
+        storage.descriptors[("owner", "key")] = json.dumps({"acl": ["*"]}).encode()
+        self.assertTrue(api.check_access(storage, "owner", "key"))
+        expiry.set_export_expiry("owner", "key", 10, now=1000)
+        self.assertEqual(1, expiry.sweep_expired_exports(storage, now=1050, on_deleted=api.forget_export_acls))
+        self.assertIsNone(api._acl_cache.get(("owner", "key")))
+
+
+if __name__ == '__main__':
+    unittest.main()
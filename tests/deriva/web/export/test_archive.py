@@ -0,0 +1,120 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import zlib
+import shutil
+import tarfile
+import tempfile
+import unittest
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from bdbag import bdbag_api as bdb
+from deriva.web.export import archive
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ArchiveBagTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bag_path = os.path.join(self.tmp_dir, "bag")
+        self.payload = {
+            "rows.csv": b"".join(b"%d,name-%d,%d\n" % (i, i % 97, i * 7) for i in range(5000)),
+            "image.jpg": os.urandom(2000),
+            "data.bin": b"".join(b"%d:%d;" % (i, i % 13) for i in range(5000))
+        }
+        os.makedirs(self.bag_path)
+        for name, data in self.payload.items():
+            with open(os.path.join(self.bag_path, name), "wb") as f:
+                f.write(data)
+        bdb.make_bag(self.bag_path, algs=["md5"])
+        self.policy = archive.get_archive_policy({"compression_level": 1, "text_compression_level": 9})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def archive(self, archiver, **kwargs):
+        archive_path, stats = archive.archive_bag(self.bag_path, archiver, archive.get_archive_policy(
+            dict(self.policy, **kwargs)))
+        return archive_path, stats
+
+    def extract(self, archive_path):
+        extract_dir = os.path.join(self.tmp_dir, "extracted")
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        bag_path = bdb.extract_bag(archive_path, extract_dir)
+        bdb.validate_bag(bag_path, fast=False)
+        for name, data in self.payload.items():
+            with open(os.path.join(bag_path, "data", name), "rb") as f:
+                self.assertEqual(data, f.read())
+
+    def test_zip_member_compression(self):
+        archive_path, stats = self.archive("zip")
+        self.assertEqual(1, stats["archive_members_stored"])
+        with ZipFile(archive_path) as zf:
+            members = dict((os.path.basename(info.filename), info) for info in zf.infolist())
+        self.assertEqual(ZIP_STORED, members["image.jpg"].compress_type)
+        self.assertEqual(ZIP_DEFLATED, members["rows.csv"].compress_type)
+        self.assertEqual(len(deflate(self.payload["rows.csv"], 9)), members["rows.csv"].compress_size)
+        self.assertEqual(len(deflate(self.payload["data.bin"], 1)), members["data.bin"].compress_size)
+        self.assertEqual(0o100644, members["data.bin"].external_attr >> 16)
+        self.extract(archive_path)
+
+    def test_idempotent_zip(self):
+        archive_path = archive.archive_bag(self.bag_path, "zip", self.policy, idempotent=True)[0]
+        with open(archive_path, "rb") as f:
+            first = f.read()
+        os.utime(os.path.join(self.bag_path, "data", "rows.csv"), (0, 0))
+        archive_path = archive.archive_bag(self.bag_path, "zip", self.policy, idempotent=True)[0]
+        with open(archive_path, "rb") as f:
+            self.assertEqual(first, f.read())
+        with ZipFile(archive_path) as zf:
+            info = zf.getinfo("bag/data/rows.csv")
+        self.assertEqual((1980, 1, 1, 0, 0, 0), info.date_time)
+        self.assertEqual(len(deflate(self.payload["rows.csv"], 9)), info.compress_size)
+        self.extract(archive_path)
+
+    def test_tgz(self):
+        archive_path = self.archive("tgz")[0]
+        with tarfile.open(archive_path, "r:gz") as t:
+            self.assertIn("bag/data/rows.csv", t.getnames())
+        self.extract(archive_path)
+
+    def test_bz2(self):
+        archive_path = self.archive("bz2")[0]
+        with tarfile.open(archive_path, "r:bz2") as t:
+            self.assertIn("bag/data/rows.csv", t.getnames())
+        self.extract(archive_path)
+
+    @unittest.skipIf(zstandard is None, "the zstandard package is not installed")
+    def test_tzst(self):
+        archive_path = self.archive("tzst")[0]
+        self.assertTrue(archive_path.endswith(".tar.zst"))
+        with open(archive_path, "rb") as f, zstandard.ZstdDecompressor().stream_reader(f) as reader, \
+                tarfile.open(fileobj=reader, mode="r|") as t:
+            names = dict((member.name, t.extractfile(member).read() if member.isfile() else None) for member in t)
+        self.assertEqual(self.payload["rows.csv"], names["bag/data/rows.csv"])
+
+
+if __name__ == '__main__':
+    unittest.main()
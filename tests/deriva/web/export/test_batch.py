@@ -0,0 +1,113 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from contextlib import ExitStack
+from deriva.web.core import Forbidden
+from deriva.web.state import SharedState
+from deriva.web.export import api, batch, jobs
+
+
+class ExportBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        state.register_schema(jobs.EXPORT_JOBS_DDL)
+        state.register_schema(batch.EXPORT_BATCHES_DDL)
+        patcher = mock.patch("deriva.web.state._shared_state", state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_batch(self, count):
+        keys = ["key-%d" % i for i in range(count)]
+        for key in keys:
+            jobs.create_job(key, "owner", os.path.join(self.tmp_dir, key))
+        items = [(key, "https://example.org/export/bdbag/%s" % key, batch.BATCH_QUEUED) for key in keys]
+        return batch.create_batch("owner", "bdbag", items), keys
+
+    def test_run_batch(self):
+        batch_key, keys = self.create_batch(5)
+        running, peak, lock = set(), [0], threading.Lock()
+        done = threading.Event()
+        # the first two items can only get past the barrier by running at the same time
+        barrier = threading.Barrier(2, timeout=10)
+
+        def run(key):
+            with lock:
+                running.add(key)
+                peak[0] = max(peak[0], len(running))
+            if key in ("key-0", "key-1"):
+                barrier.wait()
+            with lock:
+                running.discard(key)
+            if key == "key-3":
+                jobs.finish_job(key, jobs.JOB_FAILED, detail="failed")
+                raise ValueError("failed")
+            jobs.finish_job(key, jobs.JOB_COMPLETE)
+
+        tasks = [(position, key, lambda key=key: run(key)) for position, key in enumerate(keys)]
+        batch.start_batch(batch_key, tasks, max_parallel=2, resources=mock.MagicMock(__exit__=lambda *a: done.set()))
+        self.assertTrue(done.wait(10))
+        self.assertEqual(peak[0], 2)
+        manifest = batch.get_batch(batch_key)
+        self.assertEqual(manifest["status"], jobs.JOB_FAILED)
+        self.assertEqual(manifest["counts"], {jobs.JOB_COMPLETE: 4, jobs.JOB_FAILED: 1})
+        self.assertIn("failed", manifest["items"][3]["detail"])
+
+    def test_batch_holds_export_lock(self):
+        batch_key, keys = self.create_batch(2)
+        lock_path = os.path.join(self.tmp_dir, ".lock")
+        proceed, done = threading.Event(), threading.Event()
+
+        def run(key):
+            proceed.wait(10)
+            jobs.finish_job(key, jobs.JOB_COMPLETE)
+
+        with mock.patch.object(api, "get_lockfile_path", return_value=lock_path):
+            with ExitStack() as resources:
+                resources.callback(done.set)
+                resources.enter_context(api.user_export_lock())
+                tasks = [(position, key, lambda key=key: run(key)) for position, key in enumerate(keys)]
+                batch.start_batch(batch_key, tasks, resources=resources.pop_all())
+            # the client's other exports are refused until every item of the batch has finished
+            with self.assertRaises(Forbidden):
+                with api.user_export_lock():
+                    pass
+            proceed.set()
+            self.assertTrue(done.wait(10))
+            with api.user_export_lock():
+                pass
+        self.assertEqual(batch.get_batch(batch_key)["status"], jobs.JOB_COMPLETE)
+
+    def test_cancel_batch(self):
+        batch_key, keys = self.create_batch(2)
+        self.assertEqual(batch.get_batch(batch_key)["status"], jobs.JOB_RUNNING)
+        self.assertEqual(batch.cancel_batch(batch_key), 2)
+        manifest = batch.get_batch(batch_key)
+        self.assertEqual(manifest["counts"], {jobs.JOB_CANCELLED: 2})
+        self.assertIsNone(batch.get_batch("missing"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+from deriva.web.state import SharedState
+from deriva.web.export import cache
+from deriva.web.export.cache import BlobStore
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        self.state.register_schema(cache.EXPORT_BLOBS_DDL)
+        patcher = mock.patch("deriva.web.state._shared_state", self.state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blob_store = BlobStore(os.path.join(self.tmp_dir, "blobs"))
+        self.blob_store.max_bytes = 2500
+        self.now = 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, name):
+        data = os.urandom(1000)
+        md5 = hashlib.md5(data).hexdigest()
+        file_path = os.path.join(self.tmp_dir, name)
+        with open(file_path, "wb") as f:
+            f.write(data)
+        with mock.patch("time.time", return_value=self.now):
+            self.blob_store.add(md5, file_path)
+        self.now += 1
+        return md5, file_path
+
+    def test_hit_and_miss(self):
+        md5, file_path = self.add("export.bin")
+        self.assertTrue(self.blob_store.contains(md5, 1000))
+        self.assertFalse(self.blob_store.contains(md5, 999))
+        self.assertFalse(self.blob_store.contains("0" * 32))
+        linked = os.path.join(self.tmp_dir, "linked.bin")
+        self.assertTrue(self.blob_store.link_to(md5, linked))
+        self.assertTrue(os.path.samefile(file_path, linked))
+        self.assertFalse(self.blob_store.link_to("0" * 32, os.path.join(self.tmp_dir, "missing.bin")))
+
+    def test_prune_least_recently_used(self):
+        blobs = [self.add("export-%d.bin" % i) for i in range(4)]
+        for md5, file_path in blobs:
+            os.remove(file_path)
+        # the first blob is linked into a new export, which makes it the most recently used, and then unreferenced
+        reused = os.path.join(self.tmp_dir, "reused.bin")
+        with mock.patch("time.time", return_value=self.now):
+            self.assertTrue(self.blob_store.link_to(blobs[0][0], reused))
+        os.remove(reused)
+        with mock.patch("os.walk") as walk:
+            self.assertEqual(2, self.blob_store.prune())
+        walk.assert_not_called()
+        self.assertEqual([True, False, False, True], [self.blob_store.contains(md5) for md5, path in blobs])
+        self.assertEqual(0, self.blob_store.prune())
+
+    def test_prune_keeps_referenced_blobs(self):
+        blobs = [self.add("export-%d.bin" % i) for i in range(4)]
+        os.remove(blobs[3][1])
+        self.assertEqual(1, self.blob_store.prune())
+        self.assertEqual([True, True, True, False], [self.blob_store.contains(md5) for md5, path in blobs])
+        rows = self.state.query("SELECT md5 FROM export_blobs")
+        self.assertEqual(set(md5 for md5, path in blobs[:3]), set(row["md5"] for row in rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from deriva.web.export import processors
+
+
+class FakeCatalog(object):
+
+    def __init__(self):
+        self.queries = list()
+
+    def get_server_uri(self):
+        return "https://example.org/ermrest/catalog/1"
+
+    def get_as_file(self, query, output_path, headers=None, callback=None, delete_if_empty=False, paged=False,
+                    page_size=None, page_sort_columns=None):
+        self.queries.append((query, headers["accept"], paged, page_size))
+        with open(output_path, "w") as f:
+            if headers["accept"] == processors.JSON_STREAM_CONTENT_TYPE:
+                f.write('{"RID": "1-0001"}\n{"RID": "1-0002"}\n')
+            else:
+                f.write("RID\n1-0001\n1-0002\n")
+
+
+class QueryDeduplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.tmp_dir, "export")
+        self.scratch_dir = os.path.join(self.tmp_dir, "scratch")
+        os.makedirs(self.scratch_dir)
+        self.catalog = FakeCatalog()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_processors(self, *specs):
+        outputs = list()
+        with processors.export_context(scratch_dir=self.scratch_dir) as context:
+            for processor_class, params in specs:
+                processor = processor_class(catalog=self.catalog, store=None, base_path=self.base_path, inputs={},
+                                            processor_params=dict(params, query_path="/entity/S:T"))
+                processor.process()
+                outputs.append(processor.output_abspath)
+        return context.stats, outputs
+
+    def test_identical_queries(self):
+        stats, outputs = self.run_processors((processors.ExportCSVQueryProcessor, {"output_path": "first"}),
+                                             (processors.ExportCSVQueryProcessor, {"output_path": "second"}))
+        self.assertEqual(1, len(self.catalog.queries))
+        self.assertEqual((1, 1), (stats["queries_executed"], stats["query_dedup_hits"]))
+        self.assertNotEqual(outputs[0], outputs[1])
+        self.assertTrue(os.path.samefile(outputs[0], outputs[1]))
+
+    def test_different_paging(self):
+        stats, outputs = self.run_processors(
+            (processors.ExportCSVQueryProcessor, {"output_path": "first"}),
+            (processors.ExportCSVQueryProcessor, {"output_path": "paged", "paged_query": True}),
+            (processors.ExportCSVQueryProcessor, {"output_path": "small", "paged_query": True,
+                                                  "paged_query_size": 10}))
+        self.assertEqual([False, True, True], [query[2] for query in self.catalog.queries])
+        self.assertEqual(3, stats["queries_executed"])
+        self.assertNotIn("query_dedup_hits", stats)
+        self.assertFalse(os.path.samefile(outputs[0], outputs[1]))
+
+    def test_different_content_type(self):
+        stats, outputs = self.run_processors(
+            (processors.ExportCSVQueryProcessor, {"output_path": "csv"}),
+            (processors.ExportJSONStreamQueryProcessor, {"output_path": "stream"}))
+        self.assertEqual(["text/csv", processors.JSON_STREAM_CONTENT_TYPE],
+                         [query[1] for query in self.catalog.queries])
+        self.assertNotIn("query_dedup_hits", stats)
+        with open(outputs[1]) as f:
+            self.assertEqual('{"RID": "1-0001"}', f.readline().strip())
+
+    def test_json_from_json_stream(self):
+        stats, outputs = self.run_processors(
+            (processors.ExportJSONStreamQueryProcessor, {"output_path": "stream"}),
+            (processors.ExportJSONQueryProcessor, {"output_path": "json"}))
+        self.assertEqual(1, len(self.catalog.queries))
+        with open(outputs[1]) as f:
+            self.assertEqual([{"RID": "1-0001"}, {"RID": "1-0002"}], json.load(f))
+
+    def test_without_export_context(self):
+        for name in ("first", "second"):
+            processor = processors.ExportCSVQueryProcessor(catalog=self.catalog, store=None, base_path=self.base_path,
+                                                           inputs={}, processor_params={"query_path": "/entity/S:T",
+                                                                                        "output_path": name})
+            processor.process()
+        self.assertEqual(2, len(self.catalog.queries))
+
+
+class RemoteFileDeduplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.downloads = list()
+        self.processor = processors.ExportFileDownloadQueryProcessor.__new__(
+            processors.ExportFileDownloadQueryProcessor)
+        self.processor.download_file = self.download
+        self.processor.getExternalUrl = lambda url: url
+        self.processor.sessions = dict()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, url, store, file_path, algorithms):
+        self.downloads.append(url)
+        with open(file_path, "wb") as f:
+            f.write(b"payload")
+        return 7, "text/plain", {"md5": "0" * 32}
+
+    def test_same_remote_file(self):
+        paths = [os.path.join(self.tmp_dir, name) for name in ("first.txt", "second.txt", "other.txt")]
+        with processors.export_context(digest_algorithms=["md5"]) as context:
+            results = [self.processor.fetch_file(url, None, path)
+                       for url, path in zip(("https://example.org/a", "https://example.org/a",
+                                             "https://example.org/b"), paths)]
+        self.assertEqual(["https://example.org/a", "https://example.org/b"], self.downloads)
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(os.path.samefile(paths[0], paths[1]))
+        self.assertFalse(os.path.samefile(paths[0], paths[2]))
+        self.assertEqual((1, 7), (context.stats["remote_dedup_hits"], context.stats["remote_dedup_bytes"]))
+        # the digests computed while downloading are reused for the linked copy
+        self.assertEqual({"md5": "0" * 32}, context.get_digests(paths[1], ["md5"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from deriva.web.state import SharedState
+from deriva.web.export import events
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ""
+        self.is_redirect = status_code in (301, 302, 303, 307, 308) and "Location" in self.headers
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise events.requests.HTTPError("%d Error" % self.status_code, response=self)
+
+
+class EventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        self.state.register_schema(events.EXPORT_EVENTS_DDL)
+        patcher = mock.patch("deriva.web.state._shared_state", self.state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class WebhookTest(EventsTestCase):
+
+    def setUp(self):
+        super(WebhookTest, self).setUp()
+        patcher = mock.patch.object(events, "start_webhook_delivery")
+        self.start_delivery = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_webhook(self):
+        return dict(self.state.query_one("SELECT * FROM export_webhooks"))
+
+    def test_allowed_urls(self):
+        patterns = ["https://*.example.org/*", "http://localhost:*/hooks/*"]
+        for url in ("https://hooks.example.org/export", "https://hooks.example.org", "https://a.b.example.org/x?y=z",
+                    "https://hooks.example.org:443/export", "http://localhost:8080/hooks/1"):
+            self.assertTrue(events.is_webhook_allowed(url, patterns), url)
+        for url in ("https://evil.host/.example.org/", "https://evil.host/?.example.org",
+                    "https://evil.host#.example.org",
+                    "https://hooks.example.org@evil.host/", "https://evil.host\\.example.org/",
+                    "http://hooks.example.org/export", "https://hooks.example.org:8443/export",
+                    "http://localhost:8080/other", "ftp://hooks.example.org/", "/hooks/1", "not a url"):
+            self.assertFalse(events.is_webhook_allowed(url, patterns), url)
+        self.assertFalse(events.is_webhook_allowed("https://hooks.example.org/export", None))
+
+    def test_delivery(self):
+        events.queue_webhook("key", "https://hooks.example.org/export", {"status": "complete"})
+        self.start_delivery.assert_called_once_with()
+        with mock.patch.object(events.requests, "post", return_value=FakeResponse(204)) as post:
+            self.assertEqual(1, events.deliver_webhooks())
+        post.assert_called_once_with("https://hooks.example.org/export", data=json.dumps({"status": "complete"}),
+                                     timeout=events.WEBHOOK_TIMEOUT_SECS, headers={"Content-Type": "application/json"},
+                                     allow_redirects=False)
+        self.assertEqual(1, self.get_webhook()["delivered"])
+        self.assertFalse(events.has_pending_webhooks())
+
+    def test_redirect_is_not_followed(self):
+        events.queue_webhook("key", "https://hooks.example.org/export", {}, max_attempts=1)
+        redirect = FakeResponse(307, {"Location": "http://169.254.169.254/"})
+        with mock.patch.object(events.requests, "post", return_value=redirect) as post:
+            events.deliver_webhooks()
+        self.assertEqual(1, post.call_count)
+        self.assertEqual(-1, self.get_webhook()["delivered"])
+
+    def test_retry_with_backoff(self):
+        with mock.patch.object(events.requests, "post", return_value=FakeResponse(503)), \
+                mock.patch("time.time", return_value=1000):
+            events.queue_webhook("key", "https://hooks.example.org/export", {}, max_attempts=3, backoff_secs=10)
+            self.assertEqual(1, events.deliver_webhooks())
+            # a delivery in backoff is not attempted again until it is due
+            self.assertEqual(0, events.deliver_webhooks())
+        webhook = self.get_webhook()
+        self.assertEqual((1, 0, 1010), (webhook["attempts"], webhook["delivered"], webhook["next_attempt"]))
+        with mock.patch.object(events.requests, "post", side_effect=events.requests.ConnectionError()), \
+                mock.patch("time.time", return_value=1010):
+            self.assertEqual(1, events.deliver_webhooks())
+        self.assertEqual(1030, self.get_webhook()["next_attempt"])
+        with mock.patch.object(events.requests, "post", return_value=FakeResponse(500)), \
+                mock.patch("time.time", return_value=1030):
+            self.assertEqual(1, events.deliver_webhooks())
+        webhook = self.get_webhook()
+        self.assertEqual((3, -1), (webhook["attempts"], webhook["delivered"]))
+
+    def test_resume_delivery(self):
+        with mock.patch.object(events, "_resumed_pid", None):
+            events.resume_webhook_delivery()
+            self.start_delivery.assert_not_called()
+        events.queue_webhook("key", "https://hooks.example.org/export", {})
+        self.start_delivery.reset_mock()
+        with mock.patch.object(events, "_resumed_pid", None):
+            events.resume_webhook_delivery()
+            events.resume_webhook_delivery()
+        self.start_delivery.assert_called_once_with()
+
+    def test_delete_events(self):
+        events.emit_event("key", events.EVENT_COMPLETE)
+        events.queue_webhook("key", "https://hooks.example.org/export", {})
+        events.emit_event("other", events.EVENT_COMPLETE)
+        events.delete_events(["key"])
+        self.assertEqual([], events.get_events("key"))
+        self.assertEqual(1, len(events.get_events("other")))
+        self.assertIsNone(self.state.query_one("SELECT * FROM export_webhooks"))
+
+
+class EventNotifierTest(EventsTestCase):
+
+    def setUp(self):
+        super(EventNotifierTest, self).setUp()
+        patcher = mock.patch.object(events, "POLL_INTERVAL_SECS", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.notifier = events.EventNotifier()
+
+    def test_subscribe(self):
+        events.emit_event("key", events.EVENT_PROGRESS, {"message": "started"})
+        stream = self.notifier.subscribe("key", max_duration_secs=10, keepalive_secs=5)
+        event = next(stream)
+        self.assertEqual(("progress", {"message": "started"}), (event["event"], json.loads(event["data"])))
+        self.assertEqual(1, self.notifier.subscribers)
+        # events emitted by another thread wake the subscriber, which ends its stream with the terminal event
+        emitter = threading.Timer(0.1, events.emit_event, ("key", events.EVENT_COMPLETE, {"url": "/export/key"}))
+        emitter.start()
+        remaining = list(stream)
+        emitter.join()
+        self.assertEqual([events.EVENT_COMPLETE], [event["event"] for event in remaining if event])
+        self.assertEqual(0, self.notifier.subscribers)
+        self.assertEqual("id: %d\nevent: complete\ndata: {\"url\": \"/export/key\"}\n\n" % remaining[-1]["id"],
+                         events.format_sse(remaining[-1]))
+
+    def test_resume_after_event_id(self):
+        events.emit_event("key", events.EVENT_PROGRESS)
+        events.emit_event("key", events.EVENT_FAILED)
+        first = events.get_events("key")[0]["id"]
+        stream = list(self.notifier.subscribe("key", after_id=first, max_duration_secs=10))
+        self.assertEqual([events.EVENT_FAILED], [event["event"] for event in stream])
+
+    def test_keepalive_and_duration(self):
+        stream = list(self.notifier.subscribe("key", max_duration_secs=0.3, keepalive_secs=0.05))
+        self.assertTrue(stream)
+        self.assertEqual(set([None]), set(stream))
+        self.assertEqual(": keepalive\n\n", events.format_sse(None))
+        self.assertEqual(0, self.notifier.subscribers)
+        self.notifier.thread and self.notifier.thread.join(1)
+        self.assertIsNone(self.notifier.thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from deriva.web.state import SharedState
+from deriva.web.export import expiry, jobs, events
+from deriva.web.export.storage import LocalStorage
+
+
+class ExportExpiryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        state.register_schema(jobs.EXPORT_JOBS_DDL)
+        state.register_schema(events.EXPORT_EVENTS_DDL)
+        state.register_schema(expiry.EXPORT_EXPIRY_DDL)
+        patcher = mock.patch("deriva.web.state._shared_state", state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = LocalStorage(os.path.join(self.tmp_dir, "export"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_export(self, owner, key):
+        path = self.storage.local_path(owner, key)
+        os.makedirs(path)
+        with open(os.path.join(path, "data.csv"), "w") as f:
+            f.write("id\n1\n")
+        return path
+
+    def test_claim_expired_exports(self):
+        expiry.set_export_expiry("owner", "old", 10, now=1000)
+        expiry.set_export_expiry("owner", "new", 100, now=1000)
+        expiry.set_export_expiry("owner", "running", 10, now=1000)
+        jobs.create_job("running", "owner", os.path.join(self.tmp_dir, "running"))
+        self.assertEqual([("owner", "old")], expiry.claim_expired_exports(now=1050))
+        # a claimed export is not claimed again until its retry time
+        self.assertEqual([], expiry.claim_expired_exports(now=1050))
+        self.assertEqual(1050 + expiry.EXPIRY_RETRY_SECS, expiry.get_export_expiry("old"))
+        # a finished export expires one TTL after it finished
+        jobs.finish_job("running", jobs.JOB_COMPLETE)
+        expiry.renew_export_expiry("running", now=1050)
+        self.assertEqual(1060, expiry.get_export_expiry("running"))
+        self.assertEqual([("owner", "running")], expiry.claim_expired_exports(now=1060))
+        self.assertEqual([("owner", "new")], expiry.claim_expired_exports(now=1100))
+
+    def test_sweep_expired_exports(self):
+        expired = self.create_export("owner", "expired")
+        current = self.create_export("owner", "current")
+        expiry.set_export_expiry("owner", "expired", 10, now=1000)
+        expiry.set_export_expiry("owner", "current", 100, now=1000)
+        events.emit_event("expired", "complete")
+        self.assertEqual(1, expiry.sweep_expired_exports(self.storage, now=1050, limit=1))
+        self.assertFalse(os.path.exists(expired))
+        self.assertTrue(os.path.exists(current))
+        self.assertEqual([], list(events.get_events("expired")))
+        self.assertIsNone(expiry.get_export_expiry("expired"))
+
+    def test_sweep_delete_failure(self):
+        expired = self.create_export("owner", "expired")
+        expiry.set_export_expiry("owner", "expired", 10, now=1000)
+        events.emit_event("expired", "complete")
+        with mock.patch.object(self.storage, "delete", side_effect=OSError("storage unavailable")):
+            self.assertEqual(0, expiry.sweep_expired_exports(self.storage, now=1050))
+        # the export stays in the index, and is deleted by a later sweep once its retry time has come
+        self.assertTrue(os.path.exists(expired))
+        self.assertEqual(1050 + expiry.EXPIRY_RETRY_SECS, expiry.get_export_expiry("expired"))
+        self.assertEqual(1, len(events.get_events("expired")))
+        self.assertEqual(0, expiry.sweep_expired_exports(self.storage, now=1060))
+        self.assertEqual(1, expiry.sweep_expired_exports(self.storage, now=1050 + expiry.EXPIRY_RETRY_SECS))
+        self.assertFalse(os.path.exists(expired))
+        self.assertIsNone(expiry.get_export_expiry("expired"))
+
+    def test_backfill_export_expiry(self):
+        self.create_export("owner", "legacy")
+        self.create_export("warm", "prebuilt")
+        expiry.set_export_expiry("owner", "indexed", 10, now=1000)
+        expiry.backfill_export_expiry(self.storage, 100, exclude_owners=("warm",))
+        created = os.stat(self.storage.local_path("owner", "legacy")).st_ctime
+        self.assertAlmostEqual(created + 100, expiry.get_export_expiry("legacy"))
+        self.assertIsNone(expiry.get_export_expiry("prebuilt"))
+        self.assertEqual(1010, expiry.get_export_expiry("indexed"))
+        # each storage directory is only scanned once
+        self.create_export("owner", "later")
+        expiry.backfill_export_expiry(self.storage, 100)
+        self.assertIsNone(expiry.get_export_expiry("later"))
+
+    def test_sweeper_backfills_export_expiry(self):
+        # the sweeper thread backfills the index before its first sweep, and retries the backfill if it fails
+        self.create_export("owner", "legacy")
+        with mock.patch("deriva.web.export.expiry.backfill_export_expiry",
+                        side_effect=[OSError("storage unavailable"), None]) as backfill, \
+                mock.patch("deriva.web.export.expiry.sweep_expired_exports", return_value=0) as sweep, \
+                mock.patch("time.sleep", side_effect=[None, None, StopIteration]):
+            with self.assertRaises(StopIteration):
+                expiry.run_expiry_sweeper(self.storage, 10, backfill_ttl_secs=100, backfill_exclude_owners=("warm",))
+        self.assertEqual(2, backfill.call_count)
+        backfill.assert_called_with(self.storage, 100, exclude_owners=("warm",))
+        self.assertEqual(2, sweep.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
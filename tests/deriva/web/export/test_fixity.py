@@ -0,0 +1,225 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import base64
+import hashlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from requests.structures import CaseInsensitiveDict
+from bdbag import bdbag_api as bdb
+from deriva.core.hatrac_store import HatracHashMismatch
+from deriva.transfer.download import DerivaDownloadError
+from deriva.web.export import processors
+from deriva.web.state import SharedState
+from deriva.web.export import cache
+from deriva.web.export.cache import BlobStore
+
+
+class FakeResponse(object):
+
+    def __init__(self, data, headers=None):
+        self.data = data
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), 1000):
+            yield self.data[i:i + 1000]
+
+
+class SinglePassFixityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bag_path = os.path.join(self.tmp_dir, "bag")
+        os.makedirs(self.bag_path)
+        bdb.make_bag(self.bag_path, algs=["md5", "sha256"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_verify_content_md5(self):
+        data = os.urandom(5000)
+        file_path = os.path.join(self.bag_path, "data", "payload.bin")
+        good = FakeResponse(data, {"Content-MD5": base64.b64encode(hashlib.md5(data).digest()).decode()})
+        total, digests = processors.write_response(good, file_path, ["md5", "sha256"])
+        self.assertEqual(total, len(data))
+        self.assertEqual(digests["sha256"], hashlib.sha256(data).hexdigest())
+        processors.verify_response_digests(good, digests, file_path)
+        bad = FakeResponse(data, {"Content-MD5": base64.b64encode(hashlib.md5(b"other").digest()).decode()})
+        with self.assertRaises(DerivaDownloadError):
+            processors.verify_response_digests(bad, digests, file_path)
+
+    def test_manifest_uses_recorded_digests(self):
+        with processors.export_context(digest_algorithms=["md5", "sha256"]) as context:
+            for name in ("downloaded.bin", "queried.csv"):
+                file_path = os.path.join(self.bag_path, "data", name)
+                total, digests = processors.write_response(FakeResponse(os.urandom(5000)), file_path,
+                                                           context.digest_algorithms)
+                if name == "downloaded.bin":
+                    context.record_digests(file_path, digests)
+            bdb.make_bag(self.bag_path, algs=["md5", "sha256"], update=True)
+        self.assertEqual(context.stats["fixity_files_reused"], 1)
+        self.assertEqual(context.stats["fixity_files_read"], 1)
+        bdb.validate_bag(self.bag_path, fast=False)
+
+
+class FakeStore(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def head(self, url, headers=None):
+        return FakeResponse(b"", self.headers)
+
+
+class BlobCacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        state.register_schema(cache.EXPORT_BLOBS_DDL)
+        patcher = mock.patch("deriva.web.state._shared_state", state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blob_store = BlobStore(os.path.join(self.tmp_dir, "blobs"))
+        self.data = os.urandom(5000)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.downloads = 0
+        self.processor = processors.ExportFileDownloadQueryProcessor.__new__(
+            processors.ExportFileDownloadQueryProcessor)
+        self.processor.download_file = self.download
+        self.processor.getExternalUrl = lambda url: url
+        self.processor.sessions = dict()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, url, store, file_path, algorithms):
+        self.downloads += 1
+        with open(file_path, "wb") as f:
+            f.write(self.data)
+        return len(self.data), "application/octet-stream", {"md5": self.md5}
+
+    def fetch(self, name, store):
+        with processors.export_context(blob_store=self.blob_store) as context:
+            result = self.processor._fetch_file("/hatrac/" + name, store, os.path.join(self.tmp_dir, name), context)
+        return context.stats, result
+
+    def test_catalog_md5_is_not_trusted(self):
+        # another user's cached file must not be linked by a manifest entry which claims its checksum
+        self.blob_store.add(self.md5, self.write_blob())
+        stats, result = self.fetch("external.bin", None)
+        self.assertEqual(stats.get("blob_cache_hits", 0), 0)
+        stats, result = self.fetch("unasserted.bin", FakeStore({}))
+        self.assertEqual(stats.get("blob_cache_hits", 0), 0)
+        self.assertEqual(self.downloads, 2)
+
+    def test_hatrac_md5_is_trusted(self):
+        store = FakeStore({"Content-MD5": base64.b64encode(hashlib.md5(self.data).digest()).decode(),
+                           "Content-Type": "image/tiff"})
+        stats, result = self.fetch("first.bin", store)
+        self.assertEqual(stats["blob_cache_misses"], 1)
+        self.assertTrue(self.blob_store.contains(self.md5))
+        stats, result = self.fetch("second.bin", store)
+        self.assertEqual(stats["blob_cache_hits"], 1)
+        self.assertEqual(self.downloads, 1)
+        # a cached file is described by the HEAD response of the object it stands in for
+        self.assertEqual((len(self.data), "image/tiff"), result)
+
+    def test_computed_md5_is_cached(self):
+        self.fetch("external.bin", None)
+        self.assertTrue(self.blob_store.contains(self.md5))
+
+    def write_blob(self):
+        file_path = os.path.join(self.tmp_dir, "blob")
+        with open(file_path, "wb") as f:
+            f.write(self.data)
+        return file_path
+
+
+class FakeHatracStore(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = CaseInsensitiveDict({"Content-Length": str(len(data)), "Content-Type": "image/tiff",
+                                            "Content-MD5": base64.b64encode(hashlib.md5(data).digest()).decode()})
+        self.downloads = 0
+
+    def get_server_uri(self):
+        return "https://example.org"
+
+    def head(self, path, headers=None, raise_not_modified=False):
+        response = FakeResponse(b"", self.headers.copy())
+        response.ok = True
+        return response
+
+    def get_obj(self, path, headers=None, destfilename=None):
+        self.downloads += 1
+        with open(destfilename, "wb") as f:
+            f.write(self.data)
+        if path.endswith("corrupt.bin"):
+            raise HatracHashMismatch("Content-MD5 does not match")
+        return FakeResponse(b"", self.headers)
+
+
+class HatracDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = os.urandom(5000)
+        self.store = FakeHatracStore(self.data)
+        self.processor = processors.ExportFileDownloadQueryProcessor(
+            catalog=FakeHatracStore(b""), store=self.store, base_path=self.tmp_dir, inputs={}, processor_params={})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, *paths):
+        manifest = os.path.join(self.tmp_dir, "manifest.json")
+        with open(manifest, "w") as f:
+            for path in paths:
+                f.write('{"url": "%s"}\n' % path)
+        return self.processor.downloadFiles(manifest)
+
+    def test_download_without_context(self):
+        # an object without a Content-Disposition header is named after the object, without its version
+        files = self.download("/hatrac/ns/object.bin:VERSION")
+        self.assertEqual(["object.bin"], list(files))
+        with open(os.path.join(self.tmp_dir, "object.bin"), "rb") as f:
+            self.assertEqual(self.data, f.read())
+
+    def test_download_with_digests(self):
+        progress = list()
+        with processors.export_context(digest_algorithms=["md5", "sha256"],
+                                       progress=lambda message, **kwargs: progress.append(kwargs)) as context:
+            files = self.download("/hatrac/ns/first.bin", "/hatrac/ns/first.bin")
+        self.assertEqual(1, self.store.downloads)
+        self.assertEqual(1, context.stats["remote_dedup_hits"])
+        self.assertEqual([{"files_downloaded": 1}, {"files_downloaded": 2}], progress)
+        digests = context.get_digests(files["first.bin"]["local_path"], ["md5", "sha256"])
+        self.assertEqual({"md5": hashlib.md5(self.data).hexdigest(), "sha256": hashlib.sha256(self.data).hexdigest()},
+                         digests)
+
+    def test_hash_mismatch(self):
+        with processors.export_context(digest_algorithms=["md5"]):
+            with self.assertRaises(DerivaDownloadError):
+                self.download("/hatrac/ns/corrupt.bin")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from deriva.web.export.logtail import LogSource, read_log_tail
+
+
+class LogTailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmp_dir, ".log")
+        with open(self.log_path, "w") as f:
+            f.write("first line\nsecond line\nunterminated")
+        self.running = False
+        self.source = LogSource(lambda: (self.log_path, self.running))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_from_offset(self):
+        self.assertEqual(b"".join(self.source.read(11)), b"second line\nunterminated")
+        self.assertEqual(b"".join(self.source.read(11, 6)), b"second")
+        self.assertEqual(self.source.wait(11, 0), (35, False))
+
+    def test_follow(self):
+        events = list(self.source.follow(11))
+        self.assertEqual(events[1:], ["id: 23\nevent: log\ndata: second line\n\n",
+                                      "id: 35\nevent: log\ndata: unterminated\n\n",
+                                      "id: 35\nevent: eof\ndata: \n\n"])
+
+    def test_tail(self):
+        self.assertEqual(read_log_tail(self.source), "first line\nsecond line\nunterminated")
+        self.assertEqual(read_log_tail(self.source, 20), "...\nunterminated")
+        self.assertIsNone(read_log_tail(LogSource(lambda: (os.path.join(self.tmp_dir, "missing"), False))))
+
+
+if __name__ == '__main__':
+    unittest.main()
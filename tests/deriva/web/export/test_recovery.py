@@ -0,0 +1,119 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import time
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from deriva.web.state import SharedState
+from deriva.web.export import recovery, jobs, events
+from deriva.web.export.storage import LocalStorage
+
+
+class ExportRecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        self.state.register_schema(jobs.EXPORT_JOBS_DDL)
+        self.state.register_schema(events.EXPORT_EVENTS_DDL)
+        patcher = mock.patch("deriva.web.state._shared_state", self.state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scratch_path = os.path.join(self.tmp_dir, "scratch")
+        self.storage = LocalStorage(os.path.join(self.tmp_dir, "export"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_scratch_dir(self, key, status=None, updated=None, mtime=None):
+        output_dir = os.path.join(self.scratch_path, "owner", key)
+        os.makedirs(os.path.join(output_dir, "bag", "data"))
+        for name in (".access", ".log", "result.csv"):
+            with open(os.path.join(output_dir, name), "w") as f:
+                f.write("%s\n" % name)
+        if status is not None:
+            jobs.create_job(key, "owner", output_dir)
+            if status != jobs.JOB_RUNNING:
+                jobs.finish_job(key, status)
+            if updated is not None:
+                self.state.execute("UPDATE export_jobs SET updated = ? WHERE key = ?", (updated, key))
+        if mtime is not None:
+            os.utime(output_dir, (mtime, mtime))
+        return output_dir
+
+    def test_fail_interrupted_job(self):
+        self.create_scratch_dir("interrupted", jobs.JOB_RUNNING)
+        # the process which was running the export no longer exists
+        with mock.patch("os.kill", side_effect=ProcessLookupError):
+            interrupted = jobs.interrupted_jobs()
+        self.assertEqual([job["key"] for job in interrupted], ["interrupted"])
+
+        recovery.fail_interrupted_job(interrupted[0], self.storage)
+        job = jobs.get_job("interrupted")
+        self.assertEqual(job["status"], jobs.JOB_FAILED)
+        self.assertIn("interrupted", job["detail"])
+        # only the log and access descriptor of the partial export are published
+        published = self.storage.local_path("owner", "interrupted")
+        self.assertEqual(sorted(os.listdir(published)), [".access", ".log"])
+        with open(os.path.join(published, ".log")) as log:
+            self.assertIn(job["detail"], log.read())
+        self.assertFalse(os.path.exists(interrupted[0]["output_dir"]))
+        failed = [event for event in events.get_events("interrupted") if event["event"] == events.EVENT_FAILED]
+        self.assertEqual(json.loads(failed[0]["data"])["detail"], job["detail"])
+
+    def test_remove_orphaned_dirs(self):
+        old = time.time() - 3600
+        running = self.create_scratch_dir("running", jobs.JOB_RUNNING, updated=old, mtime=old)
+        finished = self.create_scratch_dir("finished", jobs.JOB_FAILED, updated=old)
+        just_finished = self.create_scratch_dir("just-finished", jobs.JOB_COMPLETE)
+        orphaned = self.create_scratch_dir("orphaned", mtime=old)
+        new = self.create_scratch_dir("new")
+
+        recovery.remove_orphaned_dirs(self.scratch_path, orphan_age_secs=600)
+        for path in (running, just_finished, new):
+            self.assertTrue(os.path.isdir(path), path)
+        for path in (finished, orphaned):
+            self.assertFalse(os.path.exists(path), path)
+
+        # directories without a job are kept when there is no orphan age
+        orphaned = self.create_scratch_dir("orphaned", mtime=old)
+        recovery.remove_orphaned_dirs(self.scratch_path)
+        self.assertTrue(os.path.isdir(orphaned))
+
+    def start_recovery(self, result):
+        with mock.patch("deriva.web.export.recovery.recover_exports", side_effect=[result]) as recover:
+            recovery.start_recovery({})
+            recovery._recovery_thread.join()
+        return recover.called
+
+    @mock.patch("deriva.web.export.recovery._recovered_pid", None)
+    def test_start_recovery(self):
+        # the sweep is started again until this process has taken the recovery lock and the sweep has succeeded
+        self.assertTrue(self.start_recovery(False))
+        self.assertTrue(self.start_recovery(RuntimeError("sweep failed")))
+        self.assertIsNone(recovery._recovered_pid)
+        self.assertTrue(self.start_recovery(True))
+        self.assertEqual(recovery._recovered_pid, os.getpid())
+        with mock.patch("deriva.web.export.recovery.recover_exports") as recover:
+            recovery.start_recovery({})
+        self.assertFalse(recover.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
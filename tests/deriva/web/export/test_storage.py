@@ -0,0 +1,135 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import uuid
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from deriva.web.export import storage
+
+
+class StorageTestMixin(object):
+    """Common test cases for export storage backends. Subclasses provide `self.storage`."""
+
+    def make_staging_dir(self):
+        staging_dir = os.path.join(self.tmpdir, "staging", str(uuid.uuid4()))
+        os.makedirs(staging_dir)
+        for name, content in ((".access", b"*\n"), (".log", b"log text\n"), ("result.csv", b"a,b\n1,2\n")):
+            with open(os.path.join(staging_dir, name), "wb") as f:
+                f.write(content)
+        return staging_dir
+
+    def test_publish_and_read(self):
+        staging_dir = self.make_staging_dir()
+        key = os.path.basename(staging_dir)
+        self.storage.publish("owner", key, staging_dir)
+        self.assertTrue(self.storage.exists("owner", key))
+        self.assertEqual(self.storage.list_files("owner", key), ["result.csv"])
+        self.assertEqual(self.storage.read_metadata("owner", key, ".access"), b"*\n")
+        self.assertIsNone(self.storage.read_metadata("owner", key, ".stats"))
+        self.assertIn(key, [k for k, created in self.storage.list_exports("owner")])
+
+    def test_delete(self):
+        staging_dir = self.make_staging_dir()
+        key = os.path.basename(staging_dir)
+        self.storage.publish("owner", key, staging_dir)
+        self.storage.delete("owner", key)
+        self.assertFalse(self.storage.exists("owner", key))
+
+
+class TestPosixStorage (StorageTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = storage.create_export_storage({"type": "posix", "path": os.path.join(self.tmpdir, "shared")},
+                                                     os.path.join(self.tmpdir, "staging"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_local_path(self):
+        staging_dir = self.make_staging_dir()
+        key = os.path.basename(staging_dir)
+        self.storage.publish("owner", key, staging_dir)
+        self.assertFalse(os.path.exists(staging_dir))
+        self.assertTrue(os.path.isfile(self.storage.local_path("owner", key, "result.csv")))
+        self.assertIsNone(self.storage.get_download_url("owner", key, "result.csv"))
+
+    def test_republish(self):
+        staging_dir = self.make_staging_dir()
+        key = os.path.basename(staging_dir)
+        self.storage.publish("owner", key, staging_dir)
+        staging_dir = os.path.join(self.tmpdir, "staging", "rebuild")
+        os.makedirs(staging_dir)
+        with open(os.path.join(staging_dir, "result.json"), "w") as f:
+            f.write("[]")
+        self.storage.publish("owner", key, staging_dir)
+        self.assertEqual(self.storage.list_files("owner", key), ["result.json"])
+        self.assertEqual(os.listdir(os.path.dirname(self.storage.local_path("owner", key))), [key])
+
+    def test_publish_across_devices(self):
+        staging_dir = self.make_staging_dir()
+        key = os.path.basename(staging_dir)
+        os_stat, os_rename = os.stat, os.rename
+
+        def stat(path, *args, **kwargs):
+            st = os_stat(path, *args, **kwargs)
+            if path == staging_dir and not args and not kwargs:
+                # the staging directory is on another file system than the published exports
+                return mock.Mock(st_dev=st.st_dev + 1)
+            return st
+
+        def rename(source, target):
+            # a directory cannot be renamed across file systems
+            self.assertNotEqual(source, staging_dir)
+            os_rename(source, target)
+
+        with mock.patch("os.stat", stat), mock.patch("os.rename", rename):
+            self.storage.publish("owner", key, staging_dir)
+        self.assertFalse(os.path.exists(staging_dir))
+        self.assertEqual(self.storage.list_files("owner", key), ["result.csv"])
+        self.assertEqual(self.storage.read_metadata("owner", key, ".log"), b"log text\n")
+        # the copy is only renamed into place once it is complete, and nothing is left next to it
+        self.assertEqual(os.listdir(os.path.dirname(self.storage.local_path("owner", key))), [key])
+
+
+@unittest.skipUnless(os.getenv("DERIVA_WEB_TEST_S3_ENDPOINT"),
+                     "This test requires an S3-compatible endpoint (e.g. MinIO) named by DERIVA_WEB_TEST_S3_ENDPOINT.")
+class TestS3Storage (StorageTestMixin, unittest.TestCase):
+    """Set DERIVA_WEB_TEST_S3_ENDPOINT, DERIVA_WEB_TEST_S3_BUCKET and the usual AWS_ACCESS_KEY_ID and
+    AWS_SECRET_ACCESS_KEY environment variables to run these tests."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = storage.create_export_storage({
+            "type": "s3",
+            "bucket": os.getenv("DERIVA_WEB_TEST_S3_BUCKET", "deriva-web-test"),
+            "prefix": "test-%s" % uuid.uuid4(),
+            "endpoint_url": os.getenv("DERIVA_WEB_TEST_S3_ENDPOINT")
+        }, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_presigned_url(self):
+        staging_dir = self.make_staging_dir()
+        key = os.path.basename(staging_dir)
+        self.storage.publish("owner", key, staging_dir)
+        self.assertFalse(os.path.exists(staging_dir))
+        url = self.storage.get_download_url("owner", key, "result.csv")
+        self.assertIn("result.csv", url)
+        self.assertIn("Signature", url)
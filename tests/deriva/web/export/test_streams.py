@@ -0,0 +1,58 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import unittest
+from deriva.web.export import streams
+
+
+class StreamLimitTest(unittest.TestCase):
+
+    def test_limited_stream(self):
+        first = streams.limited_stream(iter(["a", "b"]), 1, refused="busy")
+        self.assertEqual(next(first), "a")
+        # the only slot is held by the first stream until it ends
+        self.assertEqual(list(streams.limited_stream(iter(["c"]), 1, refused="busy")), ["busy"])
+        self.assertEqual(list(first), ["b"])
+        self.assertEqual(list(streams.limited_stream(iter(["c"]), 1, refused="busy")), ["c"])
+        self.assertEqual(streams.stream_slots.active, 0)
+
+    def test_closed_stream_releases_slot(self):
+        stream = streams.limited_stream(iter(["a", "b"]), 1)
+        next(stream)
+        self.assertEqual(streams.stream_slots.active, 1)
+        stream.close()
+        self.assertEqual(streams.stream_slots.active, 0)
+        # a stream which is closed before it is sent never holds a slot
+        streams.limited_stream(iter(["a"]), 1).close()
+        self.assertEqual(streams.stream_slots.active, 0)
+
+    def test_held_slot(self):
+        with streams.stream_slots.held(1) as first:
+            with streams.stream_slots.held(1) as second:
+                self.assertTrue(first)
+                self.assertFalse(second)
+            self.assertEqual(streams.stream_slots.active, 1)
+        self.assertEqual(streams.stream_slots.active, 0)
+
+    def test_unlimited_stream(self):
+        held = [streams.limited_stream(iter(["a", "b"]), 0) for _ in range(3)]
+        self.assertEqual([next(stream) for stream in held], ["a", "a", "a"])
+        for stream in held:
+            stream.close()
+        self.assertEqual(streams.stream_slots.active, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from functools import partial
+from contextlib import contextmanager
+from deriva.web.core import Forbidden
+from deriva.web.state import SharedState
+from deriva.web.export import api, jobs
+
+
+class SubmitExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        state.register_schema(jobs.EXPORT_JOBS_DDL)
+        self.client = api.ExportClient(owner="owner")
+        self.locked = threading.Event()
+        self.released = threading.Event()
+        for patcher in (mock.patch("deriva.web.state._shared_state", state),
+                        mock.patch.object(api.ExportClient, "from_request", return_value=self.client),
+                        mock.patch.object(api, "user_export_lock", self.user_export_lock)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.output_dir = os.path.join(self.tmp_dir, "key")
+        os.makedirs(self.output_dir)
+        jobs.create_job("key", "owner", self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @contextmanager
+    def user_export_lock(self, exclusive=True):
+        self.locked.set()
+        try:
+            yield
+        finally:
+            self.released.set()
+
+    def test_submit_export(self):
+        calls = list()
+        proceed = threading.Event()
+
+        def export(base_dir=None, client=None, user_lock=True):
+            proceed.wait(10)
+            calls.append((base_dir, client, user_lock, threading.current_thread()))
+
+        thread = api.submit_export(partial(export, base_dir=self.output_dir))
+        # the lock is acquired by the request, and held by the export until it finishes
+        self.assertTrue(self.locked.is_set())
+        self.assertFalse(self.released.is_set())
+        proceed.set()
+        thread.join(10)
+        self.assertTrue(self.released.is_set())
+        self.assertEqual(calls, [(self.output_dir, self.client, False, thread)])
+
+    def test_submit_export_refused(self):
+        @contextmanager
+        def user_export_lock(exclusive=True):
+            raise Forbidden("Multiple concurrent exports per user are not supported.")
+            yield
+
+        with mock.patch.object(api, "user_export_lock", user_export_lock):
+            with self.assertRaises(Forbidden):
+                api.submit_export(partial(mock.Mock(), base_dir=self.output_dir))
+        self.assertEqual(jobs.get_job("key")["status"], jobs.JOB_FAILED)
+        self.assertFalse(os.path.exists(self.output_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from deriva.web.core import BadRequest, NotFound, InternalServerError
+from deriva.web.export import templates
+
+TEMPLATE = {
+    "type": "bdbag",
+    "parameters": {"RID": {"pattern": "[0-9A-Z-]+"}, "limit": {"pattern": "[0-9]+", "default": 100}},
+    "settings": {"timeout_secs": 1800},
+    "config": {
+        "catalog": {
+            "host": "https://www.example.org",
+            "catalog_id": "1",
+            "query_processors": [{
+                "processor": "csv",
+                "processor_params": {"query_path": "/entity/S:Sample/RID={RID_urlencoded}?limit={limit}",
+                                     "output_path": "sample-{RID}"}
+            }]
+        },
+        "bag": {"bag_name": "sample-{RID}", "bag_archiver": "zip"}
+    }
+}
+
+
+class ExportTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.handler_config = {"templates_path": self.tmp_dir, "timeout_secs": 600}
+        self.write_template("sample", TEMPLATE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_template(self, name, document):
+        with open(os.path.join(self.tmp_dir, name + ".json"), "w") as tf:
+            json.dump(document, tf)
+
+    def test_resolve_request(self):
+        request = {"template": "sample", "parameters": {"RID": "1-ABCD"}}
+        config, settings, template, envars = templates.resolve_export_request(request, "bdbag", self.handler_config)
+        self.assertEqual(envars, {"RID": "1-ABCD", "limit": "100"})
+        self.assertEqual(settings["timeout_secs"], 1800)
+        self.assertEqual(template.archiver, "zip")
+        self.assertIsNone(config["bag"]["bag_archiver"])
+        config["bag"]["bag_name"] = "changed"
+        self.assertIs(templates.get_export_template("sample", self.handler_config), template)
+        self.assertEqual(template.config["bag"]["bag_name"], "sample-{RID}")
+
+    def test_plain_request(self):
+        request = {"catalog": {"host": "www.example.org"}}
+        config, settings, template, envars = templates.resolve_export_request(request, "bdbag", self.handler_config)
+        self.assertIs(config, request)
+        self.assertIsNone(template)
+
+    def test_invalid_parameters(self):
+        for parameters in ({}, {"RID": "1-ABCD/x"}, {"RID": "1-ABCD", "other": "x"}):
+            with self.assertRaises(BadRequest):
+                templates.resolve_export_request({"template": "sample", "parameters": parameters}, "bdbag",
+                                                 self.handler_config)
+        with self.assertRaises(BadRequest):
+            templates.resolve_export_request({"template": "sample", "parameters": {"RID": "1-ABCD"}}, "file",
+                                             self.handler_config)
+
+    def test_dot_parameters(self):
+        # values which would make the bag name refer to the output directory or its parent are rejected
+        document = json.loads(json.dumps(TEMPLATE))
+        document["parameters"]["name"] = {"default": "sample"}
+        document["parameters"]["path"] = {"pattern": "[a-z./]+", "default": "a/b"}
+        document["config"]["bag"]["bag_name"] = "{name}"
+        document["config"]["catalog"]["query_processors"][0]["processor_params"]["output_path"] = "{path}"
+        self.write_template("named", document)
+        for parameters in ({"name": "."}, {"name": ".."}, {"name": "..."}, {"path": "a/../b"}, {"path": "./a"}):
+            with self.assertRaises(BadRequest):
+                templates.resolve_export_request({"template": "named", "parameters": dict(parameters, RID="1-ABCD")},
+                                                 "bdbag", self.handler_config)
+        for parameters in ({"name": "sample.v1"}, {"name": ".sample"}, {"path": "a.b/c"}):
+            templates.resolve_export_request({"template": "named", "parameters": dict(parameters, RID="1-ABCD")},
+                                             "bdbag", self.handler_config)
+
+    def test_invalid_template(self):
+        with self.assertRaises(NotFound):
+            templates.get_export_template("missing", self.handler_config)
+        document = json.loads(json.dumps(TEMPLATE))
+        document["config"]["bag"]["bag_name"] = "sample-{undeclared}"
+        self.write_template("broken", document)
+        with self.assertRaises(InternalServerError):
+            templates.get_export_template("broken", self.handler_config)
+        # the bag name is formatted without the URL-encoded parameters
+        document["config"]["bag"]["bag_name"] = "sample-{RID_urlencoded}"
+        self.write_template("encoded", document)
+        with self.assertRaisesRegex(InternalServerError, "RID_urlencoded"):
+            templates.get_export_template("encoded", self.handler_config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import logging
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+from deriva.web.state import SharedState
+from deriva.web.export import warm, events, runner
+from deriva.web.export.storage import LocalStorage
+
+
+class WarmScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        state.register_schema(warm.WARM_EXPORTS_DDL)
+        patcher = mock.patch("deriva.web.state._shared_state", state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_off_peak_hours(self):
+        def at(hour):
+            return datetime.datetime(2024, 1, 1, hour)
+        self.assertTrue(warm.is_off_peak(None, at(12)))
+        self.assertTrue(warm.is_off_peak([3, 3], at(12)))
+        self.assertEqual([False, True, True, False], [warm.is_off_peak([1, 5], at(hour)) for hour in (0, 1, 4, 5)])
+        # a window which spans midnight
+        self.assertEqual([False, True, True, True, False],
+                         [warm.is_off_peak([22, 4], at(hour)) for hour in (21, 22, 0, 3, 4)])
+
+    def test_claim_warm_build(self):
+        with mock.patch("time.time", return_value=1000):
+            self.assertTrue(warm.claim_warm_build("name", "digest", 3600, 600))
+            # another process does not build it while it is claimed
+            self.assertFalse(warm.claim_warm_build("name", "digest", 3600, 600))
+            warm._finish_build("name", config_digest="digest", snaptime="2TS", built=1000, stale=0)
+            self.assertFalse(warm.claim_warm_build("name", "digest", 3600, 600))
+            self.assertTrue(warm.claim_warm_build("name", "other-digest", 3600, 600))
+            warm._finish_build("name", config_digest="digest", built=1000, stale=0)
+            warm.mark_warm_export_stale("name")
+            self.assertTrue(warm.claim_warm_build("name", "digest", 3600, 600))
+            warm._finish_build("name", built=1000, stale=0)
+        with mock.patch("time.time", return_value=4600):
+            self.assertTrue(warm.claim_warm_build("name", "digest", 3600, 600))
+
+
+class WarmBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        state.register_schema(warm.WARM_EXPORTS_DDL)
+        state.register_schema(events.EXPORT_EVENTS_DDL)
+        self.storage = LocalStorage(os.path.join(self.tmp_dir, "export"))
+        self.snaptime = "2TS-0001"
+        self.builds = list()
+        for patcher in (mock.patch("deriva.web.state._shared_state", state),
+                        mock.patch.object(warm, "get_export_storage", return_value=self.storage),
+                        mock.patch.object(warm, "get_service_credentials", return_value=None),
+                        mock.patch.object(warm, "get_catalog_snaptime", lambda server, credentials: self.snaptime),
+                        mock.patch.object(runner, "run_export", self.run_export)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.entry = {"type": "file", "acl": ["*"],
+                      "config": {"catalog": {"host": "https://example.org", "catalog_id": "1",
+                                             "query_processors": []}}}
+        self.handler_config = {"scratch_path": os.path.join(self.tmp_dir, "scratch"), "isolation": {"enabled": False}}
+
+    def tearDown(self):
+        for handler in list(logging.getLogger().handlers):
+            if getattr(handler, "baseFilename", "").startswith(self.tmp_dir):
+                logging.getLogger().removeHandler(handler)
+        shutil.rmtree(self.tmp_dir)
+
+    def run_export(self, server, base_dir, progress, **kwargs):
+        self.builds.append(server["catalog_id"])
+        progress("Export started")
+        path = os.path.join(base_dir, "data.csv")
+        with open(path, "w") as f:
+            f.write("id\n1\n")
+        return {"data.csv": {runner.GenericDownloader.LOCAL_PATH_KEY: path}}
+
+    def build(self):
+        warm.claim_warm_build("dataset", "digest", 0, 600)
+        warm.build_warm_export("dataset", self.entry, self.handler_config)
+
+    def test_snapshot_reuse(self):
+        self.build()
+        self.assertEqual(["1@2TS-0001"], self.builds)
+        self.assertTrue(self.storage.exists(warm.WARM_OWNER, "warm-dataset"))
+        state = warm.get_warm_state("dataset")
+        self.assertEqual(("2TS-0001", {"data.csv": {}}), (state["snaptime"], warm.json.loads(state["outputs"])))
+        # an unchanged catalog snapshot is not exported again
+        self.build()
+        self.assertEqual(1, len(self.builds))
+        # a changed snapshot is, and the events of the build it replaces are deleted
+        self.snaptime = "2TS-0002"
+        self.build()
+        self.assertEqual(["1@2TS-0001", "1@2TS-0002"], self.builds)
+        self.assertEqual(1, len(events.get_events("warm-dataset")))
+        self.assertEqual("2TS-0002", warm.get_warm_state("dataset")["snaptime"])
+
+    def test_rebuild_after_deletion(self):
+        self.build()
+        self.storage.delete(warm.WARM_OWNER, "warm-dataset")
+        self.build()
+        self.assertEqual(2, len(self.builds))
+
+    def test_isolated_build_log(self):
+        self.handler_config["isolation"] = {"enabled": True}
+        with mock.patch.object(warm, "is_isolation_available", return_value=True), \
+                mock.patch.object(warm, "run_isolated", return_value={}) as run_isolated:
+            self.build()
+        kwargs = run_isolated.call_args[1]
+        self.assertEqual(".log", os.path.basename(kwargs["log_path"]))
+        self.assertEqual(logging.INFO, kwargs["log_level"])
+        self.assertTrue(os.path.isfile(self.storage.local_path(warm.WARM_OWNER, "warm-dataset", ".log")))
+
+
+if __name__ == '__main__':
+    unittest.main()
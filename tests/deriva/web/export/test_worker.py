@@ -0,0 +1,100 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+from deriva.transfer.download import DerivaDownloadTimeoutError
+from deriva.web.export import worker
+
+
+def _get_pid():
+    return os.getpid()
+
+
+def _raise():
+    raise ValueError("export failed")
+
+
+def _sleep():
+    time.sleep(30)
+
+
+def _spin():
+    while True:
+        pass
+
+
+_lock = threading.Lock()
+
+
+def _acquire_lock():
+    return _lock.acquire(timeout=2)
+
+
+def _log(message):
+    logging.getLogger("deriva.web.export").info(message)
+
+
+@unittest.skipUnless(worker.is_isolation_available(), "process isolation is not available")
+class RunIsolatedTest(unittest.TestCase):
+
+    def test_result(self):
+        self.assertNotEqual(worker.run_isolated(_get_pid), os.getpid())
+
+    def test_exception(self):
+        with self.assertRaisesRegex(ValueError, "export failed"):
+            worker.run_isolated(_raise)
+
+    def test_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(DerivaDownloadTimeoutError):
+            worker.run_isolated(_sleep, timeout=1, poll_interval=0.1)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_cancel(self):
+        with self.assertRaises(worker.ExportCancelledError):
+            worker.run_isolated(_sleep, is_cancelled=lambda: True, poll_interval=0.1)
+
+    @unittest.skipIf(worker.resource is None, "resource limits are not supported on this platform")
+    def test_cpu_limit(self):
+        with self.assertRaisesRegex(worker.ExportProcessError, "CPU time limit"):
+            worker.run_isolated(_spin, limits={"max_cpu_secs": 1}, timeout=30, poll_interval=0.1)
+
+    def test_inherited_lock(self):
+        # a child must not inherit a lock which another thread of the parent holds, as a forked child would
+        _lock.acquire()
+        try:
+            self.assertTrue(worker.run_isolated(_acquire_lock))
+        finally:
+            _lock.release()
+
+    def test_child_log(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmp_dir, ".log")
+            worker.run_isolated(_log, args=("logged by the child",), log_path=log_path)
+            with open(log_path) as log:
+                self.assertIn("INFO - logged by the child", log.read())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from deriva.web.export.zipindex import get_zip_index
+
+TEXT = b"".join(b"%d,sample-%d\n" % (i, i) for i in range(20000))
+BINARY = os.urandom(10000)
+
+
+class ZipIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.tmp_dir, "bag.zip")
+        with ZipFile(self.zip_path, "w") as zf:
+            zf.writestr("bag/data/samples.csv", TEXT, compress_type=ZIP_DEFLATED)
+            zf.writestr("bag/data/image.bin", BINARY, compress_type=ZIP_STORED)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_list(self):
+        index = get_zip_index(self.zip_path)
+        self.assertEqual([m.name for m in index.list()], ["bag/data/samples.csv", "bag/data/image.bin"])
+        self.assertEqual(index.list("bag/data/s")[0].describe()["compression"], "deflated")
+        self.assertIs(get_zip_index(self.zip_path), index)
+
+    def test_read(self):
+        index = get_zip_index(self.zip_path)
+        text, binary = index.get("bag/data/samples.csv"), index.get("bag/data/image.bin")
+        self.assertEqual(b"".join(index.read(text)), TEXT)
+        self.assertEqual(b"".join(index.read(binary)), BINARY)
+        self.assertEqual(b"".join(index.read(text, 100000, 50)), TEXT[100000:100050])
+        self.assertEqual(b"".join(index.read(binary, 9990, 100)), BINARY[9990:])
+
+    def test_read_gzip(self):
+        index = get_zip_index(self.zip_path)
+        member = index.get("bag/data/samples.csv")
+        data = b"".join(index.read_gzip(member))
+        self.assertEqual(len(data), index.gzip_size(member))
+        self.assertEqual(gzip.decompress(data), TEXT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+import flask
+from deriva.web import compression
+from deriva.web.core import app, deriva_ctx, RestHandler
+
+
+class NegotiateEncodingTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        encodings = ["gzip"]
+        self.assertEqual(compression.negotiate_encoding("gzip, deflate", encodings), "gzip")
+        self.assertEqual(compression.negotiate_encoding("x-gzip", encodings), "gzip")
+        self.assertEqual(compression.negotiate_encoding("*", encodings), "gzip")
+        self.assertIsNone(compression.negotiate_encoding("gzip;q=0", encodings))
+        self.assertIsNone(compression.negotiate_encoding("identity", encodings))
+        self.assertIsNone(compression.negotiate_encoding(None, encodings))
+
+    def test_client_preference(self):
+        self.assertEqual(compression.negotiate_encoding("br;q=0.1, gzip;q=0.9", ["br", "gzip"]), "gzip")
+
+    def test_compressible(self):
+        config = compression.get_compression_config({"min_size": 100})
+        self.assertTrue(compression.is_compressible(config, "text/csv; charset=utf-8", 1000))
+        self.assertTrue(compression.is_compressible(config, "application/ld+json"))
+        self.assertFalse(compression.is_compressible(config, "application/zip", 1000))
+        self.assertFalse(compression.is_compressible(config, "text/plain", 10))
+
+
+class SidecarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, "data.csv")
+        with open(self.file_path, "w") as f:
+            f.write("id,name\n" * 10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_sidecar(self):
+        sidecar_path = compression.get_sidecar_path(self.file_path, "gzip")
+        chunks = compression.compress_chunks(compression.read_file_chunks(self.file_path, chunk_size=1000), "gzip")
+        data = b"".join(compression.write_sidecar(chunks, self.file_path, sidecar_path))
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(gzip.decompress(data), f.read())
+        self.assertTrue(compression.is_sidecar_current(self.file_path, sidecar_path))
+        with open(sidecar_path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        os.utime(self.file_path)
+        self.assertFalse(compression.is_sidecar_current(self.file_path, sidecar_path))
+
+    def test_interrupted_sidecar(self):
+        sidecar_path = compression.get_sidecar_path(self.file_path, "gzip")
+        chunks = compression.compress_chunks(compression.read_file_chunks(self.file_path, chunk_size=1000), "gzip")
+        stream = compression.write_sidecar(chunks, self.file_path, sidecar_path)
+        next(stream)
+        stream.close()
+        self.assertEqual(os.listdir(os.path.dirname(sidecar_path)), [])
+
+
+class GetContentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, ".log")
+        with open(self.file_path, "w") as f:
+            f.write("export started\n" * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_content(self, growing):
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            deriva_ctx.deriva_response = flask.Response(content_type="text/plain")
+            response = RestHandler().get_content(self.file_path, growing=growing)
+            # the file grows while it is being sent
+            with open(self.file_path, "a") as f:
+                f.write("export finished\n")
+            data = gzip.decompress(b"".join(response.response))
+            self.assertEqual("gzip", response.content_encoding)
+        return data
+
+    def test_growing_file(self):
+        data = self.get_content(growing=True)
+        self.assertEqual(b"export started\n" * 1000, data)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, compression.SIDECAR_DIR_NAME)))
+
+    def test_sidecar(self):
+        self.get_content(growing=False)
+        sidecar_path = compression.get_sidecar_path(self.file_path, "gzip")
+        self.assertTrue(os.path.isfile(sidecar_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
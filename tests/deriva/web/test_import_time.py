@@ -0,0 +1,67 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import unittest
+import importlib.util
+import subprocess
+
+# modules which must only be loaded on first use, never by importing the app
+DEFERRED_MODULES = ["deriva.transfer", "deriva.web.export.runner", "boto3", "pytz", "webauthn2.manager"]
+
+# cold start budget for "import deriva.web.app" in milliseconds (cumulative import time, best of several runs)
+IMPORT_BUDGET_MS = float(os.getenv("DERIVA_WEB_IMPORT_BUDGET_MS", 1000))
+IMPORT_RUNS = 3
+
+
+def measure_app_import():
+    """Import the app in a fresh interpreter with -X importtime, returning {module: cumulative microseconds}."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import deriva.web.app"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            modules[fields[2].strip()] = int(fields[1])
+        except ValueError:
+            continue  # header line
+    return modules
+
+
+@unittest.skipUnless(importlib.util.find_spec("webauthn2"), "webauthn2 is required to import the app")
+class ImportTimeTest(unittest.TestCase):
+
+    def test_deferred_modules(self):
+        modules = measure_app_import()
+        self.assertIn("deriva.web.app", modules)
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, modules, "%s is imported eagerly by deriva.web.app" % module)
+
+    def test_deferred_constants(self):
+        from deriva.transfer import GenericDownloader
+        from deriva.web.export import api
+        self.assertEqual(api.REMOTE_PATHS_KEY, GenericDownloader.REMOTE_PATHS_KEY)
+
+    def test_import_budget(self):
+        elapsed_ms = min(measure_app_import()["deriva.web.app"] for _ in range(IMPORT_RUNS)) / 1000.0
+        self.assertLess(elapsed_ms, IMPORT_BUDGET_MS,
+                        "Importing deriva.web.app took %.0f ms, the budget is %.0f ms" % (elapsed_ms, IMPORT_BUDGET_MS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from deriva.web.profiling import RequestProfiler, profiled, format_profile, new_profile_id
+
+
+class RequestProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.profiler = RequestProfiler({"enabled": True, "admin_groups": ["admins"], "max_profiles": 2}, self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled(self):
+        self.assertFalse(RequestProfiler(None, self.tmp_dir).is_requested({"Deriva-Profile": "1"}))
+        self.assertFalse(RequestProfiler({"enabled": True}, self.tmp_dir).enabled)
+        self.assertTrue(self.profiler.is_requested({"Deriva-Profile": "1"}))
+        self.assertFalse(self.profiler.is_requested({}))
+
+    def test_profile_request(self):
+        profile_ids = list()
+        for i in range(3):
+            profile = self.profiler.start()
+            self.assertIsNotNone(profile)
+            self.assertIsNone(self.profiler.start())
+            sum(range(1000))
+            profile_id = new_profile_id("guid-%d" % i)
+            self.profiler.stop(profile, profile_id)
+            os.utime(self.profiler.get_profile_path(profile_id), (i, i))
+            profile_ids.append(profile_id)
+        self.assertEqual([p[0] for p in self.profiler.list_profiles()], profile_ids[:0:-1])
+        self.assertIn("function calls", format_profile(self.profiler.get_profile_path(profile_ids[2])))
+
+    def test_profiled(self):
+        path = self.profiler.get_profile_path("child", "-export")
+        with profiled(path):
+            sum(range(1000))
+        self.assertTrue(os.path.isfile(path))
+        with self.assertRaises(ValueError):
+            self.profiler.get_profile_path("../child")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from deriva.web.state import SharedState
+from deriva.web.ratelimit import RateLimiter, RATE_LIMIT_DDL
+from deriva.web.core import resolve_client_ip, parse_trusted_proxies
+
+CONFIG = {
+    "enabled": True,
+    "exempt_groups": ["admins"],
+    "routes": [
+        {
+            "name": "export",
+            "paths": ["/export/"],
+            "methods": ["POST"],
+            "identity": {"rate_per_min": 60, "burst": 2},
+            "anonymous": {"rate_per_min": 6, "burst": 1}
+        }
+    ]
+}
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state = SharedState(os.path.join(self.tmp_dir, "state.db"))
+        self.state.register_schema(RATE_LIMIT_DDL)
+        self.now = 1000.0
+        self.limiter = RateLimiter(CONFIG, state=self.state, clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_burst_and_refill(self):
+        self.assertEqual(self.limiter.check("/export/bdbag", "POST", identity="alice"), 0)
+        self.assertEqual(self.limiter.check("/export/file", "POST", identity="alice"), 0)
+        self.assertAlmostEqual(self.limiter.check("/export/file", "POST", identity="alice"), 1.0)
+        # other identities have their own buckets
+        self.assertEqual(self.limiter.check("/export/file", "POST", identity="bob"), 0)
+        self.now += 1.0
+        self.assertEqual(self.limiter.check("/export/file", "POST", identity="alice"), 0)
+
+    def test_anonymous_ip(self):
+        self.assertEqual(self.limiter.check("/export/file", "POST", ip="10.0.0.1"), 0)
+        self.assertAlmostEqual(self.limiter.check("/export/file", "POST", ip="10.0.0.1"), 10.0)
+        self.assertEqual(self.limiter.check("/export/file", "POST", ip="10.0.0.2"), 0)
+
+    def test_unmatched_requests(self):
+        for _ in range(5):
+            self.assertEqual(self.limiter.check("/export/file/key", "GET", ip="10.0.0.1"), 0)
+            self.assertEqual(self.limiter.check("/transform/format/1", "POST", ip="10.0.0.1"), 0)
+
+    def test_exempt_groups(self):
+        for _ in range(5):
+            self.assertEqual(self.limiter.check("/export/file", "POST", identity="carol",
+                                                attribute_ids=frozenset(["carol", "admins"])), 0)
+
+    def test_shared_between_limiters(self):
+        other = RateLimiter(CONFIG, state=SharedState(self.state.db_path), clock=lambda: self.now)
+        self.assertEqual(self.limiter.check("/export/file", "POST", ip="10.0.0.1"), 0)
+        self.assertGreater(other.check("/export/file", "POST", ip="10.0.0.1"), 0)
+
+
+class ClientIPTest(unittest.TestCase):
+
+    def test_untrusted_peer(self):
+        # without a trusted proxy, a client cannot choose its own address with X-Forwarded-For
+        self.assertEqual(resolve_client_ip("192.0.2.1", "10.0.0.1"), "192.0.2.1")
+        self.assertEqual(resolve_client_ip("2001:db8::1", "10.0.0.1"), "2001:db8::1")
+        self.assertEqual(resolve_client_ip("2001:DB8:0::2"), "2001:db8::2")
+        self.assertIsNone(resolve_client_ip("unknown"))
+
+    def test_trusted_proxies(self):
+        proxies = parse_trusted_proxies(["127.0.0.1", "10.0.0.0/8", "not-an-address"])
+        self.assertEqual(len(proxies), 2)
+        # the right-most entry which was not added by a trusted proxy is the client
+        self.assertEqual(resolve_client_ip("127.0.0.1", "203.0.113.7, 192.0.2.1, 10.1.2.3", proxies), "192.0.2.1")
+        self.assertEqual(resolve_client_ip("127.0.0.1", "2001:db8::1", proxies), "2001:db8::1")
+        self.assertEqual(resolve_client_ip("127.0.0.1", "garbage", proxies), "127.0.0.1")
+        self.assertEqual(resolve_client_ip("192.0.2.9", "10.1.2.3", proxies), "192.0.2.9")
+
+
+if __name__ == '__main__':
+    unittest.main()
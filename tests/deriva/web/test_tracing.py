@@ -0,0 +1,115 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from deriva.web.tracing import Tracer, TracedIterable, traced, trace_context, parse_traceparent, NON_RECORDING_SPAN
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "traces", "traces.jsonl")
+        self.tracer = Tracer({"enabled": True}, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_traces(self):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"] for line in f]
+
+    def test_disabled(self):
+        tracer = Tracer(None, self.path)
+        self.assertIsNone(tracer.start_trace("GET /"))
+        with traced("work") as span:
+            self.assertIs(span, NON_RECORDING_SPAN)
+        self.assertIsNone(trace_context())
+        self.assertFalse(Tracer({"enabled": True, "exporter": "collector"}, self.path).enabled)
+        self.assertIsNone(Tracer({"enabled": True, "sample_rate": 0}, self.path).start_trace("GET /"))
+
+    def test_request_trace(self):
+        root = self.tracer.start_trace("GET /export/bdbag/<key>", attributes={"deriva.request_guid": "guid"})
+        with traced("webauthn2.get_request_context"):
+            pass
+        with self.assertRaises(ValueError):
+            with traced("get_content", {"file.path": "/tmp/data.csv"}):
+                raise ValueError("missing")
+        body = TracedIterable("http.response.send", [b"abc", b"de"])
+        self.assertEqual(b"abcde", b"".join(body))
+        body.close()
+        self.tracer.end_trace(root)
+        self.assertIsNone(trace_context())
+
+        spans = {span["name"]: span for span in self.read_traces()[0]}
+        self.assertEqual(4, len(spans))
+        request = spans["GET /export/bdbag/<key>"]
+        self.assertNotIn("parentSpanId", request)
+        self.assertEqual(32, len(request["traceId"]))
+        for name in ("webauthn2.get_request_context", "get_content", "http.response.send"):
+            self.assertEqual(request["spanId"], spans[name]["parentSpanId"])
+            self.assertEqual(request["traceId"], spans[name]["traceId"])
+        self.assertEqual(2, spans["get_content"]["status"]["code"])
+        self.assertIn({"key": "http.response.body.size", "value": {"intValue": "5"}},
+                      spans["http.response.send"]["attributes"])
+        self.assertIn({"key": "deriva.request_guid", "value": {"stringValue": "guid"}}, request["attributes"])
+
+    def test_traceparent(self):
+        traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        self.assertEqual(("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", True),
+                         parse_traceparent(traceparent))
+        self.assertIsNone(parse_traceparent("00-0af7651916cd43dd8448eb211c80319c-0000000000000000-01"))
+        root = self.tracer.start_trace("GET /", traceparent=traceparent)
+        self.tracer.end_trace(root)
+        span = self.read_traces()[0][0]
+        self.assertEqual("0af7651916cd43dd8448eb211c80319c", span["traceId"])
+        self.assertEqual("b7ad6b7169203331", span["parentSpanId"])
+        # an unsampled caller is not traced
+        self.assertIsNone(self.tracer.start_trace("GET /", traceparent=traceparent[:-2] + "00"))
+
+    def test_resumed_trace(self):
+        root = self.tracer.start_trace("POST /export/batch")
+        context = trace_context()
+
+        def run():
+            with self.tracer.resumed(context, "export"):
+                with traced("export.run"):
+                    pass
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.tracer.end_trace(root)
+
+        batch_item, request = self.read_traces()
+        self.assertEqual(["export", "export.run"], [span["name"] for span in batch_item])
+        self.assertEqual(request[0]["traceId"], batch_item[0]["traceId"])
+        self.assertEqual(request[0]["spanId"], batch_item[0]["parentSpanId"])
+
+    def test_min_duration(self):
+        tracer = Tracer({"enabled": True, "min_duration_ms": 60000}, self.path)
+        tracer.end_trace(tracer.start_trace("GET /"))
+        self.assertEqual([], self.read_traces())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#
+# Copyright 2016-2023 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Load test measuring how request throughput scales with the number of service processes.
+
+The service is hosted in a throwaway storage area by a small pre-forking WSGI server (one listening socket shared by N
+threaded worker processes, similar to a mod_wsgi daemon process group), and is driven by a pool of client processes
+issuing retrieval requests (and optionally transform requests) over keep-alive connections.
+
+The test is skipped unless DERIVA_WEB_LOAD_TEST is set, because it takes a while and its result depends on the number
+of CPUs of the host. It measures the process counts given by DERIVA_WEB_LOAD_PROCESSES (default "1 2 4"), and fails if
+the scaling efficiency at the largest process count is below DERIVA_WEB_LOAD_MIN_EFFICIENCY (default 0.5).
+
+    DERIVA_WEB_LOAD_TEST=1 python -m pytest tests/load
+
+It can also be run as a script, which prints the measurements:
+
+    python tests/load/test_export_scaling.py --processes 1 2 4 8 --duration 10
+
+Transform requests require a reachable ERMrest server, named by DERIVA_WEB_TRANSFORM_HOSTNAME, and a query given with
+--transform-query. The script exits non-zero if the scaling efficiency at the largest process count is below
+--min-efficiency.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import signal
+import argparse
+import tempfile
+import unittest
+import http.client
+import multiprocessing
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def make_fixture(home, payload_kb):
+    storage = os.path.join(home, "data")
+    with open(os.path.join(home, "deriva_config.json"), "w") as cf:
+        json.dump({"storage_path": storage}, cf)
+    key = str(uuid.uuid4())
+    export_dir = os.path.join(storage, "export", "anon-127.0.0.1", key)
+    os.makedirs(export_dir)
+    with open(os.path.join(export_dir, ".access"), "w") as access:
+        access.write("*\n")
+    with open(os.path.join(export_dir, "data.csv"), "wb") as data:
+        data.write(b"x" * payload_kb * 1024)
+    return key
+
+
+def serve(sock, home):
+    os.environ["HOME"] = home
+    from deriva.web.app import app
+    server = ThreadingWSGIServer(sock.getsockname(), QuietHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_name, server.server_port = sock.getsockname()[:2]
+    server.setup_environ()
+    server.set_app(app)
+    server.serve_forever()
+
+
+def client(port, paths, deadline, results):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    count = errors = 0
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                count += 1
+            else:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+    results.put((count, errors))
+
+
+def run(processes, clients, duration, home, paths):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1024)
+    port = sock.getsockname()[1]
+    workers = [multiprocessing.Process(target=serve, args=(sock, home), daemon=True)
+               for _ in range(processes)]
+    for w in workers:
+        w.start()
+    time.sleep(2)  # allow the workers to import the app
+
+    results = multiprocessing.Queue()
+    deadline = time.time() + duration
+    drivers = [multiprocessing.Process(target=client, args=(port, paths, deadline, results)) for _ in range(clients)]
+    for d in drivers:
+        d.start()
+    totals = [results.get() for _ in drivers]
+    for d in drivers:
+        d.join()
+    for w in workers:
+        os.kill(w.pid, signal.SIGTERM)
+        w.join()
+    sock.close()
+    return sum(t[0] for t in totals) / float(duration), sum(t[1] for t in totals)
+
+
+def measure(process_counts, clients=0, duration=10, payload_kb=64, transform_query=None):
+    """Returns a list of (processes, requests/s, speedup, errors) for each of process_counts."""
+    home = tempfile.mkdtemp(prefix="deriva-web-load-")
+    key = make_fixture(home, payload_kb)
+    paths = ["/export/file/%s/data.csv" % key]
+    if transform_query:
+        paths.append(transform_query)
+
+    baseline = None
+    measurements = list()
+    for processes in process_counts:
+        rps, errors = run(processes, clients or 4 * processes, duration, home, paths)
+        baseline = baseline or (rps / processes)
+        speedup = rps / baseline if baseline else 0.0
+        measurements.append((processes, rps, speedup, errors))
+    return measurements
+
+
+def efficiency(measurements):
+    processes, rps, speedup, errors = measurements[-1]
+    return speedup / processes
+
+
+@unittest.skipUnless(os.getenv("DERIVA_WEB_LOAD_TEST"), "set DERIVA_WEB_LOAD_TEST to run the load test")
+class ExportScalingTest(unittest.TestCase):
+
+    def test_scaling(self):
+        process_counts = [int(n) for n in os.getenv("DERIVA_WEB_LOAD_PROCESSES", "1 2 4").split()]
+        min_efficiency = float(os.getenv("DERIVA_WEB_LOAD_MIN_EFFICIENCY", 0.5))
+        measurements = measure(process_counts, duration=int(os.getenv("DERIVA_WEB_LOAD_DURATION", 5)))
+        for processes, rps, speedup, errors in measurements:
+            self.assertGreater(rps, 0, "No requests succeeded with %d processes" % processes)
+            self.assertEqual(errors, 0, "%d requests failed with %d processes" % (errors, processes))
+        self.assertGreaterEqual(efficiency(measurements), min_efficiency,
+                                "Scaling efficiency %.2f is below the required minimum of %.2f" %
+                                (efficiency(measurements), min_efficiency))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=0, help="client processes (default: 4 per server process)")
+    parser.add_argument("--duration", type=int, default=10)
+    parser.add_argument("--payload-kb", type=int, default=64)
+    parser.add_argument("--transform-query", default=None,
+                        help="a /transform/format/<catalog>?... path to include in the request mix")
+    parser.add_argument("--min-efficiency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    print("%10s %12s %10s %8s" % ("processes", "requests/s", "speedup", "errors"))
+    measurements = measure(args.processes, args.clients, args.duration, args.payload_kb, args.transform_query)
+    for processes, rps, speedup, errors in measurements:
+        print("%10d %12.1f %10.2f %8d" % (processes, rps, speedup, errors))
+
+    if efficiency(measurements) < args.min_efficiency:
+        print("Scaling efficiency %.2f is below the required minimum of %.2f" %
+              (efficiency(measurements), args.min_efficiency))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())